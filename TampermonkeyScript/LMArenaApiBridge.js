@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         LMArena API Bridge
 // @namespace    http://tampermonkey.net/
-// @version      2.6
+// @version      2.11
 // @description  Bridges LMArena to a local API server via WebSocket for streamlined automation.
 // @author       Lianues
 // @match        https://lmarena.ai/*
@@ -16,8 +16,30 @@
 
     // --- 配置 ---
     const SERVER_URL = "ws://localhost:5102/ws"; // 与 api_server.py 中的端口匹配
+    // 标签页 ID：保存在 sessionStorage 中，刷新页面后保持不变，不同标签页互不相同。
+    // 由 docker_browser_runner.py 启动的标签页会预先设置 window.__LMARENA_BRIDGE_TAB_ID，以便与服务器端的记录对应
+    const TAB_ID = (() => {
+        if (typeof window.__LMARENA_BRIDGE_TAB_ID === 'string' && window.__LMARENA_BRIDGE_TAB_ID) {
+            return window.__LMARENA_BRIDGE_TAB_ID;
+        }
+        try {
+            let id = sessionStorage.getItem('lmarena_bridge_tab_id');
+            if (!id) {
+                id = crypto.randomUUID();
+                sessionStorage.setItem('lmarena_bridge_tab_id', id);
+            }
+            return id;
+        } catch (e) {
+            return crypto.randomUUID();
+        }
+    })();
+    // 向服务器声明本脚本支持的能力
+    const CAPABILITIES = ['heartbeat', 'resume', 'parsed_stream', 'concurrency', 'abort', 'prefix_cache'];
+    const PREFIX_CACHE_SIZE = 16; // 缓存最近发送过的消息列表条数，服务器按此容量维护相同的镜像
     let socket;
     let isCaptureModeActive = false; // ID捕获模式的开关
+    // 批量捕获任务：{ jobId, remaining, seen }。为 null 时使用旧的单次捕获（发送到 id_updater.py）
+    let captureJob = null;
     let isAuthenticated = false; // 认证状态标志
 
     // --- 认证检查 ---
@@ -84,11 +106,22 @@
     // --- 核心逻辑 ---
     function connect() {
         console.log(`[API Bridge] 正在连接到本地服务器: ${SERVER_URL}...`);
-        socket = new WebSocket(SERVER_URL);
+        const ws = new WebSocket(`${SERVER_URL}?tab_id=${encodeURIComponent(TAB_ID)}`);
+        socket = ws;
 
         socket.onopen = async () => {
-            console.log("[API Bridge] ✅ 与本地服务器的 WebSocket 连接已建立。");
+            console.log(`[API Bridge] ✅ 与本地服务器的 WebSocket 连接已建立。标签页 ID: ${TAB_ID.substring(0, 8)}`);
             document.title = "✅ " + document.title;
+            // 声明仍在执行、排队中或尚未被确认的请求，服务器据此接管断线期间遗留的请求
+            ws.send(JSON.stringify({
+                type: 'hello',
+                tab_id: TAB_ID,
+                capabilities: CAPABILITIES,
+                inflight: [...new Set([...outgoingStreams.keys(), ...activeRequests.keys(), ...pendingQueue.map(item => item.requestId)])],
+                prefix_cache_size: PREFIX_CACHE_SIZE,
+                ...capacityState()
+            }));
+            replayUnackedChunks();
             
             // 连接建立后立即检查认证状态
             await ensureAuthentication();
@@ -100,15 +133,46 @@
 
                 // 检查是否是指令，而不是标准的聊天请求
                 if (message.command) {
+                    // 心跳：立即原样回传时间戳，服务器据此计算往返时间
+                    if (message.command === 'ping') {
+                        ws.send(JSON.stringify({ type: 'pong', ts: message.ts }));
+                        return;
+                    }
+                    if (message.command === 'ack') {
+                        handleAck(message.request_id, message.seq);
+                        return;
+                    }
+                    if (message.command === 'abort') {
+                        abortRequest(message.request_id);
+                        return;
+                    }
+                    if (message.command === 'configure') {
+                        setMaxConcurrent(message.max_concurrent_requests);
+                        return;
+                    }
                     console.log(`[API Bridge] ⬇️ 收到指令: ${message.command}`);
                     if (message.command === 'refresh' || message.command === 'reconnect') {
                         console.log(`[API Bridge] 收到 '${message.command}' 指令，正在执行页面刷新...`);
                         location.reload();
                     } else if (message.command === 'activate_id_capture') {
-                        console.log("[API Bridge] ✅ ID 捕获模式已激活。请在页面上触发一次 'Retry' 操作。");
-                        isCaptureModeActive = true;
+                        if (message.job_id) {
+                            captureJob = { jobId: message.job_id, remaining: message.count || 1, seen: new Set() };
+                            console.log(`[API Bridge] ✅ 批量 ID 捕获已激活，需要捕获 ${captureJob.remaining} 对 ID。请在不同的消息上触发 'Retry' 操作。`);
+                        } else {
+                            captureJob = null;
+                            console.log("[API Bridge] ✅ ID 捕获模式已激活。请在页面上触发一次 'Retry' 操作。");
+                        }
                         // 可以选择性地给用户一个视觉提示
-                        document.title = "🎯 " + document.title;
+                        if (!isCaptureModeActive) {
+                            document.title = "🎯 " + document.title;
+                        }
+                        isCaptureModeActive = true;
+                    } else if (message.command === 'deactivate_id_capture') {
+                        if (captureJob && message.job_id && message.job_id !== captureJob.jobId) {
+                            return; // 已被新的捕获任务取代
+                        }
+                        deactivateCaptureMode();
+                        console.log("[API Bridge] ID 捕获模式已关闭。");
                     } else if (message.command === 'send_page_source') {
                        console.log("[API Bridge] 收到发送页面源码的指令，正在发送...");
                        sendPageSource();
@@ -123,8 +187,9 @@
                     return;
                 }
                 
-                console.log(`[API Bridge] ⬇️ 收到聊天请求 ${request_id.substring(0, 8)}。准备执行 fetch 操作。`);
-                await executeFetchAndStreamBack(request_id, payload);
+                console.log(`[API Bridge] ⬇️ 收到聊天请求 ${request_id.substring(0, 8)}。`);
+                if (!resolvePayloadPrefix(request_id, payload)) return;
+                enqueueRequest(request_id, payload);
 
             } catch (error) {
                 console.error("[API Bridge] 处理服务器消息时出错:", error);
@@ -132,6 +197,11 @@
         };
 
         socket.onclose = () => {
+            // 旧连接被服务器排空后关闭时，新连接已经建立，无需重连
+            if (socket !== ws) {
+                console.log("[API Bridge] 旧的 WebSocket 连接已关闭。");
+                return;
+            }
             console.warn("[API Bridge] 🔌 与本地服务器的连接已断开。将在5秒后尝试重新连接...");
             if (document.title.startsWith("✅ ")) {
                 document.title = document.title.substring(2);
@@ -141,13 +211,111 @@
 
         socket.onerror = (error) => {
             console.error("[API Bridge] ❌ WebSocket 发生错误:", error);
-            socket.close(); // 会触发 onclose 中的重连逻辑
+            ws.close(); // 会触发 onclose 中的重连逻辑
         };
     }
 
-    async function executeFetchAndStreamBack(requestId, payload) {
+    // --- 会话前缀缓存 ---
+    // 服务器只发送与缓存中某个消息列表的公共前缀引用 (prefix) 和新增的消息，
+    // 这里拼回完整列表并以 cache_key 缓存，供后续请求引用。Map 按插入顺序保存，用作 LRU。
+    const prefixCache = new Map(); // cache_key -> message_templates
+
+    function resolvePayloadPrefix(requestId, payload) {
+        const { prefix, cache_key } = payload;
+        if (prefix) {
+            const cached = prefixCache.get(prefix.key);
+            if (!cached || cached.length < prefix.length) {
+                console.warn(`[API Bridge] 请求 ${requestId.substring(0, 8)} 引用的前缀缓存不存在，请求服务器重发完整消息。`);
+                socket.send(JSON.stringify({ type: 'prefix_miss', request_id: requestId, key: prefix.key }));
+                return false;
+            }
+            // 刷新被引用条目的位置，与服务器端的淘汰顺序保持一致
+            prefixCache.delete(prefix.key);
+            prefixCache.set(prefix.key, cached);
+            payload.message_templates = cached.slice(0, prefix.length).concat(payload.message_templates || []);
+            delete payload.prefix;
+        }
+        if (cache_key) {
+            prefixCache.delete(cache_key);
+            prefixCache.set(cache_key, payload.message_templates);
+            while (prefixCache.size > PREFIX_CACHE_SIZE) {
+                prefixCache.delete(prefixCache.keys().next().value);
+            }
+            delete payload.cache_key;
+        }
+        return true;
+    }
+
+    // --- 并发请求管理 ---
+    // 每个请求有独立的 AbortController；同时执行的请求数不超过 maxConcurrent，超出的在本地排队。
+    let maxConcurrent = 4; // 由服务器的 configure 指令覆盖（config.jsonc 中的 tab_max_concurrent_requests）
+    const activeRequests = new Map(); // requestId -> AbortController
+    const pendingQueue = []; // [{ requestId, payload }]
+
+    function enqueueRequest(requestId, payload) {
+        if (activeRequests.has(requestId) || pendingQueue.some(item => item.requestId === requestId)) {
+            console.warn(`[API Bridge] 请求 ${requestId.substring(0, 8)} 已在执行或排队中，忽略重复下发。`);
+            return;
+        }
+        pendingQueue.push({ requestId, payload });
+        if (activeRequests.size >= maxConcurrent) {
+            console.log(`[API Bridge] 已达到并发上限 (${maxConcurrent})，请求 ${requestId.substring(0, 8)} 进入本地队列（第 ${pendingQueue.length} 位）。`);
+        }
+        pumpQueue();
+        reportCapacity();
+    }
+
+    function pumpQueue() {
+        while (activeRequests.size < maxConcurrent && pendingQueue.length > 0) {
+            const { requestId, payload } = pendingQueue.shift();
+            const controller = new AbortController();
+            activeRequests.set(requestId, controller);
+            executeFetchAndStreamBack(requestId, payload, controller.signal).finally(() => {
+                activeRequests.delete(requestId);
+                pumpQueue();
+                reportCapacity();
+            });
+        }
+    }
+
+    function abortRequest(requestId) {
+        const index = pendingQueue.findIndex(item => item.requestId === requestId);
+        if (index !== -1) {
+            pendingQueue.splice(index, 1);
+            console.log(`[API Bridge] 请求 ${requestId.substring(0, 8)} 在排队期间被服务器取消。`);
+            reportCapacity();
+            return;
+        }
+        const controller = activeRequests.get(requestId);
+        if (controller) {
+            console.log(`[API Bridge] 服务器要求中止请求 ${requestId.substring(0, 8)}。`);
+            controller.abort();
+        }
+    }
+
+    function setMaxConcurrent(value) {
+        if (!Number.isInteger(value) || value < 1) return;
+        if (value !== maxConcurrent) {
+            console.log(`[API Bridge] 最大并发请求数设置为 ${value}。`);
+        }
+        maxConcurrent = value;
+        pumpQueue();
+        reportCapacity();
+    }
+
+    function capacityState() {
+        return { max_concurrent: maxConcurrent, active: activeRequests.size, queued: pendingQueue.length };
+    }
+
+    function reportCapacity() {
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({ type: 'capacity', ...capacityState() }));
+        }
+    }
+
+    async function executeFetchAndStreamBack(requestId, payload, signal) {
         console.log(`[API Bridge] 当前操作域名: ${window.location.hostname}`);
-        const { is_image_request, message_templates, target_model_id, session_id, message_id } = payload;
+        const { is_image_request, message_templates, target_model_id, session_id, message_id, stream_format } = payload;
 
         // --- 检查认证状态 ---
         if (!isAuthenticated) {
@@ -223,17 +391,17 @@
 
         console.log("[API Bridge] 准备发送到 LMArena API 的最终载荷:", JSON.stringify(body, null, 2));
 
-        // 设置一个标志，让我们的 fetch 拦截器知道这个请求是脚本自己发起的
-        window.isApiBridgeRequest = true;
         try {
-            const response = await fetch(apiUrl, {
+            // 直接调用原始 fetch，脚本自己的请求不会经过下面的拦截器，多个请求并发时也不会误触发 ID 捕获
+            const response = await originalFetch(apiUrl, {
                 method: httpMethod,
                 headers: {
                     'Content-Type': 'text/plain;charset=UTF-8', // LMArena 使用 text/plain
                     'Accept': '*/*',
                 },
                 body: JSON.stringify(body),
-                credentials: 'include' // 必须包含 cookie
+                credentials: 'include', // 必须包含 cookie
+                signal
             });
 
             if (!response.ok || !response.body) {
@@ -243,38 +411,196 @@
 
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
+            // 服务器协商了 events 格式时在浏览器中解析，只回传事件；否则原样转发
+            const parser = stream_format === 'events' ? createStreamParser() : null;
 
             while (true) {
                 const { value, done } = await reader.read();
                 if (done) {
+                    if (parser) {
+                        const events = parser.flush();
+                        if (events.length > 0) sendEventsToServer(requestId, events);
+                    }
                     console.log(`[API Bridge] ✅ 请求 ${requestId.substring(0, 8)} 的流已结束。`);
                     sendToServer(requestId, "[DONE]");
                     break;
                 }
-                const chunk = decoder.decode(value);
-                // 直接将原始数据块转发回后端
-                sendToServer(requestId, chunk);
+                // stream: true 保证被拆到两个数据块中的多字节字符能正确解码
+                const chunk = decoder.decode(value, { stream: true });
+                if (parser) {
+                    const events = parser.push(chunk);
+                    if (events.length > 0) sendEventsToServer(requestId, events);
+                } else {
+                    // 直接将原始数据块转发回后端
+                    sendToServer(requestId, chunk);
+                }
             }
 
         } catch (error) {
+            if (signal && signal.aborted) {
+                // 服务器已放弃该请求，无需再回传任何数据
+                console.log(`[API Bridge] 请求 ${requestId.substring(0, 8)} 已中止。`);
+                outgoingStreams.delete(requestId);
+                return;
+            }
             console.error(`[API Bridge] ❌ 在为请求 ${requestId.substring(0, 8)} 执行 fetch 时出错:`, error);
             sendToServer(requestId, { error: error.message });
             sendToServer(requestId, "[DONE]");
-        } finally {
-            // 请求结束后，无论成功与否，都重置标志
-            window.isApiBridgeRequest = false;
         }
     }
 
+    // --- 浏览器端解析 LMArena 数据流 ---
+    // 数据流按行组织，每行为 <a|b><类型>:<JSON>：0 为文本增量，2 为图片等附加数据，3 为错误，d 为结束信息。
+    // 无法识别的行（如 Cloudflare 页面、JSON 错误体）作为 raw 事件原样转发，由服务器按原有逻辑处理。
+    function createStreamParser() {
+        let pending = '';
+
+        function parseLine(line, events) {
+            if (!line) return;
+            const match = /^([ab])([0-9a-z]+):/.exec(line);
+            let value;
+            try {
+                value = match ? JSON.parse(line.slice(match[0].length)) : undefined;
+            } catch (e) {
+                value = undefined;
+            }
+            if (value === undefined) {
+                events.push({ type: 'raw', data: line + '\n' });
+                return;
+            }
+            const side = match[1];
+            switch (match[2]) {
+                case '0':
+                    if (typeof value === 'string' && value) events.push({ type: 'text', side, text: value });
+                    break;
+                case '2':
+                    // 与服务器的原始解析保持一致：每条记录只取第一项图片
+                    if (Array.isArray(value) && value[0] && value[0].type === 'image' && value[0].image) {
+                        events.push({ type: 'image', side, url: value[0].image });
+                    }
+                    break;
+                case '3':
+                    events.push({ type: 'error', side, message: typeof value === 'string' ? value : JSON.stringify(value) });
+                    break;
+                case 'd':
+                    if (value && typeof value === 'object' && 'finishReason' in value) {
+                        events.push({ type: 'finish', side, reason: value.finishReason, usage: value.usage || null });
+                    }
+                    break;
+            }
+        }
+
+        return {
+            push(chunk) {
+                pending += chunk;
+                const lines = pending.split('\n');
+                pending = lines.pop();
+                const events = [];
+                for (const line of lines) parseLine(line, events);
+                return events;
+            },
+            flush() {
+                const events = [];
+                parseLine(pending, events);
+                pending = '';
+                return events;
+            }
+        };
+    }
+
+    // --- 分块序号与断线重传 ---
+    // 每个请求回传的数据块都带有递增的序号。服务器确认 (ack) 之前，数据块保留在缓存中，
+    // WebSocket 断开重连后重新发送，服务器按序号去重。
+    const outgoingStreams = new Map(); // requestId -> { nextSeq, unacked: [{seq, body}], finishedAt, warned }
+    const FINISHED_STREAM_TTL_MS = 60000;
+
     function sendToServer(requestId, data) {
+        sendChunk(requestId, { data });
+    }
+
+    function sendEventsToServer(requestId, events) {
+        sendChunk(requestId, { events });
+    }
+
+    // body 为 { data } （原始数据、[DONE] 或错误）或 { events } （浏览器端解析出的事件）
+    function sendChunk(requestId, body) {
+        let stream = outgoingStreams.get(requestId);
+        if (!stream) {
+            stream = { nextSeq: 1, unacked: [], finishedAt: null, warned: false };
+            outgoingStreams.set(requestId, stream);
+        }
+        const seq = stream.nextSeq++;
+        stream.unacked.push({ seq, body });
+        if (body.data === "[DONE]") {
+            stream.finishedAt = Date.now();
+        }
+
         if (socket && socket.readyState === WebSocket.OPEN) {
-            const message = {
-                request_id: requestId,
-                data: data
-            };
-            socket.send(JSON.stringify(message));
-        } else {
-            console.error("[API Bridge] 无法发送数据，WebSocket 连接未打开。");
+            socket.send(JSON.stringify({ request_id: requestId, seq, ...body }));
+        } else if (!stream.warned) {
+            console.warn(`[API Bridge] WebSocket 连接未打开，请求 ${requestId.substring(0, 8)} 的数据将缓存并在重连后重发。`);
+            stream.warned = true;
+        }
+    }
+
+    function handleAck(requestId, seq) {
+        const stream = outgoingStreams.get(requestId);
+        if (!stream) return;
+        stream.unacked = stream.unacked.filter(chunk => chunk.seq > seq);
+        if (stream.finishedAt && stream.unacked.length === 0) {
+            outgoingStreams.delete(requestId);
+        }
+    }
+
+    function replayUnackedChunks() {
+        for (const [requestId, stream] of outgoingStreams) {
+            if (stream.unacked.length > 0) {
+                console.log(`[API Bridge] 🔁 重发请求 ${requestId.substring(0, 8)} 的 ${stream.unacked.length} 个未确认数据块。`);
+            }
+            for (const chunk of stream.unacked) {
+                socket.send(JSON.stringify({ request_id: requestId, seq: chunk.seq, ...chunk.body }));
+            }
+            stream.warned = false;
+        }
+    }
+
+    // 定期清理已结束但迟迟未被确认的请求，避免缓存无限增长
+    setInterval(() => {
+        const now = Date.now();
+        for (const [requestId, stream] of outgoingStreams) {
+            if (stream.finishedAt && now - stream.finishedAt > FINISHED_STREAM_TTL_MS) {
+                outgoingStreams.delete(requestId);
+            }
+        }
+    }, FINISHED_STREAM_TTL_MS / 2);
+
+    // --- ID 捕获 ---
+    function deactivateCaptureMode() {
+        isCaptureModeActive = false;
+        captureJob = null;
+        if (document.title.startsWith("🎯 ")) {
+            document.title = document.title.substring(2);
+        }
+    }
+
+    // 批量捕获：通过 WebSocket 把 ID 上报给服务器，由服务器直接加入会话池
+    function reportCapturedId(sessionId, messageId) {
+        const key = `${sessionId}/${messageId}`;
+        if (captureJob.seen.has(key)) {
+            console.log("[API Bridge Interceptor] 该 ID 已上报过，请在另一条消息上触发 'Retry'。");
+            return;
+        }
+        if (!socket || socket.readyState !== WebSocket.OPEN) {
+            console.warn("[API Bridge Interceptor] WebSocket 连接未打开，本次捕获的 ID 未能上报。");
+            return;
+        }
+        captureJob.seen.add(key);
+        captureJob.remaining--;
+        socket.send(JSON.stringify({ type: 'id_captured', job_id: captureJob.jobId, session_id: sessionId, message_id: messageId }));
+        console.log(`[API Bridge Interceptor] 🎯 捕获到ID并已上报，剩余 ${captureJob.remaining} 对。`);
+        if (captureJob.remaining <= 0) {
+            deactivateCaptureMode();
+            console.log("[API Bridge] ✅ 批量 ID 捕获已完成，捕获模式已自动关闭。");
         }
     }
 
@@ -297,17 +623,16 @@
         if (urlString) {
             const match = urlString.match(/\/api\/stream\/retry-evaluation-session-message\/([a-f0-9-]+)\/messages\/([a-f0-9-]+)/);
 
-            // 仅在请求不是由API桥自身发起，且捕获模式已激活时，才更新ID
-            if (match && !window.isApiBridgeRequest && isCaptureModeActive) {
+            // API 桥自身的请求直接使用 originalFetch，不会经过这里；仅在捕获模式已激活时更新ID
+            if (match && isCaptureModeActive && captureJob) {
+                reportCapturedId(match[1], match[2]);
+            } else if (match && isCaptureModeActive) {
                 const sessionId = match[1];
                 const messageId = match[2];
                 console.log(`[API Bridge Interceptor] 🎯 在激活模式下捕获到ID！正在发送...`);
 
                 // 关闭捕获模式，确保只发送一次
-                isCaptureModeActive = false;
-                if (document.title.startsWith("🎯 ")) {
-                    document.title = document.title.substring(2);
-                }
+                deactivateCaptureMode();
 
                 // 异步将捕获到的ID发送到本地的 id_updater.py 脚本
                 fetch('http://127.0.0.1:5103/update', {
@@ -350,10 +675,14 @@
 
     // --- 启动连接 ---
     console.log("========================================");
-    console.log("  LMArena API Bridge v2.6 正在运行。");
+    console.log("  LMArena API Bridge v2.11 正在运行。");
     console.log("  - 聊天功能已连接到 ws://localhost:5102");
-    console.log("  - ID 捕获器将发送到 http://localhost:5103");
+    console.log("  - ID 捕获器将发送到 http://localhost:5103（批量捕获通过 WebSocket 上报）");
     console.log("  - 增强的认证检查和会话初始化");
+    console.log("  - 心跳检测与多标签页支持");
+    console.log("  - 数据块序号与断线续传");
+    console.log("  - 可选的浏览器端数据流解析");
+    console.log("  - 标签页内并发请求管理与中止");
     console.log("========================================");
     
     connect(); // 建立 WebSocket 连接
@@ -2,6 +2,8 @@
 # 新一代 LMArena Bridge 后端服务
 
 import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
@@ -10,9 +12,11 @@ import subprocess
 import time
 import uuid
 import re
-import threading
-import random
 import mimetypes
+import tempfile
+import math
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
 from contextlib import asynccontextmanager
 
@@ -21,7 +25,20 @@ import requests
 from packaging.version import parse as parse_version
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
+
+from modules.attachment_processor import AttachmentProcessor, decoded_size
+from modules.batch_store import BatchInputError, BatchJob, BatchStore
+from modules.config_store import ConfigStore, write_file_atomic
+from modules.prefix_cache import PrefixCache, template_chain
+from modules.rate_limiter import RateLimiter, RateLimitExceeded
+from modules.remote_attachments import RemoteAttachmentFetcher, RemoteFetchError
+from modules.request_body import BlobSet, BlobStore, blob_digest, expand_blob_references, has_blob_references, parse_json_stream
+from modules.response_journal import ResponseJournal, ResponseJournalStore
+from modules.scheduler import FairScheduler, SchedulerSlot
+from modules.session_lanes import SessionLanes
+from modules.single_flight import Flight, SingleFlightGroup
+from modules.usage_tracker import RequestUsage, UsageTracker
 
 
 # --- 基础配置 ---
@@ -29,23 +46,154 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- 全局状态与配置 ---
-CONFIG = {} # 存储从 config.jsonc 加载的配置
-# browser_ws 用于存储与单个油猴脚本的 WebSocket 连接。
-# 注意：此架构假定只有一个浏览器标签页在工作。
-# 如果需要支持多个并发标签页，需要将此扩展为字典管理多个连接。
-browser_ws: WebSocket | None = None
+CONFIG = {} # 当前生效的配置快照（只读），由 config_store 在配置变化时替换
+config_store = ConfigStore('config.jsonc') # config.jsonc 的唯一读写入口
+RTT_HISTORY_SIZE = 20 # 每个标签页保留的心跳往返时间样本数
+RECENT_ERRORS_SIZE = 20 # 每个标签页保留的最近错误条数，供外部监控（如 docker_browser_runner.py）判断页面状态
+ACK_EVERY_CHUNKS = 16 # 每收到多少个带序号的数据块向标签页确认一次
+
+@dataclass
+class BrowserTab:
+    """一个已连接的油猴脚本标签页及其健康状态。"""
+    tab_id: str
+    websocket: WebSocket
+    capabilities: set[str] = field(default_factory=set)
+    connected_at: float = field(default_factory=time.monotonic)
+    last_pong_at: float = field(default_factory=time.monotonic)
+    # 最近若干次心跳的往返时间（秒）
+    rtt_history: deque = field(default_factory=lambda: deque(maxlen=RTT_HISTORY_SIZE))
+    missed_heartbeats: int = 0
+    healthy: bool = True
+    # 排空中的标签页不再接收新请求，但会继续完成已分配的请求
+    draining: bool = False
+    # 排空完成后是否关闭连接。由外部（docker_browser_runner.py 缩容）要求排空时保持连接，
+    # 由外部关闭页面，避免用户脚本重连后又接到新请求
+    close_when_drained: bool = True
+    # 当前由该标签页处理的 request_id
+    pending_requests: set[str] = field(default_factory=set)
+    # 最近的请求错误，每项为 {"ts": 时间戳, "error": 错误信息}
+    recent_errors: deque = field(default_factory=lambda: deque(maxlen=RECENT_ERRORS_SIZE))
+    # 负载统计：累计忙碌时长（至少有一个请求在处理的时间）、当前忙碌/空闲的起点
+    busy_seconds: float = 0.0
+    busy_since: float | None = None
+    idle_since: float = field(default_factory=time.monotonic)
+    # 标签页上报的并发能力（声明了 concurrency 能力的脚本）：最大并发数、正在执行与本地排队的请求数
+    max_concurrent: int | None = None
+    browser_active: int = 0
+    browser_queued: int = 0
+    # 对标签页中会话前缀缓存的镜像（声明了 prefix_cache 能力的脚本）
+    prefix_cache: PrefixCache | None = None
+    # 含大附件的请求消息逐个展开发送，同一时间最多只有一个展开后的大消息帧在内存中
+    large_frame_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def average_rtt(self) -> float | None:
+        return sum(self.rtt_history) / len(self.rtt_history) if self.rtt_history else None
+
+    @property
+    def saturated(self) -> bool:
+        """已分配的请求数达到标签页上报的并发上限，新请求会在标签页本地排队。"""
+        return self.max_concurrent is not None and len(self.pending_requests) >= self.max_concurrent
+
+    def add_request(self, request_id: str):
+        if not self.pending_requests:
+            self.busy_since = time.monotonic()
+        self.pending_requests.add(request_id)
+
+    def remove_request(self, request_id: str):
+        if request_id not in self.pending_requests:
+            return
+        self.pending_requests.discard(request_id)
+        if not self.pending_requests and self.busy_since is not None:
+            now = time.monotonic()
+            self.busy_seconds += now - self.busy_since
+            self.busy_since = None
+            self.idle_since = now
+
+    def load_snapshot(self) -> dict:
+        """
+        负载指标。busy_seconds 为累计值（含当前这段忙碌时间），
+        调用方用两次采样的差值除以间隔即可得到该时段的利用率；idle_seconds 在忙碌时为 0。
+        """
+        now = time.monotonic()
+        busy = self.busy_seconds + (now - self.busy_since if self.busy_since is not None else 0)
+        return {
+            "tab_id": self.tab_id,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "pending_requests": len(self.pending_requests),
+            "max_concurrent": self.max_concurrent,
+            "utilization": round(len(self.pending_requests) / self.max_concurrent, 3) if self.max_concurrent else None,
+            "busy_seconds": round(busy, 2),
+            "idle_seconds": 0.0 if self.pending_requests else round(now - self.idle_since, 1),
+        }
+
+    async def send_json(self, data: dict):
+        await self.websocket.send_text(json.dumps(data, ensure_ascii=False))
+
+@dataclass
+class InflightRequest:
+    """一个已下发给浏览器、尚未结束的请求。保留原始消息以便故障转移。"""
+    request_id: str
+    message: dict
+    tab: BrowserTab
+    received_data: bool = False
+    attempts: int = 1
+    # 已接收的最大数据块序号，用于丢弃重连后重传的重复数据块
+    last_seq: int = 0
+    # 标签页已回传 [DONE]，即浏览器中的 fetch 已结束
+    finished: bool = False
+
+# browser_tabs 存储所有已连接的油猴脚本标签页，键是 tab_id。
+browser_tabs: dict[str, BrowserTab] = {}
+# inflight_requests 记录每个请求由哪个标签页处理，键是 request_id。
+inflight_requests: dict[str, InflightRequest] = {}
 # response_channels 用于存储每个 API 请求的响应队列。
 # 键是 request_id，值是 asyncio.Queue。
 response_channels: dict[str, asyncio.Queue] = {}
 last_activity_time = None # 记录最后一次活动的时间
-idle_monitor_thread = None # 空闲监控线程
-main_event_loop = None # 主事件循环
+idle_monitor_task: asyncio.Task | None = None # 空闲监控任务
+# 排空模式：服务器即将关闭或重启，新请求返回 503，进行中的请求继续完成
+server_draining = False
+# 软重置期间清除此事件，新请求会在此等待，而不是被丢弃
+restart_gate = asyncio.Event()
+restart_gate.set()
+# 油猴脚本连接时设置，断开时清除
+browser_connected_event = asyncio.Event()
+# 按优先级类别与 API Key 权重排队的请求调度器，并发上限在加载配置时更新
+request_scheduler = FairScheduler(capacity=8)
+# request_slots 记录每个请求占用的调度名额，键是 request_id。
+request_slots: dict[str, SchedulerSlot] = {}
+# 每个 session_id/message_id 同时处理的请求数有限，避免并发重试争抢同一条上游消息
+session_lanes = SessionLanes()
+# request_lanes 记录每个请求占用的会话映射，键是 request_id。
+request_lanes: dict[str, dict] = {}
+# 按 API Key 的限流与用量统计
+rate_limiter = RateLimiter()
+usage_tracker = UsageTracker("logs/usage.jsonl")
+usage_flush_task: asyncio.Task | None = None
+config_watch_task: asyncio.Task | None = None
+# request_usage 记录每个请求的调用方与用量，键是 request_id。
+request_usage: dict[str, RequestUsage] = {}
+# 进行中的可合并请求（single_flight_enabled 开启时）
+single_flights = SingleFlightGroup()
+# 流式响应日志，按响应 ID（chatcmpl-...）索引，供断线续传
+response_journals = ResponseJournalStore(os.path.join(tempfile.gettempdir(), "lmarena_bridge_journal"))
+# 请求体中过大的 data: URL 保存在临时文件中，请求只持有引用，下发时再写回消息帧
+blob_store = BlobStore()
+# request_blobs 记录每个请求持有的附件引用，键是 request_id。
+request_blobs: dict[str, BlobSet] = {}
+# 过大图片的压缩进程池与结果缓存
+attachment_processor = AttachmentProcessor()
+# 下载 image_url 中远程图片的共享连接池与磁盘缓存
+remote_fetcher = RemoteAttachmentFetcher("cache/remote_attachments")
 
 # --- 模型映射 ---
 # MODEL_NAME_TO_ID_MAP 现在将存储更丰富的对象： { "model_name": {"id": "...", "type": "..."} }
 MODEL_NAME_TO_ID_MAP = {}
 MODEL_ENDPOINT_MAP = {} # 新增：用于存储模型到 session/message ID 的映射
 DEFAULT_MODEL_ID = None # 默认模型id: None
+endpoint_map_write_lock = asyncio.Lock() # 串行化 model_endpoint_map.json 的写入
 
 def load_model_endpoint_map():
     """从 model_endpoint_map.json 加载模型到端点的映射。"""
@@ -66,23 +214,94 @@ def load_model_endpoint_map():
         logger.error(f"加载或解析 'model_endpoint_map.json' 失败: {e}。将使用空映射。")
         MODEL_ENDPOINT_MAP = {}
 
+async def save_model_endpoint_map():
+    """把内存中的模型端点映射原子地写回 model_endpoint_map.json。"""
+    # 在事件循环中序列化快照，文件写入放到线程池中
+    content = json.dumps(MODEL_ENDPOINT_MAP, indent=2, ensure_ascii=False)
+    async with endpoint_map_write_lock:
+        await asyncio.to_thread(write_file_atomic, 'model_endpoint_map.json', content)
+
+def add_model_endpoint(model: str, mapping: dict) -> bool:
+    """向模型的会话池中追加一个映射，已存在相同 session_id/message_id 时返回 False。"""
+    entry = MODEL_ENDPOINT_MAP.get(model)
+    if isinstance(entry, dict):
+        entry = [entry] # 旧的单映射格式转换为列表
+    elif not isinstance(entry, list):
+        entry = []
+    if any(m.get("session_id") == mapping["session_id"] and m.get("message_id") == mapping["message_id"] for m in entry if isinstance(m, dict)):
+        return False
+    entry.append(mapping)
+    MODEL_ENDPOINT_MAP[model] = entry
+    return True
+
+def check_session_lane_capacity():
+    """
+    会话通道能同时处理的请求数（会话数 × session_lane_concurrency）低于 max_concurrent_requests 时给出警告：
+    超出的请求只能排队等待会话，调大 max_concurrent_requests 或增加标签页都不会提高该模型的并发。
+    """
+    lane_concurrency = max(1, int(CONFIG.get("session_lane_concurrency", 1)))
+    capacity = max(1, int(CONFIG.get("max_concurrent_requests", 8)))
+    if lane_concurrency >= capacity:
+        return
+    def count_sessions(mappings: list) -> int:
+        return len({
+            (m["session_id"], m["message_id"]) for m in mappings
+            if isinstance(m, dict) and m.get("session_id") and m.get("message_id")
+            and "YOUR_" not in m["session_id"] and "YOUR_" not in m["message_id"]
+        })
+    pools = {}
+    for model, entry in MODEL_ENDPOINT_MAP.items():
+        sessions = count_sessions(entry if isinstance(entry, list) else [entry])
+        if sessions:
+            pools[model] = sessions
+    if CONFIG.get("use_default_ids_if_mapping_not_found", True):
+        sessions = count_sessions([{"session_id": CONFIG.get("session_id"), "message_id": CONFIG.get("message_id")}])
+        if sessions:
+            pools["(全局默认会话)"] = sessions
+    limited = {model: sessions for model, sessions in pools.items() if sessions * lane_concurrency < capacity}
+    if limited:
+        summary = "、".join(f"{model}: {sessions * lane_concurrency}" for model, sessions in limited.items())
+        logger.warning(
+            f"以下模型可同时处理的请求数低于 max_concurrent_requests ({capacity})，超出的请求将排队等待会话：{summary}。"
+            f"如需并行处理，请用 id_updater.py 为这些模型捕获更多会话（session_id/message_id）。"
+        )
+
 def load_config():
-    """从 config.jsonc 加载配置，并处理 JSONC 注释。"""
-    global CONFIG
+    """从 config.jsonc 加载配置。解析失败时保留当前配置（首次加载失败则为空配置）。"""
     try:
-        with open('config.jsonc', 'r', encoding='utf-8') as f:
-            content = f.read()
-            # 移除 // 行注释和 /* */ 块注释
-            json_content = re.sub(r'//.*', '', content)
-            json_content = re.sub(r'/\*.*?\*/', '', json_content, flags=re.DOTALL)
-            CONFIG = json.loads(json_content)
-        logger.info("成功从 'config.jsonc' 加载配置。")
-        # 打印关键配置状态
-        logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if CONFIG.get('tavern_mode_enabled') else '❌ 禁用'}")
-        logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if CONFIG.get('bypass_enabled') else '❌ 禁用'}")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将使用默认配置。")
-        CONFIG = {}
+        config_store.load()
+    except (OSError, ValueError) as e:
+        logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将使用{'默认' if not CONFIG else '当前'}配置。")
+
+def apply_config(snapshot: dict, version: int):
+    """config_store 发布新快照时调用：替换全局 CONFIG，并更新依赖配置的组件。"""
+    global CONFIG
+    CONFIG = snapshot
+    logger.info(f"成功从 'config.jsonc' 加载配置（版本 {version}）。")
+    # 打印关键配置状态
+    logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if CONFIG.get('tavern_mode_enabled') else '❌ 禁用'}")
+    logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if CONFIG.get('bypass_enabled') else '❌ 禁用'}")
+    request_scheduler.set_capacity(max(1, int(CONFIG.get("max_concurrent_requests", 8))))
+    usage_tracker.path = CONFIG.get("usage_log_file", "logs/usage.jsonl")
+    session_lanes.set_concurrency(max(1, int(CONFIG.get("session_lane_concurrency", 1))))
+    attachment_processor.configure(
+        workers=int(CONFIG.get("attachment_processing_workers", 2)),
+        cache_limit=int(CONFIG.get("attachment_cache_mb", 64) * 1024 * 1024)
+    )
+    remote_fetcher.configure(
+        max_connections=int(CONFIG.get("remote_attachment_max_connections", 16)),
+        cache_limit=int(CONFIG.get("remote_attachment_cache_mb", 256) * 1024 * 1024),
+        cache_ttl=CONFIG.get("remote_attachment_cache_ttl_seconds", 3600)
+    )
+    push_tab_settings()
+
+config_store.subscribe(apply_config)
+
+async def watch_config_file():
+    """定期检查 config.jsonc 是否被外部修改（手动编辑、id_updater.py 等），变化时重新加载。"""
+    while True:
+        await asyncio.sleep(CONFIG.get("config_watch_interval_seconds", 2))
+        config_store.reload_if_changed()
 
 def load_model_map():
     """从 models.json 加载模型映射，支持 'id:type' 格式。"""
@@ -260,69 +479,141 @@ def save_available_models(new_models_list, models_path="available_models.json"):
         logger.error(f"❌ 写入 '{models_path}' 文件时出错: {e}")
 
 # --- 自动重启逻辑 ---
-def restart_server():
-    """优雅地通知客户端刷新，然后重启服务器。"""
+async def notify_browser_refresh():
+    """通知所有浏览器标签页刷新页面，以便其重新连接。"""
+    for tab in list(browser_tabs.values()):
+        try:
+            # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
+            await tab.send_json({"command": "reconnect"})
+            logger.info(f"已向标签页 {tab.tab_id[:8]} 发送 'reconnect' 指令。")
+        except Exception as e:
+            logger.error(f"向标签页 {tab.tab_id[:8]} 发送 'reconnect' 指令失败: {e}")
+
+async def drain_inflight_requests(timeout: float) -> bool:
+    """等待当前所有进行中的请求结束。超时返回 False。"""
+    pending = set(response_channels.keys())
+    if not pending:
+        return True
+    logger.info(f"正在等待 {len(pending)} 个进行中的请求完成（最多 {timeout:.0f} 秒）...")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not pending & response_channels.keys():
+            return True
+        await asyncio.sleep(0.5)
+    return not pending & response_channels.keys()
+
+async def wait_for_browser_connection(timeout: float) -> bool:
+    """等待油猴脚本（重新）连接。超时返回 False。"""
+    try:
+        await asyncio.wait_for(browser_connected_event.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def restart_server():
+    """进入排空模式并等待进行中的请求完成，然后通知客户端刷新并重启整个服务器进程。"""
+    global server_draining
     logger.warning("="*60)
     logger.warning("检测到服务器空闲超时，准备自动重启...")
     logger.warning("="*60)
-    
-    # 1. (异步) 通知浏览器刷新
-    async def notify_browser_refresh():
-        if browser_ws:
-            try:
-                # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("已向浏览器发送 'reconnect' 指令。")
-            except Exception as e:
-                logger.error(f"发送 'reconnect' 指令失败: {e}")
-    
-    # 在主事件循环中运行异步通知函数
-    # 使用`asyncio.run_coroutine_threadsafe`确保线程安全
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
-        asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
-    
-    # 2. 延迟几秒以确保消息发送
-    time.sleep(3)
-    
-    # 3. 执行重启
+
+    # 1. 排空：拒绝新请求，等待进行中的请求完成
+    server_draining = True
+    if not await drain_inflight_requests(CONFIG.get("shutdown_drain_timeout_seconds", 30)):
+        logger.warning("等待进行中的请求超时，剩余请求将随重启中断。")
+
+    # 2. 通知浏览器刷新
+    await notify_browser_refresh()
+
+    # 3. 延迟几秒以确保消息发送
+    await asyncio.sleep(3)
+
+    # 4. 执行重启
     logger.info("正在重启服务器...")
     os.execv(sys.executable, ['python'] + sys.argv)
 
-def idle_monitor():
-    """在后台线程中运行，监控服务器是否空闲。"""
+async def soft_restart_server():
+    """
+    进程内软重置：不重启 Python 进程。
+    等待进行中的请求完成后刷新浏览器页面，重新加载配置与模型映射，并清理残留的响应通道。
+    重置期间到达的新请求会在 restart_gate 处排队，而不是被丢弃。
+    """
     global last_activity_time
-    
-    # 等待，直到 last_activity_time 被首次设置
-    while last_activity_time is None:
-        time.sleep(1)
-        
-    logger.info("空闲监控线程已启动。")
-    
-    while True:
-        if CONFIG.get("enable_idle_restart", False):
-            timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
-            
-            # 如果超时设置为-1，则禁用重启检查
-            if timeout == -1:
-                time.sleep(10) # 仍然需要休眠以避免繁忙循环
-                continue
+    logger.warning("="*60)
+    logger.warning("检测到服务器空闲超时，准备进行软重置（不重启进程）...")
+    logger.warning("="*60)
 
-            idle_time = (datetime.now() - last_activity_time).total_seconds()
-            
-            if idle_time > timeout:
-                logger.info(f"服务器空闲时间 ({idle_time:.0f}s) 已超过阈值 ({timeout}s)。")
-                restart_server()
-                break # 退出循环，因为进程即将被替换
-                
+    restart_gate.clear()
+    try:
+        # 1. 等待进行中的请求完成
+        drain_timeout = CONFIG.get("soft_restart_drain_timeout_seconds", 60)
+        if not await drain_inflight_requests(drain_timeout):
+            logger.warning("等待进行中的请求超时，剩余请求将被终止。")
+
+        # 2. 清理残留的响应通道
+        for request_id, queue in list(response_channels.items()):
+            await queue.put({"error": "Server is restarting"})
+            logger.info(f"软重置：已终止残留请求 {request_id[:8]}。")
+        response_channels.clear()
+
+        # 3. 通知浏览器刷新
+        had_browser = bool(browser_tabs)
+        if had_browser:
+            browser_connected_event.clear()
+            await notify_browser_refresh()
+
+        # 4. 重新加载配置与模型映射
+        load_config()
+        load_model_map()
+        load_model_endpoint_map()
+        check_session_lane_capacity()
+
+        # 5. 等待浏览器重新连接
+        if had_browser:
+            reconnect_timeout = CONFIG.get("soft_restart_reconnect_timeout_seconds", 30)
+            if await wait_for_browser_connection(reconnect_timeout):
+                logger.info("软重置完成，油猴脚本已重新连接。")
+            else:
+                logger.warning(f"软重置完成，但油猴脚本在 {reconnect_timeout} 秒内未重新连接。")
+        else:
+            logger.info("软重置完成。")
+    finally:
+        last_activity_time = datetime.now()
+        restart_gate.set()
+
+async def idle_monitor():
+    """作为 asyncio 任务运行，监控服务器是否空闲。"""
+    logger.info("空闲监控任务已启动。")
+
+    while True:
         # 每 10 秒检查一次
-        time.sleep(10)
+        await asyncio.sleep(10)
+
+        if not CONFIG.get("enable_idle_restart", False):
+            continue
+
+        timeout = CONFIG.get("idle_restart_timeout_seconds", 300)
+        # 如果超时设置为-1，则禁用重启检查
+        if timeout == -1:
+            continue
+
+        # 仍有请求或批量任务在处理中，不算空闲
+        if response_channels or batch_tasks:
+            continue
+
+        idle_time = (datetime.now() - last_activity_time).total_seconds()
+        if idle_time > timeout:
+            logger.info(f"服务器空闲时间 ({idle_time:.0f}s) 已超过阈值 ({timeout}s)。")
+            if CONFIG.get("idle_restart_mode", "soft") == "hard":
+                await restart_server()
+                break # 进程即将被替换
+            await soft_restart_server()
 
 # --- FastAPI 生命周期事件 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """在服务器启动时运行的生命周期函数。"""
-    global idle_monitor_thread, last_activity_time, main_event_loop
-    main_event_loop = asyncio.get_running_loop() # 获取主事件循环
+    global idle_monitor_task, usage_flush_task, config_watch_task, last_activity_time
     load_config() # 首先加载配置
     
     # --- 打印当前的操作模式 ---
@@ -338,18 +629,33 @@ async def lifespan(app: FastAPI):
     check_for_updates() # 检查程序更新
     load_model_map() # 重新启用模型加载
     load_model_endpoint_map() # 加载模型端点映射
+    check_session_lane_capacity()
     logger.info("服务器启动完成。等待油猴脚本连接...")
 
     # 在模型更新后，标记活动时间的起点
     last_activity_time = datetime.now()
     
-    # 启动空闲监控线程
-    if CONFIG.get("enable_idle_restart", False):
-        idle_monitor_thread = threading.Thread(target=idle_monitor, daemon=True)
-        idle_monitor_thread.start()
-        
+    # 启动空闲监控任务（配置可在软重置后变化，因此总是启动，由任务内部判断开关）
+    idle_monitor_task = asyncio.create_task(idle_monitor())
+    # 定期把内存中的用量统计批量写入文件
+    usage_flush_task = asyncio.create_task(usage_tracker.run(CONFIG.get("usage_flush_interval_seconds", 30)))
+    # 配置文件被外部修改时自动重新加载，请求处理过程中不再读取文件
+    config_watch_task = asyncio.create_task(watch_config_file())
+    # 继续执行服务器重启前未完成的批量任务
+    await resume_batches()
 
     yield
+    await stop_batches()
+    idle_monitor_task.cancel()
+    config_watch_task.cancel()
+    usage_flush_task.cancel()
+    try:
+        await usage_flush_task
+    except asyncio.CancelledError:
+        pass
+    blob_store.clear()
+    attachment_processor.shutdown()
+    await remote_fetcher.close()
     logger.info("服务器正在关闭。")
 
 app = FastAPI(lifespan=lifespan)
@@ -365,32 +671,12 @@ app.add_middleware(
 )
 
 # --- 辅助函数 ---
-def save_config():
-    """将当前的 CONFIG 对象写回 config.jsonc 文件，保留注释。"""
+def save_config(changes: dict):
+    """把配置修改写回 config.jsonc（保留注释、原子替换），并立即作为新版本配置生效。"""
     try:
-        # 读取原始文件以保留注释等
-        with open('config.jsonc', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        # 使用正则表达式安全地替换值
-        def replacer(key, value, content):
-            # 这个正则表达式会找到 key，然后匹配它的 value 部分，直到逗号或右花括号
-            pattern = re.compile(rf'("{key}"\s*:\s*").*?("?)(,?\s*)$', re.MULTILINE)
-            replacement = rf'\g<1>{value}\g<2>\g<3>'
-            if not pattern.search(content): # 如果 key 不存在，就添加到文件末尾（简化处理）
-                 content = re.sub(r'}\s*$', f'  ,"{key}": "{value}"\n}}', content)
-            else:
-                 content = pattern.sub(replacement, content)
-            return content
-
-        content_str = "".join(lines)
-        content_str = replacer("session_id", CONFIG["session_id"], content_str)
-        content_str = replacer("message_id", CONFIG["message_id"], content_str)
-        
-        with open('config.jsonc', 'w', encoding='utf-8') as f:
-            f.write(content_str)
-        logger.info("✅ 成功将会话信息更新到 config.jsonc。")
-    except Exception as e:
+        config_store.update(changes)
+        logger.info(f"✅ 成功将 {', '.join(changes)} 更新到 config.jsonc（版本 {config_store.version}）。")
+    except (OSError, ValueError) as e:
         logger.error(f"❌ 写入 config.jsonc 时发生错误: {e}", exc_info=True)
 
 
@@ -452,6 +738,9 @@ def _process_openai_message(message: dict) -> dict:
                         })
                     except (IndexError, ValueError) as e:
                         logger.warning(f"无法解析的 base64 data URI: {url[:60]}... 错误: {e}")
+                elif url:
+                    # http(s) 地址在 fetch_remote_attachments 中已被下载并替换为 data: URI，这里只会遇到被禁用或无法识别的地址
+                    logger.warning(f"忽略不支持的图片 URL（需要 data: URI，或开启 remote_attachments_enabled）: {url[:60]}")
 
         text_content = "\n\n".join(text_parts)
     elif isinstance(content, str):
@@ -467,10 +756,100 @@ def _process_openai_message(message: dict) -> dict:
         "attachments": attachments
     }
 
-def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None) -> dict:
+def iter_image_url_parts(openai_req: dict):
+    """遍历请求消息中的 image_url 内容，产生其中的 {"url": ...} 对象。"""
+    for message in openai_req.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            image_url_data = part.get("image_url") if isinstance(part, dict) and part.get("type") == "image_url" else None
+            if isinstance(image_url_data, dict) and isinstance(image_url_data.get("url"), str):
+                yield image_url_data
+
+def attachment_data_url(content_type: str, data: bytes, blobs: BlobSet | None) -> str:
+    """把附件内容编码为 data: URL。blobs 不为空且内容较大时写入临时文件，请求中只保留引用。"""
+    encoded = base64.b64encode(data).decode("ascii")
+    threshold = CONFIG.get("request_body_spill_threshold_kb", 256) * 1024
+    if blobs is not None and threshold > 0 and len(encoded) >= threshold:
+        encoded = blobs.add_text(encoded)
+    return f"data:{content_type};base64,{encoded}"
+
+async def fetch_remote_attachments(openai_req: dict, blobs: BlobSet | None = None):
+    """
+    并发下载 image_url 中的 http(s) 图片并原地替换为 data: URI，之后与客户端内联的图片走相同的处理流程。
+    下载共用一个连接池，结果按内容缓存在磁盘上；下载失败、超时或不是图片时返回对应的错误状态码。
+    """
+    if not CONFIG.get("remote_attachments_enabled", True):
+        return
+    remote_parts = [d for d in iter_image_url_parts(openai_req) if d["url"].startswith(("http://", "https://"))]
+    if not remote_parts:
+        return
+    max_bytes = int(CONFIG.get("remote_attachment_max_size_mb", 20) * 1024 * 1024)
+    timeout = CONFIG.get("remote_attachment_timeout_seconds", 30)
+    allow_private = CONFIG.get("remote_attachment_allow_private_networks", False)
+    results = await asyncio.gather(
+        *(remote_fetcher.fetch(d["url"], max_bytes, timeout, allow_private) for d in remote_parts),
+        return_exceptions=True
+    )
+    for image_url_data, result in zip(remote_parts, results):
+        if isinstance(result, RemoteFetchError):
+            raise HTTPException(status_code=result.status_code, detail=str(result))
+        if isinstance(result, asyncio.CancelledError):
+            # 共享的下载任务被中止（服务器正在关闭），不是本请求被取消，不能把取消传播给本请求
+            raise HTTPException(status_code=503, detail=f"下载图片被中断，请稍后重试: {image_url_data['url']}")
+        if isinstance(result, BaseException):
+            raise result
+        data, content_type = result
+        logger.info(f"已下载远程图片: {image_url_data['url'][:60]} ({content_type}, {len(data) / 1024:.0f}KB)")
+        image_url_data["url"] = attachment_data_url(content_type, data, blobs)
+
+async def preprocess_attachments(openai_req: dict, blobs: BlobSet | None = None):
+    """
+    在排队与下发之前检查 data: 附件的大小。LMArena 拒绝超过约 5MB 的附件，但要等整个载荷上传到浏览器后才返回 413。
+    超过 attachment_max_size_mb 的图片在进程池中缩小并重新压缩，原地替换请求中的 URL；无法压缩到限制以内的附件直接返回 413。
+    """
+    limit = int(CONFIG.get("attachment_max_size_mb", 5) * 1024 * 1024)
+    if limit <= 0:
+        return
+    for image_url_data in iter_image_url_parts(openai_req):
+        url = image_url_data["url"]
+        if not url.startswith("data:"):
+            continue
+        header, _, data = url.partition(",")
+        digest = blob_digest(data)
+        size = decoded_size(header, blob_store.size(digest) if digest else len(data))
+        if size > limit:
+            image_url_data["url"] = await shrink_attachment(header, data, digest, size, limit, blobs)
+
+async def shrink_attachment(header: str, data: str, digest: str | None, size: int, limit: int, blobs: BlobSet | None) -> str:
+    """把过大的图片压缩到 limit 字节以内，返回新的 data: URL。"""
+    content_type = header[len("data:"):].split(";")[0]
+    size_text, limit_text = f"{size / 1024 / 1024:.1f}MB", f"{limit / 1024 / 1024:g}MB"
+    if not content_type.startswith("image/") or ";base64" not in header:
+        raise HTTPException(status_code=413, detail=f"附件大小 ({size_text}) 超过了 LMArena 的限制 ({limit_text})，且不是可以自动压缩的图片。请上传更小的文件。")
+    if not attachment_processor.available:
+        raise HTTPException(status_code=413, detail=f"图片大小 ({size_text}) 超过了 LMArena 的限制 ({limit_text})。服务器未安装 Pillow，无法自动压缩，请压缩后重试。")
+
+    encoded = await asyncio.to_thread(blob_store.read_text, digest) if digest else data
+    result = await attachment_processor.shrink(encoded, limit, int(CONFIG.get("attachment_image_max_dimension", 2048)))
+    if result is None:
+        raise HTTPException(status_code=413, detail=f"图片大小 ({size_text}) 超过了 LMArena 的限制 ({limit_text})，且无法自动压缩到限制以内。请上传更小的图片。")
+    image_bytes, new_type = result
+    logger.info(f"附件已压缩: {content_type} {size_text} -> {new_type} {len(image_bytes) / 1024 / 1024:.1f}MB")
+
+    if blobs is not None and digest:
+        blobs.discard(digest)
+    return attachment_data_url(new_type, image_bytes, blobs)
+
+def session_mode(mapping: dict) -> str:
+    """会话映射实际使用的模式：映射中记录的模式，没有时回退到全局配置。"""
+    return mapping.get("mode") or CONFIG.get("id_updater_last_mode", "direct_chat")
+
+def convert_openai_to_lmarena_payload(openai_data: dict) -> dict:
     """
-    将 OpenAI 请求体转换为油猴脚本所需的简化载荷，并应用酒馆模式、绕过模式以及对战模式。
-    新增了模式覆盖参数，以支持模型特定的会话模式。
+    将 OpenAI 请求体转换为油猴脚本所需的简化载荷，并应用酒馆模式与绕过模式。
+    结果与会话无关，每个请求只转换一次：合并键由它计算，选定会话后再由 bind_payload_to_session 填入会话信息。
     """
     # 1. 规范化角色并处理消息
     #    - 将非标准的 'developer' 角色转换为 'system' 以提高兼容性。
@@ -527,14 +906,25 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
         logger.info("绕过模式已启用，正在注入一个空的用户消息。")
         message_templates.append({"role": "user", "content": " ", "participantPosition": "a", "attachments": []})
 
-    # 6. 应用参与者位置 (Participant Position)
+    return {
+        "message_templates": message_templates,
+        "target_model_id": target_model_id,
+    }
+
+def bind_payload_to_session(payload: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None) -> dict:
+    """
+    按选中会话的模式（对战/直接对话）设置每条消息的参与者位置，并填入会话 ID，返回新的载荷。
+    传入的载荷不会被修改，故障转移或接替上游请求时可以再次使用。
+    """
+    # 应用参与者位置 (Participant Position)
     # 优先使用覆盖的模式，否则回退到全局配置
-    mode = mode_override or CONFIG.get("id_updater_last_mode", "direct_chat")
+    mode = session_mode({"mode": mode_override})
     target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
     target_participant = target_participant.lower() # 确保是小写
 
     logger.info(f"正在根据模式 '{mode}' (目标: {target_participant if mode == 'battle' else 'N/A'}) 设置 Participant Positions...")
 
+    message_templates = [dict(msg) for msg in payload["message_templates"]]
     for msg in message_templates:
         if msg['role'] == 'system':
             if mode == 'battle':
@@ -551,28 +941,29 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
             msg['participantPosition'] = 'a'
 
     return {
+        **payload,
         "message_templates": message_templates,
-        "target_model_id": target_model_id,
         "session_id": session_id,
         "message_id": message_id
     }
 
 # --- OpenAI 格式化辅助函数 (确保JSON序列化稳健) ---
-def format_openai_chunk(content: str, model: str, request_id: str) -> str:
+def format_openai_chunk(content: str, model: str, request_id: str, index: int = 0) -> str:
     """格式化为 OpenAI 流式块。"""
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
         "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+        "choices": [{"index": index, "delta": {"content": content}, "finish_reason": None}]
     }
     return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
 
-def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
-    """格式化为 OpenAI 结束块。"""
+def format_openai_finish_chunk(model: str, request_id: str, reason: str | list[str] = 'stop') -> str:
+    """格式化为 OpenAI 结束块。reason 为列表时（n > 1）每个 choice 各有一个结束原因。"""
+    reasons = reason if isinstance(reason, list) else [reason]
     chunk = {
         "id": request_id, "object": "chat.completion.chunk",
         "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
+        "choices": [{"index": i, "delta": {}, "finish_reason": r} for i, r in enumerate(reasons)]
     }
     return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
 
@@ -581,29 +972,71 @@ def format_openai_error_chunk(error_message: str, model: str, request_id: str) -
     content = f"\n\n[LMArena Bridge Error]: {error_message}"
     return format_openai_chunk(content, model, request_id)
 
-def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
-    """构建符合 OpenAI 规范的非流式响应体。"""
+def format_openai_non_stream_response(content: str | list[str], model: str, request_id: str, reason: str | list[str] = 'stop', usage: dict | None = None) -> dict:
+    """构建符合 OpenAI 规范的非流式响应体。content/reason 为列表时（n > 1）每项对应一个 choice。usage 缺省时按内容长度估算。"""
+    contents = content if isinstance(content, list) else [content]
+    reasons = reason if isinstance(reason, list) else [reason] * len(contents)
+    completion_tokens = sum(len(c) for c in contents) // 4
     return {
         "id": request_id,
         "object": "chat.completion",
         "created": int(time.time()),
         "model": model,
         "choices": [{
-            "index": 0,
-            "message": {"role": "assistant", "content": content},
-            "finish_reason": reason,
-        }],
-        "usage": {
+            "index": i,
+            "message": {"role": "assistant", "content": c},
+            "finish_reason": r,
+        } for i, (c, r) in enumerate(zip(contents, reasons))],
+        "usage": usage or {
             "prompt_tokens": 0,
-            "completion_tokens": len(content) // 4,
-            "total_tokens": len(content) // 4,
+            "completion_tokens": completion_tokens,
+            "total_tokens": completion_tokens,
         },
     }
 
-async def _process_lmarena_stream(request_id: str):
+def resolve_stream_timeouts(model_name: str | None, openai_req: dict | None = None) -> dict:
+    """
+    计算一个请求的三类超时（秒）：
+    - first_byte: 下发请求后等待浏览器第一个数据块的最长时间
+    - idle: 两个数据块之间的最长间隔
+    - total: 整个响应的总时长上限（<= 0 表示不限制）
+    优先级：请求体中的 "timeouts" > config.jsonc 中的 model_timeouts[模型] > 全局配置。
+    未单独配置时沿用 stream_response_timeout_seconds。
+    """
+    legacy = CONFIG.get("stream_response_timeout_seconds", 360)
+    timeouts = {
+        "first_byte": CONFIG.get("stream_first_byte_timeout_seconds", legacy),
+        "idle": CONFIG.get("stream_idle_timeout_seconds", legacy),
+        "total": CONFIG.get("stream_total_timeout_seconds", -1),
+    }
+    overrides = [(CONFIG.get("model_timeouts") or {}).get(model_name) if model_name else None]
+    if openai_req:
+        overrides.append(openai_req.get("timeouts"))
+    for override in overrides:
+        if not isinstance(override, dict):
+            continue
+        for key in timeouts:
+            value = override.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                timeouts[key] = value
+    return timeouts
+
+def record_tab_error(request_id: str, error):
+    """把请求错误记到处理它的标签页上。"""
+    inflight = inflight_requests.get(request_id)
+    if inflight:
+        inflight.tab.recent_errors.append({"ts": round(time.time(), 3), "error": str(error)[:300]})
+
+# 对战模式下两个参与者的输出（a/b 前缀）对应的 choice 序号
+BATTLE_SIDE_CHOICES = {"a": 0, "b": 1}
+
+async def _process_lmarena_stream(request_id: str, timeouts: dict | None = None, keepalive_interval: float | None = None, split_sides: bool = False):
     """
     核心内部生成器：处理来自浏览器的原始数据流，并产生结构化事件。
     事件类型: ('content', str), ('finish', str), ('error', str)
+    若指定 keepalive_interval，等待期间每隔该时长额外产生一个 ('keepalive', None) 事件。
+    split_sides 为 True 时（对战模式 n=2），content 与 finish 事件的数据为 (choice 序号, 值)，
+    参与者 A 对应 0，B 对应 1；否则两侧的输出合并为同一个流。
     """
     queue = response_channels.get(request_id)
     if not queue:
@@ -612,22 +1045,80 @@ async def _process_lmarena_stream(request_id: str):
         return
 
     buffer = ""
-    timeout = CONFIG.get("stream_response_timeout_seconds",360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
+    usage = request_usage.get(request_id)
+    timeouts = timeouts or resolve_stream_timeouts(None)
+    started_at = time.monotonic()
+    last_data_at = started_at
+    total_deadline = started_at + timeouts["total"] if timeouts["total"] > 0 else None
+    received_first_byte = False
+    text_pattern = re.compile(r'([ab])0:"((?:\\.|[^"\\])*)"')
     # 新增：用于匹配和提取图片URL的正则表达式
-    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
+    image_pattern = re.compile(r'([ab])2:(\[.*?\])')
+    # 结束记录可能带有嵌套的 usage 对象，因此只定位前缀，JSON 本体交给 raw_decode 解析
+    finish_pattern = re.compile(r'([ab])d:(?=\{)')
+
+    def for_side(side, value):
+        return (BATTLE_SIDE_CHOICES.get(side, 0), value) if split_sides else value
+    json_decoder = json.JSONDecoder()
     error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
     cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
 
     try:
         while True:
+            phase = "idle" if received_first_byte else "first_byte"
+            phase_deadline = last_data_at + timeouts[phase]
+            deadline = min(phase_deadline, total_deadline) if total_deadline else phase_deadline
+            wait = max(deadline - time.monotonic(), 0)
+            if keepalive_interval:
+                wait = min(wait, keepalive_interval)
             try:
-                raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
+                raw_data = await asyncio.wait_for(queue.get(), timeout=wait)
             except asyncio.TimeoutError:
-                logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
-                yield 'error', f'Response timed out after {timeout} seconds.'
-                return
+                now = time.monotonic()
+                if total_deadline and now >= total_deadline:
+                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 响应总时长超过上限（{timeouts['total']}秒）。")
+                    yield 'error', f"Response exceeded the total time limit of {timeouts['total']} seconds."
+                    return
+                if now >= phase_deadline:
+                    if received_first_byte:
+                        logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 数据块间隔超时（{timeouts['idle']}秒）。")
+                        yield 'error', f"Response stalled: no data for {timeouts['idle']} seconds."
+                    else:
+                        logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待首个数据块超时（{timeouts['first_byte']}秒）。")
+                        yield 'error', f"Response timed out after {timeouts['first_byte']} seconds waiting for the first byte."
+                    return
+                yield 'keepalive', None
+                continue
+
+            received_first_byte = True
+            last_data_at = time.monotonic()
+
+            # 0. 标签页已在浏览器中解析好的事件（stream_format 为 events 时）。
+            #    无法识别的原始内容（raw）并入缓冲区，错误事件交给下面的错误处理，沿用原有逻辑
+            if isinstance(raw_data, dict) and 'events' in raw_data:
+                error_event = None
+                for event in raw_data['events']:
+                    kind = event.get('type') if isinstance(event, dict) else None
+                    side = event.get('side', 'a') if isinstance(event, dict) else 'a'
+                    if kind == 'text':
+                        text_content = event.get('text') or ''
+                        if text_content:
+                            if usage: usage.completion_chars += len(text_content)
+                            yield 'content', for_side(side, text_content)
+                    elif kind == 'image':
+                        markdown_image = f"![Image]({event.get('url')})"
+                        if usage: usage.completion_chars += len(markdown_image)
+                        yield 'content', for_side(side, markdown_image)
+                    elif kind == 'finish':
+                        if usage and isinstance(event.get('usage'), dict):
+                            usage.upstream[side] = event['usage']
+                        yield 'finish', for_side(side, event.get('reason') or 'stop')
+                    elif kind == 'error':
+                        error_event = {'error': event.get('message') or '来自 LMArena 的未知错误'}
+                        break
+                    elif kind == 'raw':
+                        buffer += str(event.get('data', ''))
+                raw_data = error_event if error_event else ""
 
             # 1. 检查来自 WebSocket 端的直接错误或终止信号
             if isinstance(raw_data, dict) and 'error' in raw_data:
@@ -645,12 +1136,8 @@ async def _process_lmarena_stream(request_id: str):
                     # 2. 检查 Cloudflare 验证页面
                     if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
                         friendly_error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
-                        if browser_ws:
-                            try:
-                                await browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False))
-                                logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 在错误消息中检测到CF并已发送刷新指令。")
-                            except Exception as e:
-                                logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
+                        if await send_command_to_request_tab(request_id, "refresh"):
+                            logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 在错误消息中检测到CF并已发送刷新指令。")
                         yield 'error', friendly_error_msg
                         return
 
@@ -664,12 +1151,8 @@ async def _process_lmarena_stream(request_id: str):
 
             if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
                 error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
-                if browser_ws:
-                    try:
-                        await browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False))
-                        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已向浏览器发送页面刷新指令。")
-                    except Exception as e:
-                        logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
+                if await send_command_to_request_tab(request_id, "refresh"):
+                    logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已向浏览器发送页面刷新指令。")
                 yield 'error', error_msg
                 return
             
@@ -683,142 +1166,588 @@ async def _process_lmarena_stream(request_id: str):
             # 优先处理文本内容
             while (match := text_pattern.search(buffer)):
                 try:
-                    text_content = json.loads(f'"{match.group(1)}"')
-                    if text_content: yield 'content', text_content
+                    text_content = json.loads(f'"{match.group(2)}"')
+                    if text_content:
+                        if usage: usage.completion_chars += len(text_content)
+                        yield 'content', for_side(match.group(1), text_content)
                 except (ValueError, json.JSONDecodeError): pass
                 buffer = buffer[match.end():]
 
             # 新增：处理图片内容
             while (match := image_pattern.search(buffer)):
                 try:
-                    image_data_list = json.loads(match.group(1))
+                    image_data_list = json.loads(match.group(2))
                     if isinstance(image_data_list, list) and image_data_list:
                         image_info = image_data_list[0]
                         if image_info.get("type") == "image" and "image" in image_info:
                             # 将URL包装成Markdown格式并作为内容块yield
                             markdown_image = f"![Image]({image_info['image']})"
-                            yield 'content', markdown_image
+                            if usage: usage.completion_chars += len(markdown_image)
+                            yield 'content', for_side(match.group(1), markdown_image)
                 except (json.JSONDecodeError, IndexError) as e:
                     logger.warning(f"解析图片URL时出错: {e}, buffer: {buffer[:150]}")
                 buffer = buffer[match.end():]
 
-            if (finish_match := finish_pattern.search(buffer)):
+            # 对战模式下两侧的结束记录可能出现在同一帧中
+            while (finish_match := finish_pattern.search(buffer)):
                 try:
-                    finish_data = json.loads(finish_match.group(1))
-                    yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError): pass
-                buffer = buffer[finish_match.end():]
+                    finish_data, finish_end = json_decoder.raw_decode(buffer, finish_match.end())
+                except json.JSONDecodeError:
+                    break # 结束记录被拆分到了下一帧，等待补全
+                if isinstance(finish_data, dict) and "finishReason" in finish_data:
+                    if usage and isinstance(finish_data.get("usage"), dict):
+                        usage.upstream[finish_match.group(1)] = finish_data["usage"]
+                    yield 'finish', for_side(finish_match.group(1), finish_data.get("finishReason", "stop"))
+                buffer = buffer[finish_end:]
 
     except asyncio.CancelledError:
         logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 任务被取消。")
     finally:
+        release_inflight_request(request_id)
         if request_id in response_channels:
             del response_channels[request_id]
             logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 响应通道已清理。")
 
-async def stream_generator(request_id: str, model: str):
-    """将内部事件流格式化为 OpenAI SSE 响应。"""
-    response_id = f"chatcmpl-{uuid.uuid4()}"
+def sse_keepalive_interval() -> float | None:
+    """SSE 保活注释的发送间隔，未启用时返回 None。"""
+    interval = CONFIG.get("sse_keepalive_interval_seconds", 15)
+    return interval if interval and interval > 0 else None
+
+async def stream_generator(request_id: str, model: str, timeouts: dict | None = None, choices: int = 1, events=None, response_id: str | None = None, follower: bool = False):
+    """
+    将内部事件流格式化为 OpenAI SSE 响应。choices 为 2 时把对战模式两个参与者的输出分别作为 choice 0/1 返回。
+    events 为合并请求共享的事件订阅；为空时直接解析本请求的响应通道。
+    follower 为真时本请求没有自己的上游请求，补全字数在这里累计，结束时归还限流名额。
+    """
+    response_id = response_id or f"chatcmpl-{uuid.uuid4()}"
     logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器启动。")
     
-    finish_reason_to_send = 'stop'  # 默认的结束原因
-
-    async for event_type, data in _process_lmarena_stream(request_id):
-        if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
-        elif event_type == 'finish':
-            # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
-            finish_reason_to_send = data
-            if data == 'content-filter':
-                warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
-                yield format_openai_chunk(warning_msg, model, response_id)
-        elif event_type == 'error':
-            logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
-            return # 发生错误时，可以立即终止
-
-    # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
-    logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
-
-async def non_stream_response(request_id: str, model: str):
-    """聚合内部事件流并返回单个 OpenAI JSON 响应。"""
+    split_sides = choices > 1
+    shared = events is not None
+    finish_reasons = ['stop'] * choices  # 默认的结束原因
+    follower_usage = request_usage.get(request_id) if follower else None
+
+    try:
+        # 立即发送一个 SSE 注释，并在长时间无数据时周期性发送，避免代理和客户端超时断开
+        keepalive_interval = sse_keepalive_interval()
+        if keepalive_interval:
+            yield ": keepalive\n\n"
+
+        if events is None:
+            events = _process_lmarena_stream(request_id, timeouts, keepalive_interval, split_sides)
+        async for event_type, data in events:
+            if event_type == 'keepalive':
+                yield ": keepalive\n\n"
+            elif event_type == 'content':
+                index, text = data if split_sides else (0, data)
+                if follower_usage:
+                    follower_usage.completion_chars += len(text)
+                yield format_openai_chunk(text, model, response_id, index)
+            elif event_type == 'finish':
+                # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
+                index, reason = data if split_sides else (0, data)
+                finish_reasons[index] = reason
+                if reason == 'content-filter':
+                    warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
+                    yield format_openai_chunk(warning_msg, model, response_id, index)
+            elif event_type == 'error':
+                logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
+                record_tab_error(request_id, data)
+                yield format_openai_error_chunk(str(data), model, response_id)
+                yield format_openai_finish_chunk(model, response_id, reason=['stop'] * choices if split_sides else 'stop')
+                return # 发生错误时，可以立即终止
+
+        # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
+        yield format_openai_finish_chunk(model, response_id, reason=finish_reasons if split_sides else finish_reasons[0])
+        logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
+    finally:
+        if shared:
+            # 退出合并请求的订阅；上游请求由共享的 Flight 负责清理，最后一个订阅者离开时才会被取消
+            await events.aclose()
+            if follower:
+                release_inflight_request(request_id)
+        else:
+            # 客户端在解析开始前断开时，_process_lmarena_stream 的清理不会执行，这里兜底归还调度名额
+            release_inflight_request(request_id)
+
+async def non_stream_response(request_id: str, model: str, timeouts: dict | None = None, choices: int = 1, events=None, follower: bool = False):
+    """
+    聚合内部事件流并返回单个 OpenAI JSON 响应。choices 为 2 时把对战模式两个参与者的输出分别作为 choice 0/1 返回。
+    events 为合并请求共享的事件订阅；为空时直接解析本请求的响应通道。
+    follower 为真时本请求没有自己的上游请求，补全字数在这里累计，结束时归还限流名额。
+    """
     response_id = f"chatcmpl-{uuid.uuid4()}"
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 开始处理非流式响应。")
     
-    full_content = []
-    finish_reason = "stop"
+    split_sides = choices > 1
+    full_content = [[] for _ in range(choices)]
+    finish_reasons = ["stop"] * choices
+    # 处理结束时请求会从 request_usage 中移除，先保留引用
+    usage = request_usage.get(request_id)
     
-    async for event_type, data in _process_lmarena_stream(request_id):
-        if event_type == 'content':
-            full_content.append(data)
-        elif event_type == 'finish':
-            finish_reason = data
-            if data == 'content-filter':
-                full_content.append("\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因")
-            # 不要在这里 break，继续等待来自浏览器的 [DONE] 信号，以避免竞态条件
-        elif event_type == 'error':
-            logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
+    shared = events is not None
+    if events is None:
+        events = _process_lmarena_stream(request_id, timeouts, split_sides=split_sides)
+    try:
+        async for event_type, data in events:
+            if event_type == 'content':
+                index, text = data if split_sides else (0, data)
+                full_content[index].append(text)
+                if follower and usage:
+                    usage.completion_chars += len(text)
+            elif event_type == 'finish':
+                index, reason = data if split_sides else (0, data)
+                finish_reasons[index] = reason
+                if reason == 'content-filter':
+                    full_content[index].append("\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因")
+                # 不要在这里 break，继续等待来自浏览器的 [DONE] 信号，以避免竞态条件
+            elif event_type == 'error':
+                logger.error(f"NON-STREAM [ID: {request_id[:8]}]: 处理时发生错误: {data}")
+                record_tab_error(request_id, data)
             
-            # 统一流式和非流式响应的错误状态码
-            status_code = 413 if "附件大小超过了" in str(data) else 500
-
-            error_response = {
-                "error": {
-                    "message": f"[LMArena Bridge Error]: {data}",
-                    "type": "bridge_error",
-                    "code": "attachment_too_large" if status_code == 413 else "processing_error"
+                # 统一流式和非流式响应的错误状态码
+                status_code = 413 if "附件大小超过了" in str(data) else 500
+
+                error_response = {
+                    "error": {
+                        "message": f"[LMArena Bridge Error]: {data}",
+                        "type": "bridge_error",
+                        "code": "attachment_too_large" if status_code == 413 else "processing_error"
+                    }
                 }
-            }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
-
-    final_content = "".join(full_content)
-    response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
+                return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+    finally:
+        if shared:
+            await events.aclose()
+            if follower:
+                release_inflight_request(request_id)
+
+    final_content = ["".join(parts) for parts in full_content]
+    response_data = format_openai_non_stream_response(
+        final_content if split_sides else final_content[0], model, response_id,
+        reason=finish_reasons if split_sides else finish_reasons[0],
+        usage=usage.to_openai_usage() if usage else None
+    )
     
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 响应聚合完成。")
     return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
 
+# --- 浏览器标签页管理 ---
+def select_browser_tab(exclude: set[str] | None = None) -> BrowserTab | None:
+    """选择一个健康的标签页：优先仍有空闲并发名额的，其次待处理请求最少的，最后心跳往返时间最短的。"""
+    candidates = [
+        tab for tab in browser_tabs.values()
+        if tab.healthy and not tab.draining and not (exclude and tab.tab_id in exclude)
+    ]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda tab: (tab.saturated, len(tab.pending_requests), tab.average_rtt or 0.0))
+
+async def dispatch_to_browser(request_id: str, message: dict, exclude: set[str] | None = None) -> BrowserTab:
+    """把请求下发给一个健康的标签页，并记录请求与标签页的对应关系。"""
+    tab = select_browser_tab(exclude)
+    if not tab:
+        raise HTTPException(status_code=503, detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。")
+
+    inflight = inflight_requests.get(request_id)
+    if inflight:
+        inflight.tab = tab
+        inflight.attempts += 1
+    else:
+        inflight_requests[request_id] = InflightRequest(request_id=request_id, message=message, tab=tab)
+    tab.add_request(request_id)
+    await send_request_to_tab(tab, prepare_message_for_tab(message, tab))
+    return tab
+
+async def send_request_to_tab(tab: BrowserTab, message: dict):
+    """
+    发送请求消息。请求中保存在临时文件里的附件在这里写回消息帧，请求处理期间不必常驻内存。
+    同一连接上的消息本来就是依次传输的，因此大消息帧逐个展开、发送，不会拖慢整体吞吐。
+    """
+    text = json.dumps(message)
+    if not has_blob_references(text):
+        await tab.websocket.send_text(text)
+        return
+    async with tab.large_frame_lock:
+        await tab.websocket.send_text(await expand_blob_references(blob_store, text))
+
+def prepare_message_for_tab(message: dict, tab: BrowserTab, use_prefix: bool = True) -> dict:
+    """按实际分配到的标签页的能力调整下发的消息；inflight 中保存的原始消息保持不变，便于故障转移。"""
+    return apply_prefix_delta(negotiate_stream_format(message, tab), tab, use_prefix)
+
+def apply_prefix_delta(message: dict, tab: BrowserTab, use_prefix: bool = True) -> dict:
+    """
+    长对话的大部分内容是已经发送过的历史。标签页缓存最近的消息列表，
+    这里只发送与缓存中最长公共前缀的引用 (prefix) 和之后的新消息，并告知标签页以 cache_key 缓存本次的完整列表。
+    """
+    if tab.prefix_cache is None or not CONFIG.get("payload_prefix_cache", True):
+        return message
+    payload = message.get("payload") or {}
+    templates = payload.get("message_templates") or []
+    chain = template_chain(templates)
+    if not chain:
+        return message
+    hit = tab.prefix_cache.find(chain) if use_prefix else None
+    tab.prefix_cache.remember(chain)
+    delta = {**payload, "cache_key": chain[-1]}
+    if hit:
+        key, length = hit
+        delta["prefix"] = {"key": key, "length": length}
+        delta["message_templates"] = templates[length:]
+        logger.debug(f"标签页 {tab.tab_id[:8]} 前缀缓存命中：复用 {length}/{len(templates)} 条消息。")
+    return {**message, "payload": delta}
+
+async def resend_without_prefix(tab: BrowserTab, request_id: str):
+    """标签页找不到引用的前缀（缓存已被淘汰或页面刷新过）时，改发完整消息。"""
+    inflight = inflight_requests.get(request_id)
+    if not inflight or inflight.tab.tab_id != tab.tab_id:
+        return
+    logger.info(f"标签页 {tab.tab_id[:8]} 的前缀缓存未命中，改为发送请求 {request_id[:8]} 的完整消息。")
+    # 两侧缓存已不一致，清空镜像后重新积累
+    if tab.prefix_cache is not None:
+        tab.prefix_cache.clear()
+    await send_request_to_tab(tab, prepare_message_for_tab(inflight.message, tab, use_prefix=False))
+
+def negotiate_stream_format(message: dict, tab: BrowserTab) -> dict:
+    """
+    开启 browser_stream_parsing 且标签页声明了 parsed_stream 能力时，要求标签页在浏览器中解析数据流并回传事件。
+    按实际分配到的标签页决定，原始消息保持不变，故障转移到旧版脚本时自动退回原始数据转发。
+    """
+    if not CONFIG.get("browser_stream_parsing", False) or "parsed_stream" not in tab.capabilities:
+        return message
+    return {**message, "payload": {**message.get("payload", {}), "stream_format": "events"}}
+
+def release_inflight_request(request_id: str):
+    """
+    请求结束后，归还调度名额、会话通道与限流并发名额、记录用量，并从标签页和在途请求表中移除。
+    排空中的标签页在最后一个请求结束后关闭。
+    """
+    slot = request_slots.pop(request_id, None)
+    if slot:
+        slot.release()
+    mapping = request_lanes.pop(request_id, None)
+    if mapping:
+        session_lanes.release(mapping)
+    usage = request_usage.pop(request_id, None)
+    if usage:
+        rate_limiter.release(usage.client, usage.completion_chars)
+        usage_tracker.record(usage)
+    blobs = request_blobs.pop(request_id, None)
+    if blobs:
+        blobs.release()
+    inflight = inflight_requests.pop(request_id, None)
+    if not inflight:
+        return
+    tab = inflight.tab
+    tab.remove_request(request_id)
+    if not inflight.finished and "abort" in tab.capabilities:
+        # 请求提前结束（客户端断开、超时等），让标签页中止 fetch 并释放并发名额
+        asyncio.create_task(send_abort_to_tab(tab, request_id))
+    if tab.draining and not tab.pending_requests:
+        if tab.close_when_drained:
+            logger.info(f"排空中的标签页 {tab.tab_id[:8]} 已完成所有请求，正在关闭旧连接。")
+            asyncio.create_task(close_tab_connection(tab))
+        else:
+            logger.info(f"排空中的标签页 {tab.tab_id[:8]} 已完成所有请求，等待外部关闭页面。")
+
+async def send_abort_to_tab(tab: BrowserTab, request_id: str):
+    try:
+        await tab.send_json({"command": "abort", "request_id": request_id})
+        logger.info(f"已通知标签页 {tab.tab_id[:8]} 中止请求 {request_id[:8]}。")
+    except Exception as e:
+        logger.debug(f"向标签页 {tab.tab_id[:8]} 发送 'abort' 指令失败: {e}")
+
+async def send_tab_settings(tab: BrowserTab):
+    """把标签页相关的配置（目前为最大并发数）下发给声明了 concurrency 能力的标签页。"""
+    try:
+        await tab.send_json({
+            "command": "configure",
+            "max_concurrent_requests": max(1, int(CONFIG.get("tab_max_concurrent_requests", 4))),
+        })
+    except Exception as e:
+        logger.error(f"向标签页 {tab.tab_id[:8]} 下发配置失败: {e}")
+
+def push_tab_settings():
+    """配置变化后向所有已连接的标签页重新下发设置（启动阶段没有事件循环时跳过）。"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    for tab in browser_tabs.values():
+        if "concurrency" in tab.capabilities:
+            loop.create_task(send_tab_settings(tab))
+
+async def close_tab_connection(tab: BrowserTab, code: int = 1000):
+    try:
+        await tab.websocket.close(code=code)
+    except Exception:
+        pass
+
+async def send_command_to_request_tab(request_id: str, command: str) -> bool:
+    """向正在处理指定请求的标签页发送指令。"""
+    inflight = inflight_requests.get(request_id)
+    if not inflight:
+        return False
+    tab = inflight.tab
+    try:
+        await tab.send_json({"command": command})
+        return True
+    except Exception as e:
+        logger.error(f"向标签页 {tab.tab_id[:8]} 发送 '{command}' 指令失败: {e}")
+        return False
+
+async def fail_over_or_abort(request_id: str, failed_tab: BrowserTab, reason: str):
+    """
+    标签页失效时处理它的一个在途请求：
+    若浏览器尚未回传任何数据，则转交给另一个健康的标签页重新执行；否则向响应通道推送错误。
+    """
+    inflight = inflight_requests.get(request_id)
+    queue = response_channels.get(request_id)
+    if not inflight or not queue or inflight.tab is not failed_tab:
+        return
+
+    max_attempts = CONFIG.get("failover_max_attempts", 2)
+    if not inflight.received_data and inflight.attempts < max_attempts:
+        try:
+            # 若失效的是已被替换的旧连接，新连接（同一 tab_id）仍可以接手
+            exclude = {failed_tab.tab_id} if browser_tabs.get(failed_tab.tab_id) is failed_tab else None
+            tab = await dispatch_to_browser(request_id, inflight.message, exclude=exclude)
+            logger.warning(f"FAILOVER [ID: {request_id[:8]}]: 标签页 {failed_tab.tab_id[:8]} 失效（{reason}），请求已转交给标签页 {tab.tab_id[:8]}。")
+            return
+        except HTTPException:
+            pass
+        except Exception as e:
+            logger.error(f"FAILOVER [ID: {request_id[:8]}]: 转交请求失败: {e}")
+
+    logger.warning(f"FAILOVER [ID: {request_id[:8]}]: 标签页 {failed_tab.tab_id[:8]} 失效（{reason}），请求无法转交，已终止。")
+    await queue.put({"error": f"Browser tab failed during operation: {reason}"})
+
+async def mark_tab_unhealthy(tab: BrowserTab, reason: str):
+    """将标签页标记为不健康：不再向其分配请求，转移或终止其在途请求，并断开连接。"""
+    if not tab.healthy:
+        return
+    tab.healthy = False
+    logger.error(f"❌ 标签页 {tab.tab_id[:8]} 被标记为不健康: {reason}")
+    for request_id in list(tab.pending_requests):
+        tab.remove_request(request_id)
+        await fail_over_or_abort(request_id, tab, reason)
+    await close_tab_connection(tab, code=1011)
+
+async def drain_tab(tab: BrowserTab, reason: str):
+    """
+    让标签页进入排空模式：不再分配新请求，已分配的请求继续在该连接上完成后再关闭。
+    超过 tab_drain_timeout_seconds 仍未完成的请求按失效处理。
+    """
+    if tab.draining or not tab.healthy:
+        return
+    tab.draining = True
+    if not tab.pending_requests:
+        logger.info(f"标签页 {tab.tab_id[:8]} {reason}，没有进行中的请求，直接关闭旧连接。")
+        await close_tab_connection(tab)
+        return
+    await wait_tab_drained(tab, reason)
+
+async def wait_tab_drained(tab: BrowserTab, reason: str):
+    """等待排空中的标签页完成已分配的请求，超时后按失效处理（剩余请求转移到其他标签页）。"""
+    timeout = CONFIG.get("tab_drain_timeout_seconds", 120)
+    logger.info(f"标签页 {tab.tab_id[:8]} {reason}，进入排空模式，等待 {len(tab.pending_requests)} 个请求完成（最多 {timeout} 秒）。")
+    deadline = time.monotonic() + timeout
+    while tab.pending_requests and tab.healthy and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    if tab.pending_requests and tab.healthy:
+        await mark_tab_unhealthy(tab, "排空超时")
+
+async def heartbeat_loop(tab: BrowserTab):
+    """定期向标签页发送 ping，连续错过若干次 pong 即判定为失效。"""
+    interval = CONFIG.get("heartbeat_interval_seconds", 5)
+    max_missed = CONFIG.get("heartbeat_max_missed", 3)
+    while tab.healthy:
+        await asyncio.sleep(interval)
+        tab.missed_heartbeats = int((time.monotonic() - tab.last_pong_at) // interval)
+        if tab.missed_heartbeats >= max_missed:
+            await mark_tab_unhealthy(tab, f"连续 {tab.missed_heartbeats} 次心跳无响应")
+            return
+        try:
+            await tab.send_json({"command": "ping", "ts": time.monotonic()})
+        except Exception as e:
+            await mark_tab_unhealthy(tab, f"发送心跳失败: {e}")
+            return
+
+def adopt_request(tab: BrowserTab, request_id: str):
+    """把一个在途请求从同一标签页的旧连接转移到新连接上。"""
+    inflight = inflight_requests.get(request_id)
+    if not inflight or inflight.tab is tab:
+        return
+    inflight.tab.remove_request(request_id)
+    inflight.tab = tab
+    tab.add_request(request_id)
+
+async def resume_orphaned_requests(tab: BrowserTab, resumable_ids: set[str]):
+    """
+    标签页重连后，接管旧连接上遗留的请求：
+    标签页声明仍在执行的请求转移到新连接继续回传，其余请求（例如页面已刷新）立即转移或终止。
+    """
+    orphaned = [
+        inflight for inflight in inflight_requests.values()
+        if inflight.tab.tab_id == tab.tab_id and inflight.tab is not tab and not inflight.tab.healthy
+    ]
+    for inflight in orphaned:
+        if inflight.request_id in resumable_ids:
+            adopt_request(tab, inflight.request_id)
+            logger.info(f"RESUME [ID: {inflight.request_id[:8]}]: 标签页 {tab.tab_id[:8]} 重连成功，请求继续在新连接上回传。")
+        else:
+            await fail_over_or_abort(inflight.request_id, inflight.tab, "标签页重连后不再执行该请求")
+
+async def hold_orphaned_requests(tab: BrowserTab):
+    """
+    支持断线续传的标签页断开后，为其在途请求保留 ws_resume_grace_seconds 的宽限期，
+    等待同一标签页重连并重传未确认的数据块；宽限期结束仍未被接管的请求再转移或终止。
+    """
+    successor = browser_tabs.get(tab.tab_id)
+    if successor is not None and successor is not tab and successor.healthy:
+        # 被替换的旧连接：新连接已经存在，直接移交
+        for request_id in list(tab.pending_requests):
+            adopt_request(successor, request_id)
+        return
+
+    grace = CONFIG.get("ws_resume_grace_seconds", 15)
+    logger.info(f"标签页 {tab.tab_id[:8]} 断开，{len(tab.pending_requests)} 个在途请求将保留 {grace} 秒等待重连。")
+    await asyncio.sleep(grace)
+    for request_id in list(tab.pending_requests):
+        await fail_over_or_abort(request_id, tab, "标签页断开后未在宽限期内重连")
+    tab.pending_requests.clear()
+
+def update_tab_capacity(tab: BrowserTab, message: dict):
+    """记录标签页上报的并发上限与当前执行/排队情况。"""
+    if isinstance(message.get("max_concurrent"), int) and message["max_concurrent"] > 0:
+        tab.max_concurrent = message["max_concurrent"]
+    if isinstance(message.get("active"), int):
+        tab.browser_active = message["active"]
+    if isinstance(message.get("queued"), int):
+        tab.browser_queued = message["queued"]
+
+async def handle_tab_control_message(tab: BrowserTab, message: dict) -> asyncio.Task | None:
+    """处理来自标签页的控制消息（hello/pong/capacity/prefix_miss/id_captured）。必要时返回新启动的后台任务。"""
+    message_type = message.get("type")
+    if message_type == "hello":
+        tab.capabilities = set(message.get("capabilities") or [])
+        logger.info(f"标签页 {tab.tab_id[:8]} 能力声明: {sorted(tab.capabilities) or '无'}")
+        if "concurrency" in tab.capabilities:
+            update_tab_capacity(tab, message)
+            await send_tab_settings(tab)
+        if "prefix_cache" in tab.capabilities:
+            tab.prefix_cache = PrefixCache(max(1, int(message.get("prefix_cache_size") or 16)))
+        if "resume" in tab.capabilities:
+            await resume_orphaned_requests(tab, set(message.get("inflight") or []))
+        if "heartbeat" in tab.capabilities:
+            tab.last_pong_at = time.monotonic()
+            return asyncio.create_task(heartbeat_loop(tab))
+    elif message_type == "pong":
+        now = time.monotonic()
+        sent_at = message.get("ts")
+        if isinstance(sent_at, (int, float)) and sent_at <= now:
+            tab.rtt_history.append(now - sent_at)
+        tab.last_pong_at = now
+        tab.missed_heartbeats = 0
+    elif message_type == "capacity":
+        update_tab_capacity(tab, message)
+    elif message_type == "prefix_miss":
+        await resend_without_prefix(tab, message.get("request_id"))
+    elif message_type == "id_captured":
+        await record_captured_id(tab, message)
+    else:
+        logger.warning(f"收到来自标签页 {tab.tab_id[:8]} 的未知控制消息: {message}")
+    return None
+
 # --- WebSocket 端点 ---
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """处理来自油猴脚本的 WebSocket 连接。"""
-    global browser_ws
+    """处理来自油猴脚本的 WebSocket 连接。每个标签页通过 tab_id 查询参数区分。"""
     await websocket.accept()
-    if browser_ws is not None:
-        logger.warning("检测到新的油猴脚本连接，旧的连接将被替换。")
-    logger.info("✅ 油猴脚本已成功连接 WebSocket。")
-    browser_ws = websocket
+    tab_id = websocket.query_params.get("tab_id") or str(uuid.uuid4())
+    tab = BrowserTab(tab_id=tab_id, websocket=websocket)
+    old_tab = browser_tabs.get(tab_id)
+    if old_tab is not None:
+        logger.warning(f"检测到标签页 {tab_id[:8]} 的新连接，旧的连接将被替换。")
+    browser_tabs[tab_id] = tab
+    browser_connected_event.set()
+    logger.info(f"✅ 油猴脚本标签页 {tab_id[:8]} 已成功连接 WebSocket（当前共 {len(browser_tabs)} 个）。")
+    if old_tab is not None:
+        # 旧连接继续完成它已分配的请求，新请求只会分配给新连接
+        asyncio.create_task(drain_tab(old_tab, "被同一标签页的新连接替换"))
+
+    heartbeat_task = None
     try:
         while True:
             # 等待并接收来自油猴脚本的消息
             message_str = await websocket.receive_text()
             message = json.loads(message_str)
-            
+
+            if "type" in message:
+                task = await handle_tab_control_message(tab, message)
+                if task:
+                    if heartbeat_task:
+                        heartbeat_task.cancel()
+                    heartbeat_task = task
+                continue
+
             request_id = message.get("request_id")
             data = message.get("data")
+            if data is None and isinstance(message.get("events"), list):
+                # 浏览器端解析后的事件批次
+                data = {"events": message["events"]}
 
             if not request_id or data is None:
                 logger.warning(f"收到来自浏览器的无效消息: {message}")
                 continue
 
+            # 故障转移后，原标签页可能仍在回传数据，只接受当前负责该请求的标签页的数据
+            # （同一标签页的新旧连接视为同一来源）
+            inflight = inflight_requests.get(request_id)
+            if inflight and inflight.tab.tab_id != tab_id:
+                continue
+
+            # 带序号的数据块：丢弃重连后重传的重复块，并定期确认，让标签页释放已确认的缓存
+            seq = message.get("seq")
+            if isinstance(seq, int):
+                is_last = data == "[DONE]" or (isinstance(data, dict) and "error" in data)
+                if inflight:
+                    if seq <= inflight.last_seq:
+                        continue
+                    inflight.last_seq = seq
+                if is_last or not inflight or seq % ACK_EVERY_CHUNKS == 0:
+                    await websocket.send_text(json.dumps({"command": "ack", "request_id": request_id, "seq": seq}))
+
             # 将收到的数据放入对应的响应通道
             if request_id in response_channels:
+                if inflight:
+                    inflight.received_data = True
+                    inflight.finished = inflight.finished or data == "[DONE]"
                 await response_channels[request_id].put(data)
-            else:
+            elif not isinstance(seq, int):
                 logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
 
     except WebSocketDisconnect:
-        logger.warning("❌ 油猴脚本客户端已断开连接。")
+        logger.warning(f"❌ 油猴脚本标签页 {tab_id[:8]} 已断开连接。")
     except Exception as e:
         logger.error(f"WebSocket 处理时发生未知错误: {e}", exc_info=True)
     finally:
-        browser_ws = None
-        # 清理所有等待的响应通道，以防请求被挂起
-        for queue in response_channels.values():
-            await queue.put({"error": "Browser disconnected during operation"})
-        response_channels.clear()
-        logger.info("WebSocket 连接已清理。")
+        if heartbeat_task:
+            heartbeat_task.cancel()
+        if browser_tabs.get(tab_id) is tab:
+            del browser_tabs[tab_id]
+        if not browser_tabs:
+            browser_connected_event.clear()
+        tab.healthy = False
+        if tab.pending_requests and "resume" in tab.capabilities:
+            # 标签页中的 fetch 可能仍在正常进行，保留请求等待重连续传
+            asyncio.create_task(hold_orphaned_requests(tab))
+        else:
+            # 转移或终止该标签页上等待的请求，以防请求被挂起
+            for request_id in list(tab.pending_requests):
+                await fail_over_or_abort(request_id, tab, "标签页已断开连接")
+            tab.pending_requests.clear()
+        logger.info(f"标签页 {tab_id[:8]} 的 WebSocket 连接已清理。")
 
 # --- OpenAI 兼容 API 端点 ---
 @app.get("/v1/models")
@@ -849,13 +1778,14 @@ async def request_model_update():
     接收来自 model_updater.py 的请求，并通过 WebSocket 指令
     让油猴脚本发送页面源码。
     """
-    if not browser_ws:
+    tab = select_browser_tab()
+    if not tab:
         logger.warning("MODEL UPDATE: 收到更新请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
     
     try:
-        logger.info("MODEL UPDATE: 收到更新请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "send_page_source"}))
+        logger.info(f"MODEL UPDATE: 收到更新请求，正在通过 WebSocket 向标签页 {tab.tab_id[:8]} 发送指令...")
+        await tab.send_json({"command": "send_page_source"})
         logger.info("MODEL UPDATE: 'send_page_source' 指令已成功发送。")
         return JSONResponse({"status": "success", "message": "Request to send page source sent."})
     except Exception as e:
@@ -889,6 +1819,60 @@ async def update_available_models_endpoint(request: Request):
         )
 
 
+def authenticate_request(request: Request) -> dict:
+    """
+    根据 Authorization 头部识别调用方，返回其名称、优先级类别与权重。
+    未配置任何 Key 时所有请求视为匿名调用方。
+    """
+    api_keys = CONFIG.get("api_keys") or []
+    legacy_key = CONFIG.get("api_key")
+    default_priority = CONFIG.get("default_priority_class", "interactive")
+
+    default_limits = CONFIG.get("default_rate_limits") or {}
+
+    if not api_keys and not legacy_key:
+        return {"name": "anonymous", "priority": default_priority, "weight": _class_weight(default_priority), "rate_limits": default_limits}
+
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        raise HTTPException(
+            status_code=401,
+            detail="未提供 API Key。请在 Authorization 头部中以 'Bearer YOUR_KEY' 格式提供。"
+        )
+
+    provided_key = auth_header.split(' ')[1]
+    for entry in api_keys:
+        if entry.get("key") and entry.get("key") == provided_key:
+            priority = entry.get("priority", default_priority)
+            return {
+                "name": entry.get("name") or f"key-...{provided_key[-4:]}",
+                "priority": priority,
+                "weight": _class_weight(priority) * entry.get("weight", 1),
+                "rate_limits": {**default_limits, **(entry.get("rate_limits") or {})},
+            }
+    if legacy_key and provided_key == legacy_key:
+        return {"name": "default", "priority": default_priority, "weight": _class_weight(default_priority), "rate_limits": default_limits}
+
+    raise HTTPException(
+        status_code=401,
+        detail="提供的 API Key 不正确。"
+    )
+
+def count_prompt_chars(messages: list) -> int:
+    """统计请求消息中的文本字符数（不含附件）。"""
+    total = 0
+    for message in messages or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            total += sum(len(part.get("text", "")) for part in content if isinstance(part, dict) and part.get("type") == "text")
+    return total
+
+def _class_weight(priority_class: str) -> float:
+    """返回优先级类别的权重，未配置的类别权重为 1。"""
+    return CONFIG.get("priority_classes", {}).get(priority_class, 1)
+
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """
@@ -900,10 +1884,9 @@ async def chat_completions(request: Request):
     last_activity_time = datetime.now() # 更新活动时间
     logger.info(f"API请求已收到，活动时间已更新为: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-    try:
-        openai_req = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
+    # --- API Key 验证（在读取请求体之前，未授权的请求不会占用内存或临时文件）---
+    client = authenticate_request(request)
+    openai_req, blobs = await read_chat_request_body(request)
 
     model_name = openai_req.get("model")
     model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {}) # 关键修复：如果模型未找到，返回一个空字典而不是None
@@ -919,63 +1902,73 @@ async def chat_completions(request: Request):
     # --- 文生图逻辑结束 ---
 
     # 如果不是图像模型，则执行正常的文本生成逻辑
-    load_config()  # 实时加载最新配置，确保会话ID等信息是最新的
-    # --- API Key 验证 ---
-    api_key = CONFIG.get("api_key")
-    if api_key:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            raise HTTPException(
-                status_code=401,
-                detail="未提供 API Key。请在 Authorization 头部中以 'Bearer YOUR_KEY' 格式提供。"
-            )
-        
-        provided_key = auth_header.split(' ')[1]
-        if provided_key != api_key:
-            raise HTTPException(
-                status_code=401,
-                detail="提供的 API Key 不正确。"
-            )
+    try:
+        return await process_chat_request(openai_req, client, blobs)
+    except BaseException:
+        blobs.release()
+        raise
+
+async def read_chat_request_body(request: Request) -> tuple[dict, BlobSet]:
+    """
+    边接收边解析请求体。超过 request_body_spill_threshold_kb 的 data: URL 直接写入临时文件，
+    请求中只保留引用，多图请求的内存占用不再是请求体大小的数倍。
+    """
+    threshold = CONFIG.get("request_body_spill_threshold_kb", 256) * 1024
+    try:
+        if threshold > 0:
+            openai_req, blobs = await parse_json_stream(request.stream(), blob_store, threshold)
+        else:
+            openai_req, blobs = await request.json(), BlobSet(blob_store)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
+    if not isinstance(openai_req, dict):
+        blobs.release()
+        raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
+    return openai_req, blobs
 
-    if not browser_ws:
+async def process_chat_request(openai_req: dict, client: dict, blobs: BlobSet | None = None):
+    """
+    调度并执行一个已通过认证的聊天请求，返回流式或非流式响应。
+    /v1/chat/completions 与批量任务共用这一入口。blobs 是请求体中写入临时文件的附件，随请求结束释放。
+    """
+    model_name = openai_req.get("model")
+
+    if server_draining:
+        raise HTTPException(
+            status_code=503,
+            detail="服务器正在关闭或重启，请稍后重试。",
+            headers={"Retry-After": str(CONFIG.get("shutdown_drain_timeout_seconds", 30))}
+        )
+
+    # 软重置进行中时，等待其完成（包括浏览器重新连接），而不是直接拒绝请求
+    if not restart_gate.is_set():
+        logger.info("服务器正在软重置，请求将在重置完成后继续处理...")
+        try:
+            await asyncio.wait_for(restart_gate.wait(), timeout=CONFIG.get("soft_restart_reconnect_timeout_seconds", 30) + CONFIG.get("soft_restart_drain_timeout_seconds", 60))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="服务器正在重置，请稍后重试。")
+
+    if not select_browser_tab():
         raise HTTPException(status_code=503, detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。")
 
     # --- 模型与会话ID映射逻辑 ---
-    session_id, message_id = None, None
-    mode_override, battle_target_override = None, None
-
+    # 先收集该模型可用的全部会话映射，下发前再按会话通道的空闲情况选择其中一个
+    candidates = []
     if model_name and model_name in MODEL_ENDPOINT_MAP:
         mapping_entry = MODEL_ENDPOINT_MAP[model_name]
-        selected_mapping = None
-
-        if isinstance(mapping_entry, list) and mapping_entry:
-            selected_mapping = random.choice(mapping_entry)
-            logger.info(f"为模型 '{model_name}' 从ID列表中随机选择了一个映射。")
-        elif isinstance(mapping_entry, dict):
-            selected_mapping = mapping_entry
+        if isinstance(mapping_entry, list):
+            candidates = [m for m in mapping_entry if isinstance(m, dict) and m.get("session_id")]
+            logger.info(f"为模型 '{model_name}' 找到了 {len(candidates)} 个会话映射。")
+        elif isinstance(mapping_entry, dict) and mapping_entry.get("session_id"):
+            candidates = [mapping_entry]
             logger.info(f"为模型 '{model_name}' 找到了单个端点映射（旧格式）。")
-        
-        if selected_mapping:
-            session_id = selected_mapping.get("session_id")
-            message_id = selected_mapping.get("message_id")
-            # 关键：同时获取模式信息
-            mode_override = selected_mapping.get("mode") # 可能为 None
-            battle_target_override = selected_mapping.get("battle_target") # 可能为 None
-            log_msg = f"将使用 Session ID: ...{session_id[-6:] if session_id else 'N/A'}"
-            if mode_override:
-                log_msg += f" (模式: {mode_override}"
-                if mode_override == 'battle':
-                    log_msg += f", 目标: {battle_target_override or 'A'}"
-                log_msg += ")"
-            logger.info(log_msg)
-
-    # 如果经过以上处理，session_id 仍然是 None，则进入全局回退逻辑
-    if not session_id:
+
+    # 如果经过以上处理仍没有可用映射，则进入全局回退逻辑
+    if not candidates:
         if CONFIG.get("use_default_ids_if_mapping_not_found", True):
-            session_id = CONFIG.get("session_id")
-            message_id = CONFIG.get("message_id")
             # 当使用全局ID时，不设置模式覆盖，让其使用全局配置
-            mode_override, battle_target_override = None, None
+            candidates = [{"session_id": CONFIG.get("session_id"), "message_id": CONFIG.get("message_id")}]
+            session_id = candidates[0]["session_id"]
             logger.info(f"模型 '{model_name}' 未找到有效映射，根据配置使用全局默认 Session ID: ...{session_id[-6:] if session_id else 'N/A'}")
         else:
             logger.error(f"模型 '{model_name}' 未在 'model_endpoint_map.json' 中找到有效映射，且已禁用回退到默认ID。")
@@ -984,24 +1977,283 @@ async def chat_completions(request: Request):
                 detail=f"模型 '{model_name}' 没有配置独立的会话ID。请在 'model_endpoint_map.json' 中添加有效映射或在 'config.jsonc' 中启用 'use_default_ids_if_mapping_not_found'。"
             )
 
-    # --- 验证最终确定的会话信息 ---
-    if not session_id or not message_id or "YOUR_" in session_id or "YOUR_" in message_id:
+    # --- 验证会话信息 ---
+    candidates = [
+        m for m in candidates
+        if m.get("session_id") and m.get("message_id") and "YOUR_" not in m["session_id"] and "YOUR_" not in m["message_id"]
+    ]
+    if not candidates:
         raise HTTPException(
             status_code=400,
             detail="最终确定的会话ID或消息ID无效。请检查 'model_endpoint_map.json' 和 'config.jsonc' 中的配置，或运行 `id_updater.py` 来更新默认值。"
         )
 
+    # --- n=2：对战模式的一次上游请求同时产生两个参与者的回答，分别作为两个 choice 返回 ---
+    choice_count = openai_req.get("n", 1)
+    if choice_count is None:
+        choice_count = 1
+    if not isinstance(choice_count, int) or isinstance(choice_count, bool) or choice_count not in (1, 2):
+        raise HTTPException(status_code=400, detail="参数 n 只支持 1 或 2（n=2 需要对战模式的会话）。")
+    if choice_count == 2:
+        candidates = [m for m in candidates if session_mode(m) == "battle"]
+        if not candidates:
+            raise HTTPException(
+                status_code=400,
+                detail=f"n=2 需要对战 (battle) 模式的会话，但模型 '{model_name}' 没有可用的对战模式会话映射。"
+            )
+
     if not model_name or model_name not in MODEL_NAME_TO_ID_MAP:
         logger.warning(f"请求的模型 '{model_name}' 不在 models.json 中，将使用默认模型ID。")
 
+    # --- 按 API Key 限流：在下载与压缩附件之前准入，被限流的请求不会占用带宽和进程池 ---
     request_id = str(uuid.uuid4())
+    admit_request(request_id, openai_req, client)
+    try:
+        if blobs is not None:
+            # 附件预处理可能向其中添加文件；故障转移时需要重新下发，附件引用保留到请求结束
+            request_blobs[request_id] = blobs
+
+        # --- 附件预处理：下载远程图片；过大的图片先压缩，无法压缩的附件立即返回 413，不必等上传到浏览器后才失败 ---
+        await fetch_remote_attachments(openai_req, blobs)
+        await preprocess_attachments(openai_req, blobs)
+
+        is_stream = openai_req.get("stream", False)
+        timeouts = resolve_stream_timeouts(model_name, openai_req)
+        lmarena_payload = convert_openai_to_lmarena_payload(openai_req)
+
+        # --- 合并相同的并发请求：与进行中的请求载荷相同时，直接订阅它的上游响应 ---
+        flight = None
+        if CONFIG.get("single_flight_enabled", False):
+            flight_key = single_flight_key(lmarena_payload, model_name, choice_count)
+            existing = single_flights.get(flight_key)
+            if existing:
+                # 只共享上游请求，限流与用量记录仍按本请求单独进行
+                logger.info(f"API CALL [ID: {request_id[:8]}]: 与进行中的相同请求合并（key: {flight_key[:8]}），共享其上游响应。")
+                if existing.started:
+                    # 附件不会再下发，立即释放
+                    blobs = request_blobs.pop(request_id, None)
+                    if blobs:
+                        blobs.release()
+                else:
+                    # 上游请求尚未发出：登记为接替者，发起方放弃时由本请求重新发起，附件保留到上游请求发出为止
+                    existing.add_successor(request_id, lambda: take_over_flight(
+                        request_id, lmarena_payload, model_name, client, candidates, choice_count, timeouts, existing))
+                return await build_chat_response(request_id, client, model_name or "default_model", timeouts, choice_count, is_stream, existing, follower=True)
+            flight = single_flights.create(flight_key)
+
+        try:
+            return await dispatch_chat_request(request_id, lmarena_payload, model_name, client, candidates, choice_count, timeouts, is_stream, flight)
+        except BaseException as e:
+            if flight:
+                abandon_flight(flight, e)
+            raise
+    except BaseException:
+        # 响应交出之前失败（包括客户端断开）时归还限流名额与附件引用；已经释放过的资源不会重复释放
+        release_inflight_request(request_id)
+        raise
+
+def single_flight_key(payload: dict, model: str | None, choice_count: int) -> str:
+    """
+    合并键：转换后载荷的哈希。载荷尚未绑定会话（不含会话 ID 与参与者位置），
+    再去掉随机生成的附件文件名，相同的请求总是得到相同的键。
+    """
+    templates = [
+        {**t, "attachments": [{k: v for k, v in a.items() if k != "name"} for a in t.get("attachments", [])]}
+        for t in payload["message_templates"]
+    ]
+    material = {"model": model, "target_model_id": payload["target_model_id"], "n": choice_count, "templates": templates}
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def build_chat_response(request_id: str, client: dict, model: str, timeouts: dict, choice_count: int, is_stream: bool, flight: Flight | None = None, follower: bool = False):
+    """
+    根据 stream 参数返回流式或非流式响应。flight 不为空时从共享的上游响应中读取事件；
+    follower 表示本请求是合并进来的，响应结束时由这里归还它自己的限流名额并记录用量。
+    """
+    subscriber = request_id if follower else None
+    if is_stream:
+        events = flight.subscribe(sse_keepalive_interval(), subscriber) if flight else None
+        response_id = f"chatcmpl-{uuid.uuid4()}"
+        frames = stream_generator(request_id, model, timeouts, choice_count, events, response_id, follower)
+        if CONFIG.get("sse_resume_enabled", False):
+            journal = start_response_journal(response_id, client["name"], frames)
+            return StreamingResponse(
+                stream_from_journal(journal),
+                media_type="text/event-stream",
+                headers={"X-Response-Handle": response_id}
+            )
+        return StreamingResponse(frames, media_type="text/event-stream")
+    events = flight.subscribe(subscriber=subscriber) if flight else None
+    return await non_stream_response(request_id, model, timeouts, choice_count, events, follower)
+
+def start_response_journal(response_id: str, client_name: str, frames) -> ResponseJournal:
+    """
+    在后台任务中把流式响应写入日志，客户端从日志读取。客户端断开不会立即中止上游：
+    在 sse_resume_grace_seconds 内凭响应 ID 和 Last-Event-ID 重新连接即可从断点继续。
+    """
+    response_journals.expire(CONFIG.get("sse_journal_ttl_seconds", 300))
+    journal = response_journals.create(
+        response_id, client_name,
+        memory_limit=CONFIG.get("sse_journal_memory_events", 256),
+        grace=CONFIG.get("sse_resume_grace_seconds", 30)
+    )
+    journal.start(asyncio.create_task(record_response_journal(journal, frames)))
+    return journal
+
+async def record_response_journal(journal: ResponseJournal, frames):
+    try:
+        async for frame in frames:
+            # 保活注释由各个读取者自行发送，不写入日志
+            if not frame.startswith(":"):
+                await journal.append(frame)
+    finally:
+        await frames.aclose()
+        journal.finish()
+
+async def stream_from_journal(journal: ResponseJournal, last_event_id: int = 0):
+    """把日志中 last_event_id 之后的事件以带 id 的 SSE 格式发送给客户端。"""
+    keepalive_interval = sse_keepalive_interval()
+    if keepalive_interval:
+        yield ": keepalive\n\n"
+    async for seq, frame in journal.read(last_event_id, keepalive_interval):
+        yield frame if seq is None else f"id: {seq}\n{frame}"
+
+def admit_request(request_id: str, openai_req: dict, client: dict):
+    """
+    按调用方限流并登记请求用量，超出限制时返回 429。
+    合并进来的请求同样经过这里：它们不发起上游请求，但仍占用调用方的并发与频率名额，并单独记录用量。
+    """
+    try:
+        rate_limiter.acquire(client["name"], client["rate_limits"])
+    except RateLimitExceeded as e:
+        usage_tracker.record_rejection(client["name"])
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: 调用方 '{client['name']}' 被限流: {e.reason}")
+        raise HTTPException(
+            status_code=429,
+            detail=f"请求过于频繁：{e.reason}。请在 {math.ceil(e.retry_after)} 秒后重试。",
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    request_usage[request_id] = RequestUsage(
+        client=client["name"],
+        model=openai_req.get("model") or "default_model",
+        prompt_chars=count_prompt_chars(openai_req.get("messages"))
+    )
+
+class QueueTimeoutError(HTTPException):
+    """排队等待会话或调度名额超时。只与本请求自己的等待时间有关，合并进来的请求不会随之失败。"""
+
+def abandon_flight(flight: Flight, error: BaseException):
+    """
+    上游请求发出之前失败。客户端断开与排队超时只与发起方自身有关，交给仍在等待的合并请求接替；
+    其他错误（如请求无效、没有可用的标签页）对合并进来的请求同样成立，让它们收到同样的错误。
+    """
+    if flight.started or flight.done:
+        return
+    if isinstance(error, (asyncio.CancelledError, QueueTimeoutError)) and flight.hand_off():
+        return
+    flight.fail(str(error.detail) if isinstance(error, HTTPException) else (str(error) or "请求已取消"))
+
+async def take_over_flight(request_id: str, payload: dict, model_name: str | None, client: dict, candidates: list[dict], choice_count: int, timeouts: dict, flight: Flight):
+    """
+    合并进来的请求接替发起上游请求。上游请求使用新的请求 ID：接替者自己的限流名额与用量仍随它自己的响应结束，
+    上游占用的会话、调度名额与附件则随上游请求结束释放。
+    """
+    upstream_id = str(uuid.uuid4())
+    blobs = request_blobs.pop(request_id, None)
+    if blobs:
+        request_blobs[upstream_id] = blobs
+    logger.info(f"API CALL [ID: {request_id[:8]}]: 接替发起合并请求的上游请求（上游 ID: {upstream_id[:8]}）。")
+    try:
+        await send_chat_request(upstream_id, payload, model_name, client, candidates, choice_count, timeouts, flight)
+    except BaseException as e:
+        release_inflight_request(upstream_id)
+        response_channels.pop(upstream_id, None)
+        abandon_flight(flight, e)
+        if not isinstance(e, Exception):
+            raise
+
+async def dispatch_chat_request(request_id: str, payload: dict, model_name: str | None, client: dict, candidates: list[dict], choice_count: int, timeouts: dict, is_stream: bool, flight: Flight | None = None):
+    """
+    为已通过限流的请求发出上游请求并返回响应。payload 是 convert_openai_to_lmarena_payload 的结果。
+    flight 不为空时由它消费上游事件，供所有合并的请求共享。
+    """
+    await send_chat_request(request_id, payload, model_name, client, candidates, choice_count, timeouts, flight)
+    try:
+        return await build_chat_response(request_id, client, model_name or "default_model", timeouts, choice_count, is_stream, flight)
+    except HTTPException:
+        release_inflight_request(request_id)
+        response_channels.pop(request_id, None)
+        raise
+    except Exception as e:
+        release_inflight_request(request_id)
+        response_channels.pop(request_id, None)
+        logger.error(f"API CALL [ID: {request_id[:8]}]: 处理请求时发生致命错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def send_chat_request(request_id: str, payload: dict, model_name: str | None, client: dict, candidates: list[dict], choice_count: int, timeouts: dict, flight: Flight | None = None):
+    """
+    排队、选择会话并把请求下发给浏览器。flight 不为空时随即开始消费上游事件。
+    """
+    # --- 选择会话：同一会话同时只处理有限个请求，优先使用空闲会话，全部繁忙时排队 ---
+    queue_timeout = CONFIG.get("scheduler_queue_timeout_seconds", 300)
+    try:
+        selected_mapping = await session_lanes.acquire(candidates, timeout=queue_timeout if queue_timeout > 0 else None)
+    except asyncio.TimeoutError:
+        release_inflight_request(request_id)
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: 模型 '{model_name}' 的 {len(candidates)} 个会话均繁忙，等待超过 {queue_timeout} 秒，已拒绝。")
+        raise QueueTimeoutError(
+            status_code=503,
+            detail="该模型的所有会话均繁忙，请稍后重试或在 'model_endpoint_map.json' 中添加更多会话。",
+            headers={"Retry-After": "30"}
+        )
+    except asyncio.CancelledError:
+        release_inflight_request(request_id)
+        raise
+    request_lanes[request_id] = selected_mapping
+
+    # --- 按优先级排队，等待调度名额（在会话通道之后获取，等待繁忙会话时不占用名额，不会拖住其他模型的请求） ---
+    try:
+        slot = await request_scheduler.acquire(
+            flow=client["name"],
+            weight=client["weight"],
+            priority_class=client["priority"],
+            timeout=queue_timeout if queue_timeout > 0 else None
+        )
+    except asyncio.TimeoutError:
+        release_inflight_request(request_id)
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: 调用方 '{client['name']}' 排队超过 {queue_timeout} 秒，已拒绝。")
+        raise QueueTimeoutError(
+            status_code=503,
+            detail="服务器繁忙，请求排队超时，请稍后重试。",
+            headers={"Retry-After": "30"}
+        )
+    except asyncio.CancelledError:
+        # 客户端在排队期间断开
+        release_inflight_request(request_id)
+        raise
+    request_slots[request_id] = slot
+    if slot.queue_wait >= 1:
+        logger.info(f"API CALL [ID: {request_id[:8]}]: 调用方 '{client['name']}' ({client['priority']}) 排队 {slot.queue_wait:.1f} 秒后获得调度名额。")
+
+    session_id = selected_mapping["session_id"]
+    message_id = selected_mapping["message_id"]
+    # 关键：同时获取模式信息（全局默认ID没有模式信息，使用全局配置）
+    mode_override = selected_mapping.get("mode") # 可能为 None
+    battle_target_override = selected_mapping.get("battle_target") # 可能为 None
+    log_msg = f"API CALL [ID: {request_id[:8]}]: 将使用 Session ID: ...{session_id[-6:]}"
+    if mode_override:
+        log_msg += f" (模式: {mode_override}"
+        if mode_override == 'battle':
+            log_msg += f", 目标: {battle_target_override or 'A'}"
+        log_msg += ")"
+    logger.info(log_msg)
+
     response_channels[request_id] = asyncio.Queue()
     logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道。")
 
     try:
-        # 1. 转换请求，传入可能存在的模式覆盖信息
-        lmarena_payload = convert_openai_to_lmarena_payload(
-            openai_req,
+        # 1. 绑定选中的会话，传入可能存在的模式覆盖信息
+        lmarena_payload = bind_payload_to_session(
+            payload,
             session_id,
             message_id,
             mode_override=mode_override,
@@ -1015,48 +2267,541 @@ async def chat_completions(request: Request):
         }
         
         # 3. 通过 WebSocket 发送
-        logger.info(f"API CALL [ID: {request_id[:8]}]: 正在通过 WebSocket 发送载荷到油猴脚本。")
-        await browser_ws.send_text(json.dumps(message_to_browser))
-
-        # 4. 根据 stream 参数决定返回类型
-        is_stream = openai_req.get("stream", False)
-
-        if is_stream:
-            # 返回流式响应
-            return StreamingResponse(
-                stream_generator(request_id, model_name or "default_model"),
-                media_type="text/event-stream"
-            )
-        else:
-            # 返回非流式响应
-            return await non_stream_response(request_id, model_name or "default_model")
+        tab = await dispatch_to_browser(request_id, message_to_browser)
+        logger.info(f"API CALL [ID: {request_id[:8]}]: 已通过 WebSocket 将载荷发送到标签页 {tab.tab_id[:8]}。")
+
+        # 4. 由共享的 Flight 消费上游事件；等待中的接替者不再需要自己的附件
+        if flight:
+            for successor_id in flight.successors:
+                blobs = request_blobs.pop(successor_id, None)
+                if blobs:
+                    blobs.release()
+            flight.start(_process_lmarena_stream(request_id, timeouts, split_sides=choice_count > 1))
+    except HTTPException:
+        release_inflight_request(request_id)
+        response_channels.pop(request_id, None)
+        raise
     except Exception as e:
         # 如果在设置过程中出错，清理通道
+        release_inflight_request(request_id)
         if request_id in response_channels:
             del response_channels[request_id]
         logger.error(f"API CALL [ID: {request_id[:8]}]: 处理请求时发生致命错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/v1/chat/completions/{response_id}/events")
+async def resume_chat_stream(response_id: str, request: Request):
+    """
+    续传流式响应：response_id 为响应块中的 id（也在响应头 X-Response-Handle 中返回），
+    从 Last-Event-ID 请求头（或 last_event_id 查询参数）之后继续发送。上游仍在运行或已经结束均可续传。
+    """
+    client = authenticate_request(request)
+    response_journals.expire(CONFIG.get("sse_journal_ttl_seconds", 300))
+    journal = response_journals.get(response_id)
+    if not journal or journal.client != client["name"]:
+        raise HTTPException(status_code=404, detail=f"响应 '{response_id}' 不存在或已过期，无法续传。")
+    raw_last_id = request.headers.get("Last-Event-ID") or request.query_params.get("last_event_id") or "0"
+    try:
+        last_event_id = int(raw_last_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Last-Event-ID 必须是整数。")
+    logger.info(f"JOURNAL [{response_id[-8:]}]: 客户端从事件 {last_event_id} 之后续传（已记录 {journal.last_seq} 个事件，上游{'已结束' if journal.done else '仍在运行'}）。")
+    return StreamingResponse(
+        stream_from_journal(journal, last_event_id),
+        media_type="text/event-stream",
+        headers={"X-Response-Handle": response_id}
+    )
+
+# --- 批量任务 (/v1/batches) ---
+# 客户端以 JSONL 提交大量离线请求，服务器保存到本地后在后台以批量优先级类别逐个执行，
+# 结果逐行追加到输出文件。服务重启后未完成的任务会从断点继续。
+batch_store = BatchStore("batches")
+batch_jobs: dict[str, BatchJob] = {}
+batch_tasks: dict[str, asyncio.Task] = {}
+batch_running = 0 # 所有批量任务当前正在执行的请求数
+batch_slot_freed = asyncio.Event()
+BATCH_RETRY_BACKOFF_MAX = 300
+
+def batch_concurrency_limit() -> int:
+    """批量请求的总并发上限。未配置时比调度器的并发上限少一个，至少为交互请求留出一个调度名额。"""
+    limit = CONFIG.get("batch_max_concurrent_requests", 0)
+    return limit if limit > 0 else max(1, request_scheduler.capacity - 1)
+
+async def acquire_batch_slot():
+    global batch_running
+    while batch_running >= batch_concurrency_limit():
+        batch_slot_freed.clear()
+        await batch_slot_freed.wait()
+    batch_running += 1
+
+def release_batch_slot(_task: asyncio.Task | None = None):
+    """作为请求任务的完成回调调用，任务在开始执行前被取消时也会归还名额。"""
+    global batch_running
+    batch_running -= 1
+    batch_slot_freed.set()
+
+def batch_client(job: BatchJob) -> dict:
+    """批量请求以提交者的身份计入用量与限流，但统一使用批量优先级类别。"""
+    priority = CONFIG.get("batch_priority_class", "bulk")
+    limits = CONFIG.get("default_rate_limits") or {}
+    for entry in CONFIG.get("api_keys") or []:
+        if (entry.get("name") or f"key-...{str(entry.get('key', ''))[-4:]}") == job.client:
+            limits = {**limits, **(entry.get("rate_limits") or {})}
+            break
+    return {"name": job.client, "priority": priority, "weight": _class_weight(priority), "rate_limits": limits}
+
+async def run_batch_request(job: BatchJob, custom_id: str, body: dict):
+    """执行批量任务中的一个请求：服务端错误与限流按指数退避重试，其余错误直接记为失败。"""
+    global last_activity_time
+    max_retries = CONFIG.get("batch_max_retries", 3)
+    backoff = CONFIG.get("batch_retry_backoff_seconds", 5)
+    attempt = 0
+    while True:
+        # 没有可用的标签页时（如服务器刚启动）等待浏览器连接，不消耗重试次数
+        while not select_browser_tab():
+            await wait_for_browser_connection(30)
+            await asyncio.sleep(1)
+        last_activity_time = datetime.now()
+        retry_after = None
+        try:
+            response = await process_chat_request({**body, "stream": False}, batch_client(job))
+            status_code = response.status_code
+            response_body = json.loads(response.body)
+        except HTTPException as e:
+            status_code = e.status_code
+            response_body = {"error": {"message": str(e.detail), "type": "bridge_error"}}
+            retry_after = (e.headers or {}).get("Retry-After")
+        except Exception as e:
+            logger.error(f"BATCH [{job.id[-8:]}]: 请求 '{custom_id}' 执行出错: {e}", exc_info=True)
+            status_code = 500
+            response_body = {"error": {"message": str(e), "type": "bridge_error"}}
+
+        if status_code == 200:
+            await job.append_result(custom_id, status_code, response_body)
+            return
+        # 限流 (429) 只是推迟执行，不消耗重试次数
+        if status_code != 429:
+            attempt += 1
+        if (status_code != 429 and status_code < 500) or attempt > max_retries:
+            message = (response_body.get("error") or {}).get("message") if isinstance(response_body, dict) else None
+            await job.append_result(custom_id, status_code, response_body, error={"code": str(status_code), "message": message or "请求失败"})
+            return
+        delay = float(retry_after) if retry_after else min(backoff * 2 ** max(attempt - 1, 0), BATCH_RETRY_BACKOFF_MAX)
+        logger.info(f"BATCH [{job.id[-8:]}]: 请求 '{custom_id}' 返回 {status_code}，{delay:.0f} 秒后重试（第 {attempt} 次）。")
+        await asyncio.sleep(delay)
+
+async def run_batch(job: BatchJob):
+    """后台执行一个批量任务，保持不超过批量并发上限的请求在途，全部结束后标记完成。"""
+    pending: set[asyncio.Task] = set()
+    try:
+        done_ids = await asyncio.to_thread(job.finished_ids)
+        if job.status != "in_progress":
+            await job.set_status("in_progress")
+        logger.info(f"BATCH [{job.id[-8:]}]: 开始执行，共 {job.total} 个请求，已完成 {len(done_ids)} 个。")
+        for custom_id, body in job.iter_requests():
+            if custom_id in done_ids:
+                continue
+            await acquire_batch_slot()
+            task = asyncio.create_task(run_batch_request(job, custom_id, body))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            task.add_done_callback(release_batch_slot)
+        if pending:
+            await asyncio.gather(*list(pending))
+        await job.set_status("completed")
+        logger.info(f"BATCH [{job.id[-8:]}]: 已完成，成功 {job.completed} 个，失败 {job.failed} 个。")
+    except asyncio.CancelledError:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if job.status == "cancelling":
+            await job.set_status("cancelled")
+            logger.info(f"BATCH [{job.id[-8:]}]: 已取消，成功 {job.completed} 个，失败 {job.failed} 个。")
+        else:
+            # 服务器关闭：保持 in_progress，下次启动时从断点继续
+            await job.save()
+        raise
+    except Exception as e:
+        logger.error(f"BATCH [{job.id[-8:]}]: 执行失败: {e}", exc_info=True)
+        job.errors = [{"code": "batch_failed", "message": str(e)}]
+        await job.set_status("failed")
+    finally:
+        batch_tasks.pop(job.id, None)
+
+def start_batch(job: BatchJob):
+    batch_tasks[job.id] = asyncio.create_task(run_batch(job))
+
+async def resume_batches():
+    """启动时加载磁盘上的任务，继续执行未完成的任务。"""
+    for job in await asyncio.to_thread(batch_store.load_all):
+        batch_jobs[job.id] = job
+        if job.status == "validating":
+            # 上传过程中服务器退出，输入不完整
+            job.errors = [{"code": "upload_incomplete", "message": "输入文件上传未完成。"}]
+            await job.set_status("failed")
+        elif job.status == "cancelling":
+            await job.set_status("cancelled")
+        elif job.status == "in_progress":
+            logger.info(f"BATCH [{job.id[-8:]}]: 服务器重启前未完成，继续执行。")
+            start_batch(job)
+
+async def stop_batches():
+    """服务器关闭时停止后台任务，任务保持 in_progress 状态以便下次启动后继续。"""
+    tasks = list(batch_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def get_batch_for_client(batch_id: str, client: dict) -> BatchJob:
+    job = batch_jobs.get(batch_id)
+    if not job or job.client != client["name"]:
+        raise HTTPException(status_code=404, detail=f"批量任务 '{batch_id}' 不存在。")
+    return job
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    """
+    创建批量任务。请求体直接是 JSONL 输入（每行 {"custom_id", "method", "url", "body"}，与 OpenAI 批量输入格式相同），
+    以流式方式写入磁盘并逐行校验。可选的查询参数 metadata 为 JSON 对象。
+    """
+    client = authenticate_request(request)
+    if server_draining:
+        raise HTTPException(status_code=503, detail="服务器正在关闭或重启，请稍后重试。")
+    metadata = None
+    if request.query_params.get("metadata"):
+        try:
+            metadata = json.loads(request.query_params["metadata"])
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="metadata 必须是 JSON 对象。")
+    job = await batch_store.create(client["name"], metadata if isinstance(metadata, dict) else None)
+    max_requests = CONFIG.get("batch_max_requests", 50000)
+    seen_ids: set[str] = set()
+    remainder = b""
+    try:
+        with open(job.input_path, 'w', encoding='utf-8') as f:
+            async for chunk in request.stream():
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                # 校验与写盘在线程中进行，大文件上传不会阻塞事件循环
+                await asyncio.to_thread(batch_store.write_input_lines, job, f, lines, seen_ids, max_requests)
+            await asyncio.to_thread(batch_store.write_input_lines, job, f, [remainder], seen_ids, max_requests)
+    except (BatchInputError, UnicodeDecodeError) as e:
+        await asyncio.to_thread(batch_store.delete, job)
+        raise HTTPException(status_code=400, detail=f"批量输入无效: {e}")
+    except BaseException:
+        await asyncio.to_thread(batch_store.delete, job)
+        raise
+    if not job.total:
+        await asyncio.to_thread(batch_store.delete, job)
+        raise HTTPException(status_code=400, detail="批量输入为空。")
+
+    batch_jobs[job.id] = job
+    await job.set_status("in_progress")
+    start_batch(job)
+    logger.info(f"BATCH [{job.id[-8:]}]: 调用方 '{client['name']}' 提交了 {job.total} 个请求。")
+    return JSONResponse(job.to_openai())
+
+@app.get("/v1/batches")
+async def list_batches(request: Request, limit: int = 20):
+    client = authenticate_request(request)
+    jobs = [job for job in batch_jobs.values() if job.client == client["name"]]
+    jobs.sort(key=lambda job: job.created_at, reverse=True)
+    return {
+        "object": "list",
+        "data": [job.to_openai() for job in jobs[:limit]],
+        "has_more": len(jobs) > limit,
+    }
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    return get_batch_for_client(batch_id, authenticate_request(request)).to_openai()
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    """取消任务：在途请求被中止，已写入的结果保留。"""
+    job = get_batch_for_client(batch_id, authenticate_request(request))
+    if job.finished or job.status == "cancelling":
+        return job.to_openai()
+    await job.set_status("cancelling")
+    task = batch_tasks.get(job.id)
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    else:
+        await job.set_status("cancelled")
+    return job.to_openai()
+
+@app.get("/v1/batches/{batch_id}/output")
+async def get_batch_output(batch_id: str, request: Request):
+    """下载已完成请求的结果（JSONL），任务执行期间也可下载当前已有的部分。"""
+    job = get_batch_for_client(batch_id, authenticate_request(request))
+    if not os.path.exists(job.output_path):
+        return Response(content=b"", media_type="application/jsonl")
+    return FileResponse(job.output_path, media_type="application/jsonl")
+
+@app.get("/v1/batches/{batch_id}/errors")
+async def get_batch_errors(batch_id: str, request: Request):
+    """下载失败请求的记录（JSONL）。"""
+    job = get_batch_for_client(batch_id, authenticate_request(request))
+    if not os.path.exists(job.error_path):
+        return Response(content=b"", media_type="application/jsonl")
+    return FileResponse(job.error_path, media_type="application/jsonl")
+
 # --- 内部通信端点 ---
+@dataclass
+class IdCaptureJob:
+    """一次批量 ID 捕获任务：标签页每捕获一对 ID 就通过 WebSocket 上报，直接加入模型的会话池。"""
+    job_id: str
+    model: str
+    count: int
+    mode: str
+    battle_target: str | None
+    tab_id: str
+    captured: list[dict] = field(default_factory=list)
+    duplicates: int = 0
+    status: str = "running" # running / completed / expired / cancelled
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+
+    def end(self, status: str):
+        self.status = status
+        self.finished_at = time.time()
+
+# id_capture_jobs 记录批量 ID 捕获任务，键是 job_id。
+id_capture_jobs: dict[str, IdCaptureJob] = {}
+ID_CAPTURE_JOB_RETENTION_SECONDS = 3600 # 已结束的任务保留多久供查询进度，之后在启动新任务时删除
+
+def prune_capture_jobs():
+    cutoff = time.time() - ID_CAPTURE_JOB_RETENTION_SECONDS
+    for job_id in [j.job_id for j in id_capture_jobs.values() if j.finished_at and j.finished_at < cutoff]:
+        del id_capture_jobs[job_id]
+
+async def record_captured_id(tab: BrowserTab, message: dict):
+    """处理标签页上报的一对 ID：加入内存中的端点映射并原子地持久化。"""
+    job = id_capture_jobs.get(message.get("job_id"))
+    session_id, message_id = message.get("session_id"), message.get("message_id")
+    if not job or job.status != "running" or not session_id or not message_id:
+        logger.warning(f"ID CAPTURE: 忽略来自标签页 {tab.tab_id[:8]} 的无效或过期的 ID 上报: {message}")
+        return
+
+    mapping = {"session_id": session_id, "message_id": message_id, "mode": job.mode}
+    if job.mode == "battle":
+        mapping["battle_target"] = job.battle_target or "A"
+    if not add_model_endpoint(job.model, mapping):
+        job.duplicates += 1
+        logger.info(f"ID CAPTURE [{job.job_id[:8]}]: Session ID ...{session_id[-6:]} 已在模型 '{job.model}' 的会话池中，跳过。")
+        return
+
+    job.captured.append(mapping)
+    logger.info(f"ID CAPTURE [{job.job_id[:8]}]: 为模型 '{job.model}' 捕获到第 {len(job.captured)}/{job.count} 对 ID (Session ID: ...{session_id[-6:]})。")
+    try:
+        await save_model_endpoint_map()
+    except OSError as e:
+        logger.error(f"ID CAPTURE: 写入 'model_endpoint_map.json' 失败: {e}")
+
+    if len(job.captured) >= job.count:
+        await finish_capture_job(job, "completed")
+
+async def finish_capture_job(job: IdCaptureJob, status: str):
+    if job.status != "running":
+        return
+    job.end(status)
+    logger.info(f"ID CAPTURE [{job.job_id[:8]}]: 任务结束（{status}），共为模型 '{job.model}' 新增 {len(job.captured)} 对 ID。")
+    tab = browser_tabs.get(job.tab_id)
+    if tab:
+        try:
+            await tab.send_json({"command": "deactivate_id_capture", "job_id": job.job_id})
+        except Exception:
+            pass
+
+async def expire_capture_job(job: IdCaptureJob, timeout: float):
+    await asyncio.sleep(timeout)
+    await finish_capture_job(job, "expired")
+
 @app.post("/internal/start_id_capture")
-async def start_id_capture():
+async def start_id_capture(request: Request):
     """
-    接收来自 id_updater.py 的通知，并通过 WebSocket 指令
     激活油猴脚本的 ID 捕获模式。
+
+    - 无请求体：旧行为，标签页把捕获到的一对 ID 发送给 id_updater.py 的临时服务器。
+    - 请求体 {"model", "count", "mode", "battle_target", "timeout_seconds"}：批量捕获，
+      标签页把每对 ID 通过 WebSocket 上报，服务器直接加入该模型的会话池并写回 model_endpoint_map.json。
     """
-    if not browser_ws:
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        body = {}
+    body = body if isinstance(body, dict) else {}
+
+    tab = browser_tabs.get(body["tab_id"]) if body.get("tab_id") else select_browser_tab()
+    if not tab:
         logger.warning("ID CAPTURE: 收到激活请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
-    
+
+    command = {"command": "activate_id_capture"}
+    job = None
+    if body.get("model"):
+        if not isinstance(body["model"], str):
+            raise HTTPException(status_code=400, detail="model 必须是字符串。")
+        mode = body.get("mode", CONFIG.get("id_updater_last_mode", "direct_chat"))
+        if mode not in ("direct_chat", "battle"):
+            raise HTTPException(status_code=400, detail="mode 必须是 'direct_chat' 或 'battle'。")
+        battle_target = str(body.get("battle_target", CONFIG.get("id_updater_battle_target", "A"))).upper() if mode == "battle" else None
+        if battle_target not in (None, "A", "B"):
+            raise HTTPException(status_code=400, detail="battle_target 必须是 'A' 或 'B'。")
+        count = body.get("count", 1)
+        if isinstance(count, str) and count.strip().isdigit():
+            count = int(count)
+        if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            raise HTTPException(status_code=400, detail="count 必须是正整数。")
+        timeout = body.get("timeout_seconds", CONFIG.get("id_capture_timeout_seconds", 600))
+        if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0:
+            raise HTTPException(status_code=400, detail="timeout_seconds 必须是正数。")
+        prune_capture_jobs()
+        # 同一标签页上尚未结束的旧任务会被新任务取代
+        for old_job in id_capture_jobs.values():
+            if old_job.tab_id == tab.tab_id and old_job.status == "running":
+                old_job.end("cancelled")
+        job = IdCaptureJob(
+            job_id=str(uuid.uuid4()), model=body["model"], count=count,
+            mode=mode, battle_target=battle_target, tab_id=tab.tab_id
+        )
+        id_capture_jobs[job.job_id] = job
+        command.update(job_id=job.job_id, count=count)
+
     try:
-        logger.info("ID CAPTURE: 收到激活请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
+        logger.info(f"ID CAPTURE: 收到激活请求，正在通过 WebSocket 向标签页 {tab.tab_id[:8]} 发送指令...")
+        await tab.send_json(command)
         logger.info("ID CAPTURE: 激活指令已成功发送。")
-        return JSONResponse({"status": "success", "message": "Activation command sent."})
     except Exception as e:
+        if job:
+            job.end("cancelled")
         logger.error(f"ID CAPTURE: 发送激活指令时出错: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Failed to send command via WebSocket.")
 
+    if not job:
+        return JSONResponse({"status": "success", "message": "Activation command sent."})
+    asyncio.create_task(expire_capture_job(job, timeout))
+    logger.info(f"ID CAPTURE [{job.job_id[:8]}]: 开始为模型 '{job.model}' 捕获 {job.count} 对 ID（模式: {job.mode}{', 目标: ' + job.battle_target if job.battle_target else ''}）。")
+    return JSONResponse({"status": "success", "job_id": job.job_id, "tab_id": tab.tab_id})
+
+@app.get("/internal/id_capture/{job_id}")
+async def id_capture_status(job_id: str):
+    """查询批量 ID 捕获任务的进度。已结束的任务保留 ID_CAPTURE_JOB_RETENTION_SECONDS 秒。"""
+    job = id_capture_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="ID capture job not found.")
+    pool = MODEL_ENDPOINT_MAP.get(job.model)
+    return {
+        "job_id": job.job_id,
+        "model": job.model,
+        "status": job.status,
+        "count": job.count,
+        "captured": job.captured,
+        "duplicates": job.duplicates,
+        "pool_size": len(pool) if isinstance(pool, list) else int(bool(pool)),
+    }
+
+@app.post("/internal/tabs/{tab_id}/drain")
+async def drain_browser_tab(tab_id: str):
+    """
+    让标签页进入排空模式（docker_browser_runner.py 缩容前调用）：立即停止向它分配新请求，已分配的请求继续完成。
+    连接保持打开，调用方在 pending_requests 归零后关闭页面；超过 tab_drain_timeout_seconds 时剩余请求转移到其他标签页。
+    """
+    tab = browser_tabs.get(tab_id)
+    if not tab:
+        raise HTTPException(status_code=404, detail="Tab not found.")
+    if not tab.draining and tab.healthy:
+        tab.draining = True
+        tab.close_when_drained = False
+        if tab.pending_requests:
+            asyncio.create_task(wait_tab_drained(tab, "按外部请求缩容"))
+        else:
+            logger.info(f"标签页 {tab.tab_id[:8]} 按外部请求缩容，没有进行中的请求，等待外部关闭页面。")
+    return {"tab_id": tab.tab_id, "draining": tab.draining, "pending_requests": len(tab.pending_requests)}
+
+@app.get("/internal/tabs")
+async def list_browser_tabs():
+    """列出已连接的标签页及其健康状态与心跳往返时间，供路由与监控使用。"""
+    now = time.monotonic()
+    return {
+        "tabs": [
+            {
+                "tab_id": tab.tab_id,
+                "healthy": tab.healthy,
+                "draining": tab.draining,
+                "capabilities": sorted(tab.capabilities),
+                "connected_seconds": round(now - tab.connected_at, 1),
+                "pending_requests": len(tab.pending_requests),
+                "max_concurrent": tab.max_concurrent,
+                "browser_active": tab.browser_active,
+                "browser_queued": tab.browser_queued,
+                "missed_heartbeats": tab.missed_heartbeats,
+                "busy_seconds": tab.load_snapshot()["busy_seconds"],
+                "recent_errors": list(tab.recent_errors),
+                "rtt_ms": {
+                    "last": round(tab.rtt_history[-1] * 1000, 1) if tab.rtt_history else None,
+                    "avg": round(tab.average_rtt * 1000, 1) if tab.rtt_history else None,
+                    "max": round(max(tab.rtt_history) * 1000, 1) if tab.rtt_history else None,
+                },
+            }
+            for tab in browser_tabs.values()
+        ]
+    }
+
+@app.get("/internal/usage")
+async def usage_status():
+    """返回自启动以来每个调用方的累计用量与当前并发请求数。"""
+    return {
+        "clients": {
+            client: {**counters, "concurrent_requests": rate_limiter.concurrent(client)}
+            for client, counters in usage_tracker.totals.items()
+        }
+    }
+
+@app.get("/internal/scheduler")
+async def scheduler_status():
+    """
+    返回调度器的并发、排队深度、每个优先级类别的排队时间统计、会话通道占用情况，
+    以及每个标签页的负载（供 docker_browser_runner.py 按队列自动增减标签页）。
+    """
+    snapshot = request_scheduler.snapshot()
+    return {
+        **snapshot,
+        "utilization": round(snapshot["running"] / snapshot["capacity"], 3) if snapshot["capacity"] else None,
+        "session_lanes": session_lanes.snapshot(),
+        "tabs": [tab.load_snapshot() for tab in browser_tabs.values()],
+    }
+
+
+# --- 优雅关闭 ---
+class DrainingServer(uvicorn.Server):
+    """
+    收到第一次退出信号时先进入排空模式：新请求返回 503，进行中的请求在
+    shutdown_drain_timeout_seconds 内继续完成，之后再真正关闭。再次收到信号则立即关闭。
+    """
+    async def startup(self, sockets=None):
+        self._loop = asyncio.get_running_loop()
+        await super().startup(sockets=sockets)
+
+    def handle_exit(self, sig, frame):
+        global server_draining
+        if server_draining:
+            # 排空期间（或排空结束后等待连接关闭时）再次收到信号：不再等待任何请求
+            self.force_exit = True
+            return super().handle_exit(sig, frame)
+        if not response_channels or not getattr(self, "_loop", None):
+            return super().handle_exit(sig, frame)
+        server_draining = True
+        logger.warning(f"收到退出信号，进入排空模式：等待 {len(response_channels)} 个进行中的请求完成。再次按 Ctrl+C 可立即退出。")
+        self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._drain_then_exit(sig, frame)))
+
+    async def _drain_then_exit(self, sig, frame):
+        if await drain_inflight_requests(CONFIG.get("shutdown_drain_timeout_seconds", 30)):
+            logger.info("所有进行中的请求已完成，服务器正在关闭。")
+        else:
+            logger.warning("排空超时，剩余请求将被中断。")
+        super().handle_exit(sig, frame)
 
 # --- 主程序入口 ---
 if __name__ == "__main__":
@@ -1066,4 +2811,5 @@ if __name__ == "__main__":
     logger.info(f"   - 监听地址: http://127.0.0.1:{api_port}")
     logger.info(f"   - WebSocket 端点: ws://127.0.0.1:{api_port}/ws")
     
-    uvicorn.run(app, host="0.0.0.0", port=api_port)
+    server = DrainingServer(uvicorn.Config(app, host="0.0.0.0", port=api_port))
+    server.run()
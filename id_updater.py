@@ -3,57 +3,49 @@
 # 这是一个经过升级的、一次性的HTTP服务器，用于根据用户选择的模式
 # (DirectChat 或 Battle) 接收来自油猴脚本的会话信息，
 # 并将其更新到 config.jsonc 文件中。
+#
+# 指定 --model 时进入批量捕获模式：不再启动临时服务器，而是让主服务器
+# 为该模型捕获 N 对 ID 并直接加入 model_endpoint_map.json 的会话池，例如：
+#   python id_updater.py --model gpt-4o --count 5 --mode direct_chat
 
+import argparse
 import http.server
 import socketserver
 import json
-import re
 import threading
+import time
 import os
 import requests
 
+from modules.config_store import ConfigStore
+
 # --- 配置 ---
 HOST = "127.0.0.1"
 PORT = 5103
 CONFIG_PATH = 'config.jsonc'
+API_SERVER_URL = "http://127.0.0.1:5102"
+config_store = ConfigStore(CONFIG_PATH)
 
 def read_config():
-    """读取并解析 config.jsonc 文件，移除注释以便解析。"""
+    """读取并解析 config.jsonc 文件。"""
     if not os.path.exists(CONFIG_PATH):
         print(f"❌ 错误：配置文件 '{CONFIG_PATH}' 不存在。")
         return None
     try:
-        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-            # 正则表达式移除行注释和块注释
-            content = re.sub(r'//.*', '', f.read())
-            content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-            return json.loads(content)
-    except Exception as e:
+        return config_store.load()
+    except (OSError, ValueError) as e:
         print(f"❌ 读取或解析 '{CONFIG_PATH}' 时发生错误: {e}")
         return None
 
 def save_config_value(key, value):
     """
-    安全地更新 config.jsonc 中的单个键值对，保留原始格式和注释。
-    仅适用于值为字符串或数字的情况。
+    更新 config.jsonc 中的单个键值对，保留原始格式和注释。
+    文件以原子替换的方式写入，正在运行的主服务器会自动加载新配置。
     """
     try:
-        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # 使用正则表达式安全地替换值
-        # 它会查找 "key": "any value" 并替换 "any value"
-        pattern = re.compile(rf'("{key}"\s*:\s*")[^"]*(")')
-        new_content, count = pattern.subn(rf'\g<1>{value}\g<2>', content, 1)
-
-        if count == 0:
-            print(f"🤔 警告: 未能在 '{CONFIG_PATH}' 中找到键 '{key}'。")
-            return False
-
-        with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-            f.write(new_content)
+        config_store.update({key: value})
         return True
-    except Exception as e:
+    except (OSError, ValueError) as e:
         print(f"❌ 更新 '{CONFIG_PATH}' 时发生错误: {e}")
         return False
 
@@ -138,7 +130,7 @@ def run_server():
 
 def notify_api_server():
     """通知主 API 服务器，ID 更新流程已开始。"""
-    api_server_url = "http://127.0.0.1:5102/internal/start_id_capture"
+    api_server_url = f"{API_SERVER_URL}/internal/start_id_capture"
     try:
         response = requests.post(api_server_url, timeout=3)
         if response.status_code == 200:
@@ -155,7 +147,56 @@ def notify_api_server():
         print(f"❌ 通知主服务器时发生未知错误: {e}")
         return False
 
+def run_bulk_capture(args):
+    """批量捕获：通知主服务器开始任务，并轮询进度直到任务结束。"""
+    body = {"model": args.model, "count": args.count, "timeout_seconds": args.timeout}
+    if args.mode:
+        body["mode"] = args.mode
+    if args.battle_target:
+        body["battle_target"] = args.battle_target
+    try:
+        response = requests.post(f"{API_SERVER_URL}/internal/start_id_capture", json=body, timeout=5)
+    except requests.ConnectionError:
+        print("❌ 无法连接到主 API 服务器。请确保 api_server.py 正在运行。")
+        return False
+    if response.status_code != 200:
+        print(f"⚠️ 启动批量捕获失败，状态码: {response.status_code}。")
+        print(f"   - 错误信息: {response.text}")
+        return False
+
+    job_id = response.json()["job_id"]
+    print(f"✅ 已开始为模型 '{args.model}' 批量捕获 {args.count} 对 ID (任务: {job_id[:8]})。")
+    print("   请在浏览器中依次对不同消息点击 'Retry' 按钮，捕获到的 ID 会直接加入会话池。")
+
+    reported = 0
+    while True:
+        time.sleep(2)
+        try:
+            status = requests.get(f"{API_SERVER_URL}/internal/id_capture/{job_id}", timeout=5).json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"⚠️ 查询任务进度失败: {e}")
+            continue
+        for mapping in status["captured"][reported:]:
+            reported += 1
+            print(f"  🎉 [{reported}/{status['count']}] Session ID: {mapping['session_id']}  Message ID: {mapping['message_id']}")
+        if status["status"] != "running":
+            print(f"任务结束（{status['status']}）：新增 {len(status['captured'])} 对 ID，模型 '{args.model}' 的会话池现有 {status['pool_size']} 个会话。")
+            return status["status"] == "completed"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="捕获 LMArena 会话 ID")
+    parser.add_argument("--model", help="批量捕获模式：为该模型捕获 ID 并加入 model_endpoint_map.json")
+    parser.add_argument("--count", type=int, default=1, help="批量捕获的 ID 对数（默认 1）")
+    parser.add_argument("--mode", choices=["direct_chat", "battle"], help="捕获到的会话所使用的模式（默认使用 config.jsonc 中上次的选择）")
+    parser.add_argument("--battle-target", choices=["A", "B"], help="Battle 模式下的目标消息")
+    parser.add_argument("--timeout", type=int, default=600, help="批量捕获的超时时间（秒，默认 600）")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.model:
+        exit(0 if run_bulk_capture(args) else 1)
+
     config = read_config()
     if not config:
         exit(1)
@@ -0,0 +1,132 @@
+# attachment_processor.py
+# 附件预处理：超过大小限制的图片在进程池中缩小并重新压缩，结果按内容哈希缓存
+
+import asyncio
+import base64
+import hashlib
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError: # Pillow 未安装时无法压缩图片，过大的图片会被直接拒绝
+    Image = None
+
+# 依次尝试的缩放比例（相对于限制最长边之后的尺寸）与压缩质量，取第一个不超过大小限制的结果
+SHRINK_SCALES = (1.0, 0.75, 0.5, 0.35, 0.25)
+SHRINK_QUALITIES = (85, 70, 55)
+# 缓存条目数上限（无法压缩的结果不占缓存字节数，单独限制条目数）
+CACHE_MAX_ENTRIES = 1024
+
+
+def decoded_size(header: str, encoded_length: int) -> int:
+    """根据 data: URL 的头部与数据部分的长度估算附件解码后的字节数。"""
+    if ";base64" in header:
+        return encoded_length * 3 // 4
+    return encoded_length
+
+
+def shrink_image(encoded: str, max_bytes: int, max_dimension: int) -> tuple[bytes, str] | None:
+    """
+    在工作进程中执行：解码 base64 图片，限制最长边后逐步降低尺寸与质量重新编码，
+    返回 (图片数据, MIME 类型)。无法识别的图片、动图或无法压缩到 max_bytes 以内时返回 None。
+    """
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as image:
+            if getattr(image, "is_animated", False):
+                return None
+            # JPEG 可以在解码时直接按比例缩小，大图能省下大部分解码时间
+            image.draft("RGB", (max_dimension, max_dimension))
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+            # 带透明通道的图片用 WebP 保留透明度，其余转为 JPEG
+            image_format, content_type = ("WEBP", "image/webp") if has_alpha else ("JPEG", "image/jpeg")
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        for scale in SHRINK_SCALES:
+            if scale == 1.0:
+                candidate = image
+            else:
+                candidate = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+            for quality in SHRINK_QUALITIES:
+                output = io.BytesIO()
+                candidate.save(output, image_format, quality=quality)
+                if output.tell() <= max_bytes:
+                    return output.getvalue(), content_type
+    except Exception:
+        return None
+    return None
+
+
+class AttachmentProcessor:
+    """
+    管理压缩图片的进程池与结果缓存。缓存键为原图内容与压缩参数的哈希，
+    同一张图片（客户端重试、多轮对话反复携带）只压缩一次，无法压缩的结果同样被缓存。
+    """
+
+    def __init__(self):
+        self.workers = 2
+        self.cache_limit = 64 * 1024 * 1024
+        self._pool: ProcessPoolExecutor | None = None
+        self._cache: OrderedDict[str, tuple[bytes, str] | None] = OrderedDict()
+        self._cache_bytes = 0
+        self._pending: dict[str, asyncio.Task] = {}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def configure(self, workers: int, cache_limit: int):
+        """更新进程数与缓存上限。进程数变化时旧进程池在当前任务完成后关闭，新进程池在下次使用时创建。"""
+        workers = max(1, workers)
+        if workers != self.workers and self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        self.workers = workers
+        self.cache_limit = max(0, cache_limit)
+        self._evict()
+
+    async def shrink(self, encoded: str, max_bytes: int, max_dimension: int) -> tuple[bytes, str] | None:
+        """
+        返回压缩后的 (图片数据, MIME 类型)，无法压缩到 max_bytes 以内时返回 None。
+        压缩在由本对象持有的独立任务中进行，发起压缩的请求被取消不会影响等待同一张图片的其他请求。
+        """
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(encoded.encode("ascii", "replace")).hexdigest())
+        key = f"{digest}:{max_bytes}:{max_dimension}"
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run(key, encoded, max_bytes, max_dimension))
+            self._pending[key] = task
+            task.add_done_callback(lambda t: self._run_done(key, t))
+        return await asyncio.shield(task)
+
+    async def _run(self, key: str, encoded: str, max_bytes: int, max_dimension: int) -> tuple[bytes, str] | None:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        result = await asyncio.get_running_loop().run_in_executor(self._pool, shrink_image, encoded, max_bytes, max_dimension)
+        self._remember(key, result)
+        return result
+
+    def _run_done(self, key: str, task: asyncio.Task):
+        if self._pending.get(key) is task:
+            del self._pending[key]
+        if not task.cancelled():
+            task.exception() # 所有等待者都已离开时避免 "exception was never retrieved" 警告
+
+    def _remember(self, key: str, result: tuple[bytes, str] | None):
+        self._cache[key] = result
+        self._cache_bytes += len(result[0]) if result else 0
+        self._evict()
+
+    def _evict(self):
+        while self._cache and (self._cache_bytes > self.cache_limit or len(self._cache) > CACHE_MAX_ENTRIES):
+            _, result = self._cache.popitem(last=False)
+            self._cache_bytes -= len(result[0]) if result else 0
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
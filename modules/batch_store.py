@@ -0,0 +1,233 @@
+# batch_store.py
+# 批量任务 (/v1/batches) 的本地存储：每个任务一个目录，保存输入、输出、错误 JSONL 以及任务状态
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from modules.config_store import write_file_atomic
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+STATE_SAVE_INTERVAL = 1.0 # 进度计数最多每秒写盘一次，状态变化时立即写盘
+
+
+class BatchInputError(ValueError):
+    """输入 JSONL 中的某一行无效。"""
+
+
+def parse_batch_line(line: str, line_number: int, seen_ids: set[str]) -> dict:
+    """校验一行输入（OpenAI 批量格式：custom_id / method / url / body），返回解析后的对象。"""
+    try:
+        item = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise BatchInputError(f"第 {line_number} 行不是有效的 JSON: {e}")
+    if not isinstance(item, dict):
+        raise BatchInputError(f"第 {line_number} 行必须是 JSON 对象。")
+    custom_id = item.get("custom_id")
+    if not isinstance(custom_id, str) or not custom_id:
+        raise BatchInputError(f"第 {line_number} 行缺少字符串类型的 custom_id。")
+    if custom_id in seen_ids:
+        raise BatchInputError(f"第 {line_number} 行的 custom_id '{custom_id}' 重复。")
+    if item.get("method", "POST").upper() != "POST":
+        raise BatchInputError(f"第 {line_number} 行的 method 必须是 POST。")
+    if item.get("url", BATCH_ENDPOINT) != BATCH_ENDPOINT:
+        raise BatchInputError(f"第 {line_number} 行的 url 必须是 {BATCH_ENDPOINT}。")
+    body = item.get("body")
+    if not isinstance(body, dict) or not isinstance(body.get("messages"), list):
+        raise BatchInputError(f"第 {line_number} 行的 body 必须是包含 messages 列表的聊天请求。")
+    seen_ids.add(custom_id)
+    return item
+
+
+def _append_line(path: str, line: str):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+@dataclass
+class BatchJob:
+    """
+    一个批量任务。计数与时间戳保存在任务目录的 batch.json 中，输出逐行追加到 output.jsonl / errors.jsonl。
+    状态修改在事件循环中进行，文件写入在线程中执行；同一任务的状态写入依次进行，磁盘上总是最新的快照。
+    """
+    id: str
+    client: str
+    directory: str
+    status: str = "validating"
+    created_at: int = field(default_factory=lambda: int(time.time()))
+    in_progress_at: int | None = None
+    completed_at: int | None = None
+    failed_at: int | None = None
+    cancelling_at: int | None = None
+    cancelled_at: int | None = None
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+    metadata: dict | None = None
+    errors: list | None = None
+    _saved_at: float = field(default=0.0, repr=False)
+    _save_lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    _STATE_FIELDS = (
+        "id", "client", "status", "created_at", "in_progress_at", "completed_at", "failed_at",
+        "cancelling_at", "cancelled_at", "total", "completed", "failed", "metadata", "errors",
+    )
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.directory, "input.jsonl")
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.directory, "output.jsonl")
+
+    @property
+    def error_path(self) -> str:
+        return os.path.join(self.directory, "errors.jsonl")
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, "batch.json")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    async def set_status(self, status: str):
+        """切换状态，记录对应的时间戳并立即写盘。"""
+        self.status = status
+        stamp = f"{status}_at"
+        if stamp in self._STATE_FIELDS and getattr(self, stamp) is None:
+            setattr(self, stamp, int(time.time()))
+        await self.save()
+
+    async def save(self, force: bool = True):
+        """在线程中写入 batch.json。force 为 False 时距上次写入不足 STATE_SAVE_INTERVAL 秒则跳过。"""
+        now = time.monotonic()
+        if not force and now - self._saved_at < STATE_SAVE_INTERVAL:
+            return
+        self._saved_at = now
+        async with self._save_lock:
+            # 在锁内取快照，等待期间发生的修改也会被写入
+            state = json.dumps({name: getattr(self, name) for name in self._STATE_FIELDS}, ensure_ascii=False, indent=2)
+            await asyncio.to_thread(write_file_atomic, self.state_path, state)
+
+    @classmethod
+    def load(cls, directory: str) -> "BatchJob":
+        with open(os.path.join(directory, "batch.json"), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return cls(directory=directory, **{k: v for k, v in state.items() if k in cls._STATE_FIELDS})
+
+    def iter_requests(self):
+        """逐行读取输入，产生 (custom_id, body)。文件按需读取，几万行的任务也不会整体载入内存。"""
+        with open(self.input_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    yield item["custom_id"], item["body"]
+
+    def finished_ids(self) -> set[str]:
+        """已写入输出或错误文件的 custom_id，用于服务重启后从断点继续。"""
+        done = set()
+        for path in (self.output_path, self.error_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line)["custom_id"])
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # 进程在写入一半时退出，留下的残行对应的请求会重新执行
+                        continue
+        return done
+
+    async def append_result(self, custom_id: str, status_code: int | None, body: dict | None, error: dict | None = None):
+        """在线程中追加一条结果：成功写入 output.jsonl，失败写入 errors.jsonl。"""
+        record = {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "body": body} if status_code is not None else None,
+            "error": error,
+        }
+        path = self.error_path if error else self.output_path
+        await asyncio.to_thread(_append_line, path, json.dumps(record, ensure_ascii=False) + "\n")
+        if error:
+            self.failed += 1
+        else:
+            self.completed += 1
+        await self.save(force=False)
+
+    def to_openai(self) -> dict:
+        """转换为 OpenAI 的 batch 对象。"""
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": BATCH_ENDPOINT,
+            "errors": {"object": "list", "data": self.errors} if self.errors else None,
+            "input_file_id": f"{self.id}-input",
+            "completion_window": "24h",
+            "status": self.status,
+            "output_file_id": f"{self.id}-output" if self.completed else None,
+            "error_file_id": f"{self.id}-errors" if self.failed else None,
+            "created_at": self.created_at,
+            "in_progress_at": self.in_progress_at,
+            "completed_at": self.completed_at,
+            "failed_at": self.failed_at,
+            "cancelling_at": self.cancelling_at,
+            "cancelled_at": self.cancelled_at,
+            "request_counts": {"total": self.total, "completed": self.completed, "failed": self.failed},
+            "metadata": self.metadata,
+        }
+
+
+class BatchStore:
+    """管理批量任务目录。"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    async def create(self, client: str, metadata: dict | None = None) -> BatchJob:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        directory = os.path.join(self.root, batch_id)
+        await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+        job = BatchJob(id=batch_id, client=client, directory=directory, metadata=metadata)
+        await job.save()
+        return job
+
+    def write_input_lines(self, job: BatchJob, f, lines: list[bytes], seen_ids: set[str], max_requests: int):
+        """校验并写入一组输入行（在线程中调用）。空行忽略。"""
+        for line in lines:
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            if max_requests > 0 and job.total >= max_requests:
+                raise BatchInputError(f"单个批量任务最多包含 {max_requests} 个请求。")
+            item = parse_batch_line(line, job.total + 1, seen_ids)
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            job.total += 1
+
+    def delete(self, job: BatchJob):
+        shutil.rmtree(job.directory, ignore_errors=True)
+
+    def load_all(self) -> list[BatchJob]:
+        """加载磁盘上的全部任务，按创建时间排序。无法读取的目录会被跳过。"""
+        if not os.path.isdir(self.root):
+            return []
+        jobs = []
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if not os.path.isfile(os.path.join(directory, "batch.json")):
+                continue
+            try:
+                jobs.append(BatchJob.load(directory))
+            except (OSError, ValueError, TypeError) as e:
+                logger.error(f"无法加载批量任务 '{name}': {e}")
+        return sorted(jobs, key=lambda job: job.created_at)
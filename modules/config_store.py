@@ -0,0 +1,231 @@
+# config_store.py
+# config.jsonc 的统一读写：只在文件变化时解析一次，修改以版本化快照的形式生效，
+# 写入时保留注释，并通过临时文件 + 原子替换避免读到写了一半的文件。
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def strip_jsonc_comments(text: str) -> str:
+    """
+    把 // 行注释和 /* */ 块注释替换为等长的空白（保留换行），字符串中的内容不受影响。
+    返回的文本与原文逐字符对齐，可以用来在原文中定位值的位置。
+    """
+    out = list(text)
+    i, n = 0, len(text)
+    in_string = False
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if ch == '\\':
+                i += 2
+                continue
+            if ch == '"':
+                in_string = False
+            i += 1
+        elif ch == '"':
+            in_string = True
+            i += 1
+        elif text.startswith('//', i):
+            end = text.find('\n', i)
+            end = n if end == -1 else end
+            for j in range(i, end):
+                out[j] = ' '
+            i = end
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            end = n if end == -1 else end + 2
+            for j in range(i, end):
+                if out[j] != '\n':
+                    out[j] = ' '
+            i = end
+        else:
+            i += 1
+    return "".join(out)
+
+
+def _blank_trailing_commas(text: str) -> str:
+    """把紧挨着 } 或 ] 的尾随逗号替换为空格（位置不变），输入应已去掉注释。"""
+    out = list(text)
+    i, n = 0, len(text)
+    in_string = False
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if ch == '\\':
+                i += 2
+                continue
+            if ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == ',':
+            j = _skip_whitespace(text, i + 1)
+            if j < n and text[j] in '}]':
+                out[i] = ' '
+        i += 1
+    return "".join(out)
+
+
+def _strip_jsonc(text: str) -> str:
+    """去掉注释与尾随逗号，得到与原文逐字符对齐的标准 JSON。"""
+    return _blank_trailing_commas(strip_jsonc_comments(text))
+
+
+def parse_jsonc(text: str) -> dict:
+    return json.loads(_strip_jsonc(text))
+
+
+def _skip_whitespace(text: str, i: int) -> int:
+    while i < len(text) and text[i] in ' \t\r\n':
+        i += 1
+    return i
+
+
+def _top_level_spans(text: str) -> tuple[dict[str, tuple[int, int, object]], int]:
+    """返回顶层每个键的值在原文中的区间与当前值，以及最后一个值的结束位置。"""
+    stripped = _strip_jsonc(text)
+    decoder = json.JSONDecoder()
+    spans = {}
+    i = _skip_whitespace(stripped, 0)
+    if i >= len(stripped) or stripped[i] != '{':
+        raise ValueError("配置文件的顶层必须是一个对象")
+    i = _skip_whitespace(stripped, i + 1)
+    last_end = i
+    while i < len(stripped) and stripped[i] != '}':
+        key, i = decoder.raw_decode(stripped, i)
+        i = _skip_whitespace(stripped, i)
+        if stripped[i] != ':':
+            raise ValueError(f"键 '{key}' 之后缺少冒号")
+        i = _skip_whitespace(stripped, i + 1)
+        value, end = decoder.raw_decode(stripped, i)
+        spans[key] = (i, end, value)
+        last_end = end
+        i = _skip_whitespace(stripped, end)
+        if i < len(stripped) and stripped[i] == ',':
+            i = _skip_whitespace(stripped, i + 1)
+    return spans, last_end
+
+
+def _format_value(value, indent: str) -> str:
+    if isinstance(value, (dict, list)) and value:
+        return json.dumps(value, ensure_ascii=False, indent=2).replace('\n', '\n' + indent)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def set_jsonc_values(text: str, changes: dict) -> str:
+    """
+    在保留注释与格式的前提下修改顶层键的值，不存在的键追加到末尾。
+    值未变化的键保持原样，其中的注释（如对象内被注释掉的示例）不会丢失。
+    """
+    spans, last_end = _top_level_spans(text)
+    # 先在最后一个值之后追加新键，再从后往前替换已有的值，已记录的区间都不受影响
+    missing = [k for k in changes if k not in spans]
+    if missing:
+        insertion = "".join(f',\n\n  "{k}": {_format_value(changes[k], "  ")}' for k in missing)
+        if not spans:
+            insertion = insertion[1:]
+        text = text[:last_end] + insertion + text[last_end:]
+    changed = [(k, spans[k]) for k in changes if k in spans and spans[k][2] != changes[k]]
+    for key, (start, end, _) in sorted(changed, key=lambda item: item[1][0], reverse=True):
+        line_start = text.rfind('\n', 0, start) + 1
+        indent = text[line_start:line_start + len(text[line_start:start]) - len(text[line_start:start].lstrip(' \t'))]
+        text = text[:start] + _format_value(changes[key], indent) + text[end:]
+    return text
+
+
+def read_text_file(path: str) -> tuple[str, str]:
+    """读取文本文件，返回 (换行统一为 \n 的内容, 文件原有的换行符)，写回时据此保持 CRLF 或 LF 不变。"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        content = f.read()
+    newline = '\r\n' if '\r\n' in content else '\n'
+    return content.replace('\r\n', '\n'), newline
+
+
+def write_file_atomic(path: str, content: str, newline: str | None = None):
+    """
+    先写入同目录下的临时文件再替换目标文件，读取方不会看到写了一半的内容。
+    newline 为写入时使用的换行符，默认使用系统换行符。
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline=newline) as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ConfigStore:
+    """
+    config.jsonc 的唯一读写入口。
+
+    - snapshot 是当前生效的配置（视为只读，不要原地修改），version 每次变化加一。
+    - load()/reload_if_changed() 只在文件修改时间变化时重新解析。
+    - update() 在内存中生成新快照并以保留注释的方式原子写回文件。
+    - subscribe() 注册的回调在每个新快照生效后以 (snapshot, version) 调用。
+    """
+
+    def __init__(self, path: str = 'config.jsonc'):
+        self.path = path
+        self.snapshot: dict = {}
+        self.version = 0
+        self._mtime = None
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _publish(self, snapshot: dict):
+        self.snapshot = snapshot
+        self.version += 1
+        for callback in self._subscribers:
+            try:
+                callback(snapshot, self.version)
+            except Exception as e:
+                logger.error(f"配置变更回调执行失败: {e}", exc_info=True)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self) -> dict:
+        """读取并解析配置文件，发布新快照。解析失败时抛出 OSError 或 ValueError，保留旧快照。"""
+        with self._lock:
+            mtime = self._file_mtime()
+            with open(self.path, 'r', encoding='utf-8') as f:
+                snapshot = parse_jsonc(f.read())
+            self._mtime = mtime
+            self._publish(snapshot)
+            return snapshot
+
+    def reload_if_changed(self) -> bool:
+        """文件被外部修改（手动编辑或其他进程）时重新加载，返回是否发布了新快照。"""
+        if self._file_mtime() == self._mtime:
+            return False
+        try:
+            self.load()
+            return True
+        except (OSError, ValueError) as e:
+            logger.error(f"重新加载 '{self.path}' 失败: {e}。继续使用版本 {self.version} 的配置。")
+            # 记录本次修改时间，文件再次变化前不重复报错
+            self._mtime = self._file_mtime()
+            return False
+
+    def update(self, changes: dict) -> dict:
+        """应用一组顶层键的修改：生成新快照并保留注释地写回文件。"""
+        with self._lock:
+            content, newline = read_text_file(self.path)
+            new_content = set_jsonc_values(content, changes)
+            # 以文件中的最新内容为基础，避免覆盖其他进程刚写入的修改
+            snapshot = parse_jsonc(new_content)
+            write_file_atomic(self.path, new_content, newline)
+            self._mtime = self._file_mtime()
+            self._publish(snapshot)
+            return snapshot
@@ -0,0 +1,71 @@
+# prefix_cache.py
+# 会话前缀缓存：服务器与标签页共享最近发送过的消息列表，新请求只需发送前缀引用和新增的消息
+
+import hashlib
+import json
+from collections import OrderedDict
+
+
+def template_chain(templates: list[dict]) -> list[str]:
+    """
+    计算消息列表的滚动哈希链：第 i 项是前 i+1 条消息的哈希。
+    两个列表的公共前缀长度等于它们哈希链的公共前缀长度。
+    """
+    chain = []
+    digest = b""
+    for template in templates:
+        h = hashlib.blake2b(digest, digest_size=16)
+        h.update(json.dumps(template, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+        digest = h.digest()
+        chain.append(digest.hex())
+    return chain
+
+
+def _common_prefix_length(a: list[str], b: list[str]) -> int:
+    # 第 k 项相同意味着前 k 项都相同，因此可以二分查找
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[mid - 1] == b[mid - 1]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class PrefixCache:
+    """
+    服务器端对某个标签页前缀缓存的镜像。键为完整消息列表的哈希（哈希链最后一项），值为该列表的哈希链。
+    容量与 LRU 淘汰顺序与标签页中的缓存保持一致：find() 命中时刷新被引用的条目，remember() 再加入新列表。
+    两侧偶尔不一致时（例如页面刷新后缓存丢失），标签页回报 prefix_miss，服务器改发完整消息。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: OrderedDict[str, list[str]] = OrderedDict()
+
+    def find(self, chain: list[str]) -> tuple[str, int] | None:
+        """返回与 chain 公共前缀最长的缓存条目 (key, 公共前缀长度)，没有公共前缀时返回 None。"""
+        best = None
+        for key, cached in self._entries.items():
+            length = _common_prefix_length(cached, chain)
+            if length > 0 and (best is None or length > best[1]):
+                best = (key, length)
+        if best:
+            self._entries.move_to_end(best[0])
+        return best
+
+    def remember(self, chain: list[str]):
+        if not chain:
+            return
+        key = chain[-1]
+        self._entries[key] = chain
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,113 @@
+# rate_limiter.py
+# 按 API Key 的限流：每分钟请求数、并发请求数、每分钟输出字符数
+
+import time
+
+
+class RateLimitExceeded(Exception):
+    """超出限额。retry_after 为建议的重试等待秒数。"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    令牌桶：容量为 capacity，每秒补充 refill_rate 个令牌。
+    允许事后扣减导致余额为负（用于按实际输出量计费），余额恢复为正之前拒绝新的请求。
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reconfigure(self, capacity: float, refill_rate: float):
+        if capacity == self.capacity and refill_rate == self.refill_rate:
+            return
+        self._refill()
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = min(self.tokens, capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def try_consume(self, amount: float = 1) -> float:
+        """尝试取走 amount 个令牌。成功返回 0，否则返回需要等待的秒数。"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.refill_rate
+
+    def debit(self, amount: float):
+        """事后扣减，余额可以为负。"""
+        self._refill()
+        self.tokens -= amount
+
+    def wait_time(self) -> float:
+        """余额为负或为零时，返回恢复为正所需的秒数。"""
+        self._refill()
+        return 0.0 if self.tokens > 0 else (1 - self.tokens) / self.refill_rate
+
+
+class RateLimiter:
+    """
+    维护每个调用方的令牌桶与并发计数。limits 中各项 <= 0 或缺省表示不限制：
+    - requests_per_minute: 每分钟请求数
+    - concurrent_requests: 同时进行中的请求数
+    - output_chars_per_minute: 每分钟输出字符数（请求结束后按实际输出扣减）
+    """
+
+    def __init__(self):
+        self._request_buckets: dict[str, TokenBucket] = {}
+        self._output_buckets: dict[str, TokenBucket] = {}
+        self._concurrent: dict[str, int] = {}
+
+    def _bucket(self, buckets: dict, client: str, per_minute: float) -> TokenBucket:
+        bucket = buckets.get(client)
+        if bucket is None:
+            bucket = buckets[client] = TokenBucket(per_minute, per_minute / 60)
+        else:
+            bucket.reconfigure(per_minute, per_minute / 60)
+        return bucket
+
+    def acquire(self, client: str, limits: dict):
+        """准入检查。通过则占用一个并发名额，否则抛出 RateLimitExceeded（不扣减任何额度）。"""
+        concurrent_limit = limits.get("concurrent_requests", -1)
+        if concurrent_limit > 0 and self._concurrent.get(client, 0) >= concurrent_limit:
+            raise RateLimitExceeded(f"并发请求数已达上限 ({concurrent_limit})", retry_after=1)
+
+        output_limit = limits.get("output_chars_per_minute", -1)
+        if output_limit > 0:
+            wait = self._bucket(self._output_buckets, client, output_limit).wait_time()
+            if wait > 0:
+                raise RateLimitExceeded(f"每分钟输出字符数已达上限 ({output_limit})", retry_after=wait)
+
+        rpm_limit = limits.get("requests_per_minute", -1)
+        if rpm_limit > 0:
+            wait = self._bucket(self._request_buckets, client, rpm_limit).try_consume(1)
+            if wait > 0:
+                raise RateLimitExceeded(f"每分钟请求数已达上限 ({rpm_limit})", retry_after=wait)
+
+        self._concurrent[client] = self._concurrent.get(client, 0) + 1
+
+    def release(self, client: str, output_chars: int = 0):
+        """请求结束：归还并发名额，并按实际输出字符数扣减额度。"""
+        count = self._concurrent.get(client, 0) - 1
+        if count > 0:
+            self._concurrent[client] = count
+        else:
+            self._concurrent.pop(client, None)
+        bucket = self._output_buckets.get(client)
+        if bucket and output_chars:
+            bucket.debit(output_chars)
+
+    def concurrent(self, client: str) -> int:
+        return self._concurrent.get(client, 0)
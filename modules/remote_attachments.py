@@ -0,0 +1,287 @@
+# remote_attachments.py
+# 远程图片附件：通过共享的连接池并发下载 image_url 中的 http(s) 地址，下载结果按内容哈希保存在磁盘 LRU 缓存中
+
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import mimetypes
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+
+from modules.config_store import write_file_atomic
+
+logger = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 5
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class RemoteFetchError(Exception):
+    """下载远程附件失败。status_code 为返回给客户端的状态码。"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PrivateAddressError(OSError):
+    """主机名解析到了内网或本机地址。"""
+
+
+class PublicAddressResolver(AbstractResolver):
+    """
+    只允许公网地址的 DNS 解析器。地址检查放在连接实际使用的解析结果上，
+    而不是连接前单独解析一次，避免检查之后 DNS 记录被改指向内网（DNS rebinding）。
+    """
+
+    def __init__(self):
+        self._resolver = DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> list:
+        hosts = await self._resolver.resolve(host, port, family)
+        for entry in hosts:
+            if not ipaddress.ip_address(entry["host"].split("%")[0]).is_global:
+                raise PrivateAddressError(f"{host} 解析到了内网或本机地址 {entry['host']}")
+        return hosts
+
+    async def close(self) -> None:
+        await self._resolver.close()
+
+
+class RemoteAttachmentFetcher:
+    """
+    下载远程图片。所有请求共用一个 aiohttp 会话（连接池），同一 URL 的并发下载只进行一次。
+    下载的内容以 sha256 命名保存在 cache_dir 中，index.json 记录 URL 到内容的映射与最近使用顺序，
+    总大小超过上限时淘汰最久未使用的 URL，不再被任何 URL 引用的文件随之删除。
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.max_connections = 16
+        self.cache_limit = 256 * 1024 * 1024
+        self.cache_ttl = 3600.0
+        # 是否允许内网地址 -> 会话。不允许时会话使用 PublicAddressResolver
+        self._sessions: dict[bool, aiohttp.ClientSession] = {}
+        self._index: OrderedDict[str, dict] | None = None
+        self._pending: dict[str, asyncio.Task] = {}
+        # 缓存的读写在线程中执行，索引的修改需要加锁
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.cache_dir, "index.json")
+
+    def configure(self, max_connections: int, cache_limit: int, cache_ttl: float):
+        """更新连接数与缓存设置。连接数变化时旧会话在其请求结束后关闭，新会话在下次下载时创建。"""
+        max_connections = max(1, max_connections)
+        if max_connections != self.max_connections:
+            for session in self._sessions.values():
+                asyncio.get_running_loop().create_task(session.close())
+            self._sessions.clear()
+        self.max_connections = max_connections
+        self.cache_limit = max(0, cache_limit)
+        self.cache_ttl = cache_ttl
+        if self._index is not None:
+            with self._lock:
+                self._evict()
+                self._save_index()
+
+    async def fetch(self, url: str, max_bytes: int, timeout: float, allow_private: bool = False) -> tuple[bytes, str]:
+        """
+        返回 (内容, MIME 类型)。下载失败、不是图片或超过 max_bytes 时抛出 RemoteFetchError。
+        下载在由本对象持有的独立任务中进行，发起下载的请求被取消不会影响同时等待同一 URL 的其他请求。
+        """
+        cached = await asyncio.to_thread(self._read_cached, url)
+        if cached:
+            return cached
+        task = self._pending.get(url)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_store(url, max_bytes, timeout, allow_private))
+            self._pending[url] = task
+            task.add_done_callback(lambda t: self._download_done(url, t))
+        return await asyncio.shield(task)
+
+    async def _fetch_and_store(self, url: str, max_bytes: int, timeout: float, allow_private: bool) -> tuple[bytes, str]:
+        try:
+            data, content_type = await asyncio.wait_for(self._download(url, max_bytes, allow_private), timeout)
+        except asyncio.TimeoutError:
+            raise RemoteFetchError(f"下载图片超时（{timeout:g} 秒）: {url}", 504)
+        await asyncio.to_thread(self._store, url, data, content_type)
+        return data, content_type
+
+    def _download_done(self, url: str, task: asyncio.Task):
+        if self._pending.get(url) is task:
+            del self._pending[url]
+        if not task.cancelled():
+            task.exception() # 所有等待者都已离开时避免 "exception was never retrieved" 警告
+
+    async def _download(self, url: str, max_bytes: int, allow_private: bool) -> tuple[bytes, str]:
+        session = self._session(allow_private)
+        # 重定向逐跳处理，每一跳都检查目标地址，避免经重定向访问内网
+        for _ in range(MAX_REDIRECTS + 1):
+            self._check_url(url, allow_private)
+            try:
+                async with session.get(url, allow_redirects=False) as response:
+                    if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+                        url = urljoin(url, response.headers["Location"])
+                        continue
+                    if response.status != 200:
+                        raise RemoteFetchError(f"下载图片失败（HTTP {response.status}）: {url}")
+                    content_type = self._content_type(url, response.headers.get("Content-Type", ""))
+                    if response.content_length is not None and response.content_length > max_bytes:
+                        raise RemoteFetchError(self._too_large_message(url, max_bytes), 413)
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                        data += chunk
+                        if len(data) > max_bytes:
+                            raise RemoteFetchError(self._too_large_message(url, max_bytes), 413)
+                    return bytes(data), content_type
+            except aiohttp.ClientConnectorError as e:
+                if isinstance(e.os_error, PrivateAddressError):
+                    raise RemoteFetchError(f"不允许从内网或本机地址下载图片: {url}", 403)
+                raise RemoteFetchError(f"下载图片失败: {url} ({e})")
+            except aiohttp.ClientError as e:
+                raise RemoteFetchError(f"下载图片失败: {url} ({e})")
+        raise RemoteFetchError(f"下载图片失败（重定向次数过多）: {url}")
+
+    def _session(self, allow_private: bool) -> aiohttp.ClientSession:
+        session = self._sessions.get(allow_private)
+        if session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, ttl_dns_cache=300,
+                resolver=None if allow_private else PublicAddressResolver(),
+            )
+            session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": "LMArenaBridge"})
+            self._sessions[allow_private] = session
+        return session
+
+    @staticmethod
+    def _too_large_message(url: str, max_bytes: int) -> str:
+        return f"图片超过了允许下载的大小上限 ({max_bytes / 1024 / 1024:g}MB): {url}"
+
+    @staticmethod
+    def _content_type(url: str, header: str) -> str:
+        """取响应的 MIME 类型；服务器未正确声明时按扩展名推断。只接受图片。"""
+        content_type = header.split(";")[0].strip().lower()
+        if not content_type.startswith("image/"):
+            guessed, _ = mimetypes.guess_type(urlsplit(url).path)
+            if content_type in ("", "application/octet-stream", "binary/octet-stream") and guessed and guessed.startswith("image/"):
+                content_type = guessed
+            else:
+                raise RemoteFetchError(f"URL 返回的不是图片（{content_type or '未知类型'}）: {url}", 415)
+        return content_type
+
+    @staticmethod
+    def _check_url(url: str, allow_private: bool):
+        """
+        检查协议与 IP 字面量地址。主机名的解析结果由 PublicAddressResolver 在建立连接时检查，
+        aiohttp 对 IP 字面量不调用解析器，所以在这里检查。
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise RemoteFetchError(f"不支持的图片 URL: {url}")
+        if allow_private:
+            return
+        try:
+            address = ipaddress.ip_address(parts.hostname.split("%")[0])
+        except ValueError:
+            return
+        if not address.is_global:
+            raise RemoteFetchError(f"不允许从内网或本机地址下载图片: {url}", 403)
+
+    # --- 磁盘缓存（在线程中执行） ---
+
+    def _load_index(self) -> OrderedDict[str, dict]:
+        if self._index is None:
+            self._index = OrderedDict()
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    for url, entry in json.load(f):
+                        if os.path.exists(os.path.join(self.cache_dir, entry["digest"])):
+                            self._index[url] = entry
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"远程图片缓存索引无法读取，将重新建立: {e}")
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_file_atomic(self.index_path, json.dumps(list(self._index.items()), ensure_ascii=False))
+
+    def _read_cached(self, url: str) -> tuple[bytes, str] | None:
+        with self._lock:
+            return self._read_cached_locked(url)
+
+    def _read_cached_locked(self, url: str) -> tuple[bytes, str] | None:
+        index = self._load_index()
+        entry = index.get(url)
+        if entry is None:
+            return None
+        if self.cache_ttl >= 0 and time.time() - entry["fetched_at"] > self.cache_ttl:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, entry["digest"]), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            del index[url]
+            return None
+        index.move_to_end(url)
+        return data, entry["content_type"]
+
+    def _store(self, url: str, data: bytes, content_type: str):
+        if self.cache_limit <= 0 or len(data) > self.cache_limit:
+            return
+        with self._lock:
+            self._store_locked(url, data, content_type)
+
+    def _store_locked(self, url: str, data: bytes, content_type: str):
+        index = self._load_index()
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.cache_dir, digest)
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path + ".part", 'wb') as f:
+                f.write(data)
+            os.replace(path + ".part", path)
+        previous = index.pop(url, None)
+        index[url] = {"digest": digest, "content_type": content_type, "size": len(data), "fetched_at": time.time()}
+        if previous and previous["digest"] != digest:
+            self._remove_unreferenced(previous["digest"])
+        self._evict()
+        self._save_index()
+
+    def _evict(self):
+        sizes = {entry["digest"]: entry["size"] for entry in self._index.values()}
+        total = sum(sizes.values())
+        while self._index and total > self.cache_limit:
+            _, entry = self._index.popitem(last=False)
+            if self._remove_unreferenced(entry["digest"]):
+                total -= entry["size"]
+
+    def _remove_unreferenced(self, digest: str) -> bool:
+        """内容文件不再被任何 URL 引用时删除，返回是否删除。"""
+        if any(entry["digest"] == digest for entry in self._index.values()):
+            return False
+        try:
+            os.remove(os.path.join(self.cache_dir, digest))
+        except FileNotFoundError:
+            pass
+        return True
+
+    async def close(self):
+        for task in list(self._pending.values()):
+            task.cancel()
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
@@ -0,0 +1,412 @@
+# request_body.py
+# 聊天请求体的流式解析：边接收边扫描 JSON，把过大的 data: URL 写入临时文件，请求中只保留占位引用，下发给浏览器时再写回消息帧
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+# 占位引用的格式：原 data: URL 的头部（如 data:image/png;base64,）+ BLOB_MARKER + 内容的 sha256。
+# 标记中包含进程级随机串，客户端无法在消息文本中伪造引用去读取其他请求的附件。
+BLOB_MARKER = f"\x00blob-{secrets.token_hex(8)}:"
+_MARKER_JSON = json.dumps(BLOB_MARKER)[1:-1]
+_MARKER_JSON_BYTES = _MARKER_JSON.encode("ascii")
+_REFERENCE_RE = re.compile(re.escape(_MARKER_JSON) + r"([0-9a-f]{64})")
+_STRING_STOP = re.compile(rb'["\\]')
+_MAX_HEADER = 256 # data: URL 头部（逗号之前）的最大长度
+_DIGEST_PLACEHOLDER = b"0" * 64
+# 写入临时文件的字符串内容在接收时校验：base64 数据只允许 base64 字母表，其余内容只允许合法的 JSON 字符串字符
+_BASE64_RUN = re.compile(rb"[A-Za-z0-9+/=]*")
+_JSON_STRING_RUN = re.compile(rb"[^\x00-\x1f\\]*")
+_HEX_DIGITS = re.compile(rb"[0-9A-Fa-f]*")
+_BASE64_ESCAPES = b"/nru" # \/、MIME 换行与 \uXXXX
+_JSON_ESCAPES = b'"\\/bfnrtu'
+SPILL_CHUNK = 256 * 1024 # 写入临时文件的内容先在内存中累积到这个大小，再交给线程批量写入
+
+
+class BlobStore:
+    """
+    以内容哈希命名的临时文件，按引用计数管理：多个请求携带同一张图片时只保存一份，
+    最后一个引用释放时删除。文件保存的是请求 JSON 中的原始字符串内容（保留转义），可以原样写回 JSON 消息帧。
+    文件在线程中写入和登记，引用计数的修改需要加锁。
+    """
+
+    def __init__(self, prefix: str = "lmarena_bridge_blobs_"):
+        self.prefix = prefix
+        self._directory: str | None = None
+        self._refs: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self) -> str:
+        with self._lock:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix=self.prefix)
+            return self._directory
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def size(self, digest: str) -> int:
+        return os.path.getsize(self.path(digest))
+
+    def open_writer(self) -> "BlobWriter":
+        return BlobWriter(self)
+
+    def _commit(self, temp_path: str, digest: str):
+        path = self.path(digest)
+        with self._lock:
+            if digest in self._refs:
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, path)
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+
+    def release(self, digest: str):
+        path = self.path(digest)
+        with self._lock:
+            count = self._refs.get(digest, 0) - 1
+            if count > 0:
+                self._refs[digest] = count
+                return
+            self._refs.pop(digest, None)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def read_text(self, digest: str) -> str:
+        """读取引用的字符串内容（已解除 JSON 转义）。"""
+        with open(self.path(digest), 'r', encoding='utf-8') as f:
+            raw = f.read()
+        return json.loads(f'"{raw}"') if "\\" in raw else raw
+
+    def expand(self, text: str) -> str:
+        """把 JSON 文本中的占位引用替换为文件中的原始内容。"""
+        pieces = []
+        position = 0
+        for match in _REFERENCE_RE.finditer(text):
+            pieces.append(text[position:match.start()])
+            with open(self.path(match.group(1)), 'r', encoding='utf-8') as f:
+                pieces.append(f.read())
+            position = match.end()
+        if not pieces:
+            return text
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+    def clear(self):
+        with self._lock:
+            if self._directory is not None:
+                shutil.rmtree(self._directory, ignore_errors=True)
+                self._directory = None
+            self._refs.clear()
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+
+class BlobWriter:
+    """
+    把一个字符串的内容写入临时文件，提交时按内容哈希登记到 BlobStore。
+    write() 只把数据放入缓冲区；flush()、commit() 与 abort() 执行磁盘操作，流式解析时在线程中调用。
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.temp_path: str | None = None
+        self._file = None
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def write(self, data: bytes):
+        self._buffer += data
+
+    def flush(self):
+        if self._file is None:
+            fd, self.temp_path = tempfile.mkstemp(dir=self.store.directory, suffix=".part")
+            self._file = os.fdopen(fd, 'wb')
+        self._file.write(self._buffer)
+        self._hash.update(self._buffer)
+        self._buffer = bytearray()
+
+    def commit(self) -> str:
+        self.flush()
+        self._file.close()
+        digest = self._hash.hexdigest()
+        self.store._commit(self.temp_path, digest)
+        return digest
+
+    def abort(self):
+        self._buffer = bytearray()
+        if self._file is None:
+            return
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class BlobSet:
+    """一个请求持有的引用。release() 可重复调用。"""
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.digests: list[str] = []
+
+    def add_text(self, text: str) -> str:
+        """把字符串写入临时文件并持有其引用，返回可以代替该字符串放入请求的占位引用。"""
+        writer = self.store.open_writer()
+        writer.write(json.dumps(text)[1:-1].encode("utf-8"))
+        digest = writer.commit()
+        self.digests.append(digest)
+        return BLOB_MARKER + digest
+
+    def discard(self, digest: str):
+        """提前释放一个不再使用的引用。"""
+        if digest in self.digests:
+            self.digests.remove(digest)
+            self.store.release(digest)
+
+    def release(self):
+        digests, self.digests = self.digests, []
+        for digest in digests:
+            self.store.release(digest)
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+
+def blob_digest(value: str) -> str | None:
+    """返回占位引用中的内容哈希，不是引用时返回 None。"""
+    _, marker, digest = value.partition(BLOB_MARKER)
+    return digest if marker else None
+
+
+class RequestBodyParser:
+    """
+    增量扫描 JSON 请求体。字符串之外的字节原样进入骨架；字符串在内存中累积，
+    以 data: 开头且超过 threshold 字节时改为写入临时文件，骨架中只留下占位引用。
+    只需要定位字符串边界（引号与反斜杠），其余语法由最后对骨架的 json.loads 校验；
+    写入临时文件的内容不经过 json.loads，在接收时逐段校验字符与转义序列。
+
+    feed() 不做磁盘操作：写入文件的内容先缓冲，needs_flush() 为真时由调用方 await flush() 在线程中批量写入。
+    """
+
+    def __init__(self, store: BlobStore, threshold: int):
+        self.blobs = BlobSet(store)
+        self.threshold = threshold
+        self._skeleton = bytearray()
+        self._string = bytearray()
+        self._in_string = False
+        self._escape_pending = False
+        self._header = b""
+        self._writer: BlobWriter | None = None
+        # 已经结束、等待提交的字符串：(写入器, 骨架中哈希占位的位置)
+        self._closing: list[tuple[BlobWriter, int]] = []
+        self._flushing: asyncio.Future | None = None
+        # 写入文件的字符串的校验状态
+        self._base64 = False
+        self._after_backslash = False
+        self._hex_pending = 0
+
+    def feed(self, chunk: bytes):
+        position, end = 0, len(chunk)
+        while position < end:
+            if not self._in_string:
+                quote = chunk.find(b'"', position)
+                if quote == -1:
+                    self._skeleton += chunk[position:]
+                    return
+                self._skeleton += chunk[position:quote]
+                self._in_string = True
+                position = quote + 1
+            elif self._escape_pending:
+                # 转义序列的第一个字符一定不是字符串结束的引号，\uXXXX 的其余部分也不会是
+                self._append_string(chunk[position:position + 1])
+                self._escape_pending = False
+                position += 1
+            else:
+                match = _STRING_STOP.search(chunk, position)
+                if match is None:
+                    self._append_string(chunk[position:])
+                    return
+                stop = match.start()
+                if chunk[stop] == 0x5C: # 反斜杠
+                    self._append_string(chunk[position:stop + 1])
+                    self._escape_pending = True
+                else:
+                    self._append_string(chunk[position:stop])
+                    self._end_string()
+                position = stop + 1
+
+    def _append_string(self, data: bytes):
+        if self._writer is not None:
+            self._check_spilled(data)
+            self._writer.write(data)
+            return
+        self._string += data
+        if len(self._string) < self.threshold or not self._string.startswith(b"data:"):
+            return
+        comma = self._string.find(b",", 0, _MAX_HEADER)
+        if comma == -1:
+            return
+        self._header = bytes(self._string[:comma + 1])
+        self._base64 = b";base64" in self._header
+        self._after_backslash = False
+        self._hex_pending = 0
+        self._writer = self.blobs.store.open_writer()
+        self._check_spilled(self._string[comma + 1:])
+        self._writer.write(self._string[comma + 1:])
+        self._string = bytearray()
+
+    def _check_spilled(self, data: bytes):
+        """校验写入文件的字符串内容，不合法时抛出 ValueError。转义序列可能跨越多次调用，状态保存在解析器中。"""
+        run = _BASE64_RUN if self._base64 else _JSON_STRING_RUN
+        escapes = _BASE64_ESCAPES if self._base64 else _JSON_ESCAPES
+        position, end = 0, len(data)
+        while position < end:
+            if self._hex_pending:
+                digits = data[position:position + self._hex_pending]
+                if not _HEX_DIGITS.fullmatch(digits):
+                    raise ValueError("请求体中的 \\u 转义序列无效")
+                self._hex_pending -= len(digits)
+                position += len(digits)
+            elif self._after_backslash:
+                if data[position] not in escapes:
+                    raise ValueError(f"请求体中的 data: URL 含有无效的转义序列 \\{chr(data[position])}")
+                if data[position] == 0x75: # u
+                    self._hex_pending = 4
+                self._after_backslash = False
+                position += 1
+            else:
+                position = run.match(data, position).end()
+                if position == end:
+                    return
+                if data[position] != 0x5C:
+                    raise ValueError(f"请求体中的 data: URL 含有无效字符 (0x{data[position]:02x})")
+                self._after_backslash = True
+                position += 1
+
+    def _end_string(self):
+        self._skeleton += b'"'
+        if self._writer is not None:
+            if self._after_backslash or self._hex_pending:
+                raise ValueError("请求体中的 data: URL 以不完整的转义序列结尾")
+            # 哈希在提交后才知道，先写入占位，flush() 时填回
+            self._skeleton += self._header + _MARKER_JSON_BYTES
+            self._closing.append((self._writer, len(self._skeleton)))
+            self._skeleton += _DIGEST_PLACEHOLDER
+            self._writer = None
+        else:
+            self._skeleton += self._string
+        self._skeleton += b'"'
+        self._string = bytearray()
+        self._in_string = False
+
+    def needs_flush(self) -> bool:
+        return bool(self._closing) or (self._writer is not None and self._writer.buffered >= SPILL_CHUNK)
+
+    async def flush(self):
+        """在线程中写入缓冲的内容并提交已结束的字符串，把它们的哈希填回骨架。"""
+        writer, closing = self._writer, self._closing
+        self._closing = []
+        self._flushing = asyncio.ensure_future(asyncio.to_thread(_write_blobs, writer, [w for w, _ in closing]))
+        # 调用方被取消时写入线程仍在运行，由 abort() 在线程结束后清理
+        digests = await asyncio.shield(self._flushing)
+        self._flushing = None
+        for (_, offset), digest in zip(closing, digests):
+            self._skeleton[offset:offset + len(_DIGEST_PLACEHOLDER)] = digest.encode("ascii")
+            self.blobs.digests.append(digest)
+
+    def close(self):
+        """结束解析（调用前应先 await flush()），返回请求对象。请求体无效时抛出 ValueError 并释放已写入的文件。"""
+        try:
+            if self._in_string:
+                raise json.JSONDecodeError("Unterminated string", self._skeleton.decode("utf-8", "replace"), len(self._skeleton))
+            return json.loads(self._skeleton)
+        except ValueError:
+            self.abort()
+            raise
+
+    def abort(self):
+        writers = [w for w, _ in self._closing]
+        if self._writer is not None:
+            writers.append(self._writer)
+        self._writer, self._closing = None, []
+        flushing, self._flushing = self._flushing, None
+        if flushing is not None and not flushing.done():
+            flushing.add_done_callback(lambda future: self._abort_after_flush(future, writers))
+        else:
+            for writer in writers:
+                writer.abort()
+        self.blobs.release()
+
+    def _abort_after_flush(self, future: asyncio.Future, writers: list[BlobWriter]):
+        if not future.cancelled() and future.exception() is None:
+            for digest in future.result():
+                self.blobs.store.release(digest)
+        for writer in writers:
+            writer.abort()
+
+
+def _write_blobs(writer: BlobWriter | None, closing: list[BlobWriter]) -> list[str]:
+    """在线程中执行：写入当前字符串的缓冲内容，提交已结束的字符串并返回它们的哈希。失败时清理本批次的文件。"""
+    digests = []
+    try:
+        if writer is not None:
+            writer.flush()
+        for closing_writer in closing:
+            digests.append(closing_writer.commit())
+    except BaseException:
+        for digest in digests:
+            closing[0].store.release(digest)
+        for closing_writer in closing[len(digests):]:
+            closing_writer.abort()
+        raise
+    return digests
+
+
+async def parse_json_stream(chunks: AsyncIterator[bytes], store: BlobStore, threshold: int) -> tuple[object, BlobSet]:
+    """边接收边解析 JSON 请求体，返回 (请求对象, 请求持有的引用)。"""
+    parser = RequestBodyParser(store, threshold)
+    try:
+        async for chunk in chunks:
+            parser.feed(chunk)
+            if parser.needs_flush():
+                await parser.flush()
+        if parser.needs_flush():
+            await parser.flush()
+    except BaseException:
+        parser.abort()
+        raise
+    obj = parser.close()
+    if parser.blobs:
+        logger.debug(f"请求体中有 {len(parser.blobs)} 个 data: URL 已写入临时文件。")
+    return obj, parser.blobs
+
+
+def has_blob_references(text: str) -> bool:
+    """JSON 文本中是否含有占位引用。"""
+    return _MARKER_JSON in text
+
+
+async def expand_blob_references(store: BlobStore, text: str) -> str:
+    """在线程中把 JSON 文本中的占位引用展开，避免读取大文件时阻塞事件循环。"""
+    if not has_blob_references(text):
+        return text
+    return await asyncio.to_thread(store.expand, text)
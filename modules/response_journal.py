@@ -0,0 +1,192 @@
+# response_journal.py
+# 流式响应日志：记录每个 SSE 事件并分配递增的 id，客户端断线后可凭 Last-Event-ID 从断点继续接收
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+# 内存中超出上限的事件每累积这么多个才批量写入一次磁盘
+SPILL_BATCH = 64
+
+
+class ResponseJournal:
+    """
+    一个流式响应的 SSE 事件日志。序号从 1 开始递增；内存中保留最近 memory_limit 个事件，
+    更早的事件分批追加到磁盘文件，读取时按批次的文件偏移只读取需要的部分。磁盘读写都在线程中进行。
+
+    上游由后台任务（producer）写入，与客户端连接无关：客户端断开后上游继续运行，
+    grace 秒内没有客户端重新连接（或响应开始后一直没有客户端读取）时才取消上游。
+    """
+
+    def __init__(self, handle: str, client: str, spill_path: str, memory_limit: int, grace: float):
+        self.handle = handle
+        self.client = client
+        self.spill_path = spill_path
+        self.memory_limit = max(1, memory_limit)
+        self.grace = grace
+        self.frames: deque[tuple[int, str]] = deque()
+        self.last_seq = 0
+        self.spilled = 0 # 序号 <= spilled 的事件已写入磁盘
+        self.done = False
+        self.finished_at: float | None = None
+        self.readers = 0
+        self.producer: asyncio.Task | None = None
+        self._signal = asyncio.Event()
+        self._spill_file = None
+        # 每个已写入磁盘的批次：(第一个事件的序号, 文件偏移, 字节数)
+        self._batches: list[tuple[int, int, int]] = []
+        self._spill_size = 0
+        self._grace_task: asyncio.Task | None = None
+
+    def start(self, producer: asyncio.Task):
+        """登记写入日志的后台任务。grace 秒内没有读取者开始读取时取消它，避免客户端在响应开始前断开后上游仍继续运行。"""
+        self.producer = producer
+        self._arm_grace()
+
+    async def append(self, frame: str) -> int:
+        """追加一个事件。只应由 producer 调用；内存中的事件超出上限一个批次时，在线程中写入磁盘。"""
+        self.last_seq += 1
+        self.frames.append((self.last_seq, frame))
+        self._wake()
+        if len(self.frames) >= self.memory_limit + SPILL_BATCH:
+            await self._spill(len(self.frames) - self.memory_limit)
+        return self.last_seq
+
+    async def _spill(self, count: int):
+        # 写入完成前事件仍保留在内存中，读取者不会看到空档
+        batch = [self.frames[i] for i in range(count)]
+        data = "".join(json.dumps([seq, frame], ensure_ascii=False) + "\n" for seq, frame in batch).encode("utf-8")
+        await asyncio.to_thread(self._write_spill, data)
+        self._batches.append((batch[0][0], self._spill_size, len(data)))
+        self._spill_size += len(data)
+        for _ in range(count):
+            self.frames.popleft()
+        self.spilled = batch[-1][0]
+
+    def _write_spill(self, data: bytes):
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, 'ab')
+        self._spill_file.write(data)
+        self._spill_file.flush()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._wake()
+
+    def _wake(self):
+        self._signal.set()
+        self._signal = asyncio.Event()
+
+    async def _read_spilled(self, after: int) -> list[tuple[int, str]]:
+        """读取磁盘上第一个包含序号大于 after 的事件的批次。"""
+        index = max(0, bisect.bisect_right(self._batches, (after + 1, float("inf"))) - 1)
+        _, offset, length = self._batches[index]
+        lines = await asyncio.to_thread(self._read_batch, offset, length)
+        return [(seq, frame) for seq, frame in map(json.loads, lines) if seq > after]
+
+    def _read_batch(self, offset: int, length: int) -> list[str]:
+        with open(self.spill_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length).decode("utf-8").splitlines()
+
+    def read(self, last_event_id: int = 0, keepalive_interval: float | None = None) -> AsyncIterator[tuple[int | None, str]]:
+        """
+        从 last_event_id 之后开始读取，产生 (序号, 事件)。上游未结束时持续等待新事件，
+        等待期间每隔 keepalive_interval 秒产生一个 (None, 保活注释)。
+        读取者在开始迭代时才计数，创建后从未被迭代的读取不会让上游一直保持运行。
+        """
+        return self._iterate(last_event_id, keepalive_interval)
+
+    async def _iterate(self, position: int, keepalive_interval: float | None):
+        self.readers += 1
+        if self._grace_task:
+            self._grace_task.cancel()
+            self._grace_task = None
+        try:
+            while True:
+                if position < self.spilled:
+                    for seq, frame in await self._read_spilled(position):
+                        yield seq, frame
+                        position = seq
+                    continue
+                for seq, frame in list(self.frames):
+                    if seq > position:
+                        yield seq, frame
+                        position = seq
+                if position < self.spilled:
+                    # 读取期间有事件被转移到磁盘
+                    continue
+                if position >= self.last_seq:
+                    if self.done:
+                        return
+                    signal = self._signal
+                    try:
+                        await asyncio.wait_for(signal.wait(), timeout=keepalive_interval)
+                    except asyncio.TimeoutError:
+                        yield None, ": keepalive\n\n"
+        finally:
+            self.readers -= 1
+            if self.readers <= 0:
+                self._arm_grace()
+
+    def _arm_grace(self):
+        if self.done or not self.producer:
+            return
+        if self._grace_task:
+            self._grace_task.cancel()
+        self._grace_task = asyncio.create_task(self._cancel_after_grace())
+
+    async def _cancel_after_grace(self):
+        await asyncio.sleep(self.grace)
+        if self.readers <= 0 and not self.done and self.producer:
+            logger.info(f"JOURNAL [{self.handle[-8:]}]: {self.grace:g} 秒内没有客户端读取响应，取消上游请求。")
+            self.producer.cancel()
+
+    def close(self):
+        if self._grace_task:
+            self._grace_task.cancel()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        try:
+            os.remove(self.spill_path)
+        except FileNotFoundError:
+            pass
+
+
+class ResponseJournalStore:
+    """按响应句柄管理日志。上游结束 ttl 秒后日志被清理，此后无法再续传。"""
+
+    def __init__(self, spill_dir: str):
+        self.spill_dir = spill_dir
+        self._journals: dict[str, ResponseJournal] = {}
+
+    def create(self, handle: str, client: str, memory_limit: int, grace: float) -> ResponseJournal:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        journal = ResponseJournal(handle, client, os.path.join(self.spill_dir, f"{handle}.jsonl"), memory_limit, grace)
+        self._journals[handle] = journal
+        return journal
+
+    def get(self, handle: str) -> ResponseJournal | None:
+        return self._journals.get(handle)
+
+    def expire(self, ttl: float):
+        """清理上游已结束超过 ttl 秒且没有读取者的日志。"""
+        now = time.monotonic()
+        for handle, journal in list(self._journals.items()):
+            if journal.done and journal.readers <= 0 and now - journal.finished_at > ttl:
+                journal.close()
+                del self._journals[handle]
+
+    def __len__(self) -> int:
+        return len(self._journals)
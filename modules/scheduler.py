@@ -0,0 +1,141 @@
+# scheduler.py
+# 请求调度：按优先级类别与 API Key 权重进行加权公平排队
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_SAMPLES = 1000 # 每个优先级类别保留的排队时间样本数
+
+
+class SchedulerSlot:
+    """调度器发放的执行名额。请求结束时必须调用 release()，重复调用无副作用。"""
+
+    def __init__(self, scheduler: "FairScheduler", priority_class: str, queue_wait: float):
+        self._scheduler = scheduler
+        self.priority_class = priority_class
+        self.queue_wait = queue_wait
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._scheduler._on_release(self)
+
+
+class FairScheduler:
+    """
+    加权公平调度器（Start-time Fair Queuing）。
+
+    每个流（通常是一个 API Key）的权重 = 优先级类别权重 × Key 权重。
+    请求入队时获得虚拟完成时间 start + 1/weight，始终优先放行完成时间最小的请求：
+    高权重的交互流量能插队到批量任务前面，而低权重的流也会随虚拟时间推进得到执行，不会饿死。
+    同时运行的请求数不超过 capacity。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._running = 0
+        self._virtual_time = 0.0
+        self._last_finish: dict[str, float] = {}
+        self._heap: list = []
+        self._counter = itertools.count()
+        self._stats: dict[str, dict] = {}
+
+    def set_capacity(self, capacity: int):
+        """调整并发上限，扩容时立即放行排队中的请求。"""
+        self.capacity = capacity
+        self._dispatch()
+
+    async def acquire(self, flow: str, weight: float, priority_class: str, timeout: float | None = None) -> SchedulerSlot:
+        """排队等待一个执行名额。超时抛出 asyncio.TimeoutError。"""
+        weight = max(float(weight), 1e-6)
+        start = max(self._virtual_time, self._last_finish.get(flow, 0.0))
+        finish = start + 1.0 / weight
+        self._last_finish[flow] = finish
+
+        stats = self._class_stats(priority_class)
+        stats["queued"] += 1
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        heapq.heappush(self._heap, (finish, next(self._counter), start, priority_class, enqueued_at, future))
+        self._dispatch()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if future.done() and not future.cancelled():
+                # 名额已发放但调用方已放弃，归还名额
+                future.result().release()
+            else:
+                future.cancel()
+                stats["queued"] -= 1
+                self._dispatch()
+            raise
+
+    def _dispatch(self):
+        while self._heap and self._running < self.capacity:
+            _, _, start, priority_class, enqueued_at, future = heapq.heappop(self._heap)
+            if future.cancelled():
+                continue
+            self._virtual_time = max(self._virtual_time, start)
+            queue_wait = time.monotonic() - enqueued_at
+            stats = self._class_stats(priority_class)
+            stats["queued"] -= 1
+            stats["running"] += 1
+            stats["dispatched"] += 1
+            stats["waits"].append(queue_wait)
+            self._running += 1
+            future.set_result(SchedulerSlot(self, priority_class, queue_wait))
+
+    def _on_release(self, slot: SchedulerSlot):
+        self._running -= 1
+        self._class_stats(slot.priority_class)["running"] -= 1
+        self._dispatch()
+
+    def _class_stats(self, priority_class: str) -> dict:
+        if priority_class not in self._stats:
+            self._stats[priority_class] = {
+                "queued": 0,
+                "running": 0,
+                "dispatched": 0,
+                "waits": deque(maxlen=QUEUE_WAIT_SAMPLES),
+            }
+        return self._stats[priority_class]
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(stats["queued"] for stats in self._stats.values())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def snapshot(self) -> dict:
+        """返回当前并发、排队深度以及每个优先级类别的排队时间统计（毫秒）。"""
+        classes = {}
+        for name, stats in self._stats.items():
+            waits = sorted(stats["waits"])
+            classes[name] = {
+                "queued": stats["queued"],
+                "running": stats["running"],
+                "dispatched": stats["dispatched"],
+                "queue_wait_ms": {
+                    "avg": round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+                    "p50": round(waits[len(waits) // 2] * 1000, 1) if waits else None,
+                    "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+                    "max": round(waits[-1] * 1000, 1) if waits else None,
+                },
+            }
+        return {
+            "capacity": self.capacity,
+            "running": self._running,
+            "queued": self.queue_depth,
+            "classes": classes,
+        }
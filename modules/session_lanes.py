@@ -0,0 +1,80 @@
+# session_lanes.py
+# 会话通道：限制同一 session_id/message_id 上同时进行的请求数
+
+import asyncio
+import random
+import time
+
+
+class SessionLanes:
+    """
+    每个 (session_id, message_id) 是一条通道，最多同时承载 concurrency 个请求。
+    同一会话上的并发重试会争抢同一条上游消息，因此默认每条通道只允许一个请求。
+    选择时优先使用同一模型下空闲的会话；全部繁忙时排队，直到任一候选会话空闲。
+    """
+
+    def __init__(self, concurrency: int = 1):
+        self.concurrency = concurrency
+        self._busy: dict[tuple[str, str], int] = {}
+        self._waiters: list[asyncio.Future] = []
+
+    @staticmethod
+    def lane_key(mapping: dict) -> tuple[str, str]:
+        return (mapping.get("session_id"), mapping.get("message_id"))
+
+    def set_concurrency(self, concurrency: int):
+        self.concurrency = concurrency
+        self._wake_waiters()
+
+    def try_acquire(self, candidates: list[dict]) -> dict | None:
+        """从候选映射中选出负载最低的空闲会话并占用，没有空闲会话时返回 None。"""
+        free = [m for m in candidates if self._busy.get(self.lane_key(m), 0) < self.concurrency]
+        if not free:
+            return None
+        lowest = min(self._busy.get(self.lane_key(m), 0) for m in free)
+        chosen = random.choice([m for m in free if self._busy.get(self.lane_key(m), 0) == lowest])
+        key = self.lane_key(chosen)
+        self._busy[key] = self._busy.get(key, 0) + 1
+        return chosen
+
+    async def acquire(self, candidates: list[dict], timeout: float | None = None) -> dict:
+        """占用一个候选会话，必要时排队等待。超时抛出 asyncio.TimeoutError。"""
+        deadline = time.monotonic() + timeout if timeout else None
+        loop = asyncio.get_running_loop()
+        while True:
+            chosen = self.try_acquire(candidates)
+            if chosen:
+                return chosen
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=remaining)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, mapping: dict):
+        key = self.lane_key(mapping)
+        count = self._busy.get(key, 0) - 1
+        if count > 0:
+            self._busy[key] = count
+        else:
+            self._busy.pop(key, None)
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # 唤醒所有等待者，按排队顺序重新尝试
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "busy_lanes": len(self._busy),
+            "waiting": len(self._waiters),
+        }
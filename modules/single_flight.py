@@ -0,0 +1,155 @@
+# single_flight.py
+# 合并相同的并发请求：同一时间内载荷相同的请求共享一次上游请求，每个订阅者各自收到完整的事件序列
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """
+    一次共享的上游请求。事件按到达顺序保存在 events 中，每个订阅者从第一个事件开始读取，
+    迟到的订阅者会先收到已错过的事件。最后一个订阅者离开时取消上游请求。
+    上游请求发出之前加入的订阅者登记为接替者：发起方因自身原因放弃时（客户端断开、排队超时），
+    由最早加入且仍在等待的接替者重新发起，而不是让所有订阅者都收到发起方的错误。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: list[tuple] = []
+        self.done = False
+        self.subscribers = 0
+        self._signal = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._done_callbacks = []
+        self._successors: OrderedDict[str, Callable[[], Awaitable]] = OrderedDict()
+        self._takeover: tuple[str, asyncio.Task] | None = None
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None
+
+    def add_done_callback(self, callback):
+        self._done_callbacks.append(callback)
+
+    @property
+    def successors(self) -> list[str]:
+        return list(self._successors)
+
+    def add_successor(self, subscriber: str, takeover: Callable[[], Awaitable]):
+        """登记接替者。takeover 是无参数的协程函数，负责重新发出上游请求并调用 start()。"""
+        if not self.started and not self.done:
+            self._successors[subscriber] = takeover
+
+    def remove_successor(self, subscriber: str):
+        """订阅者离开时调用。它正在接替发起上游请求时取消该任务，由任务的失败处理交给下一位。"""
+        self._successors.pop(subscriber, None)
+        if self._takeover and self._takeover[0] == subscriber and not self.started:
+            self._takeover[1].cancel()
+
+    def hand_off(self) -> bool:
+        """把发起上游请求的责任交给最早加入的接替者，返回是否有人接替。"""
+        if self.started or self.done or not self._successors:
+            return False
+        subscriber, takeover = self._successors.popitem(last=False)
+        logger.info(f"SINGLE-FLIGHT [{self.key[:8]}]: 发起方已放弃，由合并进来的请求 {subscriber[:8]} 接替发起上游请求。")
+        self._takeover = (subscriber, asyncio.create_task(takeover()))
+        return True
+
+    def start(self, source: AsyncIterator[tuple]):
+        """开始消费上游事件源（只能调用一次）。"""
+        self._successors.clear()
+        self._takeover = None
+        self._task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator[tuple]):
+        try:
+            async for event in source:
+                self._publish(event)
+        except asyncio.CancelledError:
+            logger.info(f"SINGLE-FLIGHT [{self.key[:8]}]: 所有订阅者均已离开，上游请求已取消。")
+        except Exception as e:
+            logger.error(f"SINGLE-FLIGHT [{self.key[:8]}]: 上游事件源出错: {e}", exc_info=True)
+            self._publish(('error', str(e)))
+        finally:
+            self._finish()
+
+    def fail(self, message: str):
+        """上游请求未能发出且无人接替时，让已加入的订阅者收到错误。"""
+        if self.done:
+            return
+        self._publish(('error', message))
+        self._finish()
+
+    def _publish(self, event: tuple):
+        self.events.append(event)
+        self._wake()
+
+    def _wake(self):
+        self._signal.set()
+        self._signal = asyncio.Event()
+
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        self._wake()
+        for callback in self._done_callbacks:
+            callback(self)
+
+    def subscribe(self, keepalive_interval: float | None = None, subscriber: str | None = None) -> AsyncIterator[tuple]:
+        """
+        订阅事件流。订阅者在开始迭代时才计数，离开时（包括被关闭、取消）减少计数，
+        创建后从未被迭代的订阅不会占用计数，也就不会让上游在所有读取者离开后继续运行。
+        若指定 keepalive_interval，等待期间每隔该时长额外产生一个 ('keepalive', None) 事件。
+        subscriber 为登记过的接替者时，离开的同时退出接替。
+        """
+        return self._iterate(keepalive_interval, subscriber)
+
+    async def _iterate(self, keepalive_interval: float | None, subscriber: str | None):
+        index = 0
+        self.subscribers += 1
+        try:
+            while True:
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    return
+                signal = self._signal
+                try:
+                    await asyncio.wait_for(signal.wait(), timeout=keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield 'keepalive', None
+        finally:
+            self.subscribers -= 1
+            if subscriber:
+                self.remove_successor(subscriber)
+            if self.subscribers <= 0 and not self.done and self._task:
+                self._task.cancel()
+
+
+class SingleFlightGroup:
+    """按 key 管理进行中的 Flight。Flight 结束后自动移除，之后相同的请求会发起新的上游请求。"""
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+
+    def get(self, key: str) -> Flight | None:
+        return self._flights.get(key)
+
+    def create(self, key: str) -> Flight:
+        flight = Flight(key)
+        self._flights[key] = flight
+        flight.add_done_callback(self._remove)
+        return flight
+
+    def _remove(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def __len__(self) -> int:
+        return len(self._flights)
@@ -4,18 +4,16 @@ import shutil
 import time
 import subprocess
 import sys
-import json
-import re
+
+# 本脚本以 `python modules/update_script.py` 方式运行，modules 目录位于 sys.path 中
+from config_store import parse_jsonc, read_text_file, set_jsonc_values, write_file_atomic
 
 def load_jsonc_values(path):
     """从一个 .jsonc 文件中加载数据，忽略注释，只返回键值对。"""
     try:
         with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        content = re.sub(r'//.*', '', content)
-        content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-        return json.loads(content)
-    except (FileNotFoundError, json.JSONDecodeError, Exception) as e:
+            return parse_jsonc(f.read())
+    except (FileNotFoundError, ValueError, Exception) as e:
         print(f"加载或解析 {path} 的值时出错: {e}")
         return None
 
@@ -112,27 +110,16 @@ def main():
     if old_config_values and os.path.exists(new_config_template_path):
         print("\n[*] 正在智能合并配置（保留注释）...")
         try:
-            with open(new_config_template_path, 'r', encoding='utf-8') as f:
-                new_config_content = f.read()
+            new_config_content, newline = read_text_file(new_config_template_path)
 
-            new_version_values = load_jsonc_values(new_config_template_path)
+            new_version_values = parse_jsonc(new_config_content)
             new_version = new_version_values.get("version", "unknown")
             old_config_values["version"] = new_version
 
-            for key, value in old_config_values.items():
-                if isinstance(value, str):
-                    replacement_value = f'"{value}"'
-                elif isinstance(value, bool):
-                    replacement_value = str(value).lower()
-                else:
-                    replacement_value = str(value)
-                
-                pattern = re.compile(f'("{key}"\s*:\s*)(?:".*?"|true|false|[\d\.]+)')
-                if pattern.search(new_config_content):
-                    new_config_content = pattern.sub(f'\\g<1>{replacement_value}', new_config_content)
-
-            with open(old_config_path, 'w', encoding='utf-8') as f:
-                f.write(new_config_content)
+            # 以新版模板（含注释）为基础，写入旧配置中仍然存在于新版的键；新版新增的键保留默认值
+            preserved = {key: value for key, value in old_config_values.items() if key in new_version_values}
+            new_config_content = set_jsonc_values(new_config_content, preserved)
+            write_file_atomic(old_config_path, new_config_content, newline)
             print("配置合并成功。")
 
         except Exception as e:
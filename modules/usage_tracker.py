@@ -0,0 +1,128 @@
+# usage_tracker.py
+# 用量统计：请求路径只更新内存计数，后台任务定期批量写入 JSONL 文件
+
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestUsage:
+    """
+    单个请求的用量。completion_chars 在解析流时累加；upstream 为 LMArena 结束记录中的 usage（若有），
+    按参与者位置 ('a'/'b') 保存，对战模式下两侧各有一条。
+    """
+    client: str
+    model: str
+    prompt_chars: int = 0
+    completion_chars: int = 0
+    upstream: dict[str, dict] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.time)
+
+    def to_openai_usage(self) -> dict:
+        """
+        转换为 OpenAI 的 usage 块。上游提供了 token 数时直接使用，
+        否则按实际字符数估算（约 4 字符 / token）。两侧共用同一份提示词，补全 token 数相加。
+        """
+        sides = list(self.upstream.values())
+        prompts = [_first_int(u, "promptTokens", "prompt_tokens", "inputTokens") for u in sides]
+        completions = [_first_int(u, "completionTokens", "completion_tokens", "outputTokens") for u in sides]
+        prompt_tokens = max((p for p in prompts if p is not None), default=None)
+        completion_tokens = sum(completions) if sides and None not in completions else None
+        if prompt_tokens is None:
+            prompt_tokens = self.prompt_chars // 4
+        if completion_tokens is None:
+            completion_tokens = self.completion_chars // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+
+def _first_int(data: dict, *keys) -> int | None:
+    for key in keys:
+        value = data.get(key)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    return None
+
+
+class UsageTracker:
+    """
+    按调用方累计用量。record() 只修改内存中的计数；
+    flush() 把上次写入以来的增量追加到 JSONL 文件，文件写入在线程池中进行。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.totals: dict[str, dict] = {}
+        self._pending: dict[str, dict] = {}
+
+    @staticmethod
+    def _empty() -> dict:
+        return {
+            "requests": 0,
+            "rejected": 0,
+            "prompt_chars": 0,
+            "completion_chars": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+    def _add(self, client: str, delta: dict):
+        for table in (self.totals, self._pending):
+            counters = table.setdefault(client, self._empty())
+            for key, value in delta.items():
+                counters[key] += value
+
+    def record(self, usage: RequestUsage):
+        openai_usage = usage.to_openai_usage()
+        self._add(usage.client, {
+            "requests": 1,
+            "prompt_chars": usage.prompt_chars,
+            "completion_chars": usage.completion_chars,
+            "prompt_tokens": openai_usage["prompt_tokens"],
+            "completion_tokens": openai_usage["completion_tokens"],
+        })
+
+    def record_rejection(self, client: str):
+        self._add(client, {"rejected": 1})
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        timestamp = int(time.time())
+        lines = [json.dumps({"ts": timestamp, "client": client, **counters}, ensure_ascii=False) for client, counters in pending.items()]
+        try:
+            await asyncio.to_thread(self._append, lines)
+        except OSError as e:
+            logger.error(f"写入用量统计文件 '{self.path}' 失败: {e}")
+            # 写入失败的增量放回，下次一并写入
+            for client, counters in pending.items():
+                merged = self._pending.setdefault(client, self._empty())
+                for key, value in counters.items():
+                    merged[key] += value
+
+    def _append(self, lines: list[str]):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+
+    async def run(self, interval: float):
+        """后台定期写入，取消时做最后一次写入。"""
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        except asyncio.CancelledError:
+            await self.flush()
+            raise
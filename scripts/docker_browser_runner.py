@@ -5,18 +5,29 @@ from __future__ import annotations
 Docker + noVNC Selenium runner for LMArena Bridge.
 - Starts selenium/standalone-chrome container (WebDriver 4444, noVNC 7900)
 - Injects LMArenaApiBridge userscript into every new document via CDP
+- Optionally opens and supervises several bridge tabs in the same browser (--tabs N)
+- Probes SOCKS5 candidates in parallel, ranks them and switches away from a degraded proxy
+- Supervises the bridge after startup and recovers from disconnects, Cloudflare and crashes
+- Scales the number of bridge tabs with the server's queue depth (--min-tabs/--max-tabs)
 - Detects Cloudflare challenge and asks user to open noVNC to solve
 - Rewrites localhost endpoints in userscript to host.docker.internal for WS/HTTP back to host
 """
 import argparse
+import importlib.util
 import json
+import math
 import os
+import socket
 import subprocess
 import sys
+import threading
 import time
 import re
 import random
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from urllib.parse import unquote, urlsplit
 
 import requests
 from selenium import webdriver
@@ -34,6 +45,8 @@ NOVNC_URL = "http://localhost:7900/?autoconnect=1&resize=scale&password=secret"
 AVAILABLE_MODELS_PATH = ROOT / "available_models.json"
 SOCKS_LOCK_PATH = ROOT / "socks5.lock.json"
 CONFIG_PATH = ROOT / "config.jsonc"
+STATUS_PATH = ROOT / "runner_status.json"
+API_SERVER_URL = "http://127.0.0.1:5102"
 
 def run(cmd: list[str], check=True) -> subprocess.CompletedProcess:
     return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=check)
@@ -203,16 +216,206 @@ def read_locked_socks5() -> str | None:
         pass
     return None
 
-def write_locked_socks5(proxy: str) -> None:
+def read_socks_ranking() -> dict[str, dict]:
+    """读取锁文件中保存的各代理历史探测统计，键为代理地址。"""
     try:
-        SOCKS_LOCK_PATH.write_text(
-            json.dumps({"proxy": proxy, "ts": int(time.time())}, ensure_ascii=False, indent=2),
-            encoding="utf-8"
-        )
-        print(f"[SOCKS] 已锁定并保存 SOCKS5: {proxy} -> {SOCKS_LOCK_PATH}")
+        if SOCKS_LOCK_PATH.exists():
+            data = json.loads(SOCKS_LOCK_PATH.read_text(encoding="utf-8"))
+            return {normalize_socks5(item["proxy"]): item for item in data.get("ranking", []) if item.get("proxy")}
+    except Exception:
+        pass
+    return {}
+
+def write_locked_socks5(proxy: str, stats: dict[str, dict] | None = None, announce: bool = True) -> None:
+    # "proxy" 字段保持不变以兼容旧版本；"ranking" 为按健康度排序的探测统计
+    data = {"proxy": proxy, "ts": int(time.time())}
+    if stats:
+        data["ranking"] = [stats[p] for p in rank_socks_candidates(stats)]
+    try:
+        SOCKS_LOCK_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        if announce:
+            print(f"[SOCKS] 已锁定并保存 SOCKS5: {proxy} -> {SOCKS_LOCK_PATH}")
     except Exception as e:
         print(f"[SOCKS] 写入锁文件失败: {e}")
 
+# 连续探测失败次数达到该值，或延迟超过最优备选的该倍数时，视为当前代理已劣化
+SOCKS_DEGRADED_FAILURES = 2
+SOCKS_DEGRADED_LATENCY_RATIO = 3.0
+# 延迟低于该值时不因延迟而切换，避免毫秒级波动触发重建会话
+SOCKS_DEGRADED_MIN_LATENCY_MS = 1000
+# 成功率按指数滑动平均统计，近期的探测结果权重更高
+SOCKS_SUCCESS_EWMA = 0.3
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError("代理提前关闭了连接")
+        data += chunk
+    return data
+
+def _socks5_handshake(proxy: str, target_host: str, target_port: int, timeout: float) -> None:
+    """不依赖 PySocks 的最小 SOCKS5 握手：认证后请求 CONNECT 到目标站点，成功即返回。"""
+    parts = urlsplit(proxy)
+    username = unquote(parts.username or "")
+    password = unquote(parts.password or "")
+    with socket.create_connection((parts.hostname, parts.port or 1080), timeout=timeout) as sock:
+        sock.settimeout(timeout)
+        methods = b"\x00\x02" if username else b"\x00"
+        sock.sendall(b"\x05" + bytes([len(methods)]) + methods)
+        version, method = _recv_exact(sock, 2)
+        if version != 5 or method == 0xFF:
+            raise OSError("代理不接受任何可用的认证方式")
+        if method == 0x02:
+            user, pwd = username.encode(), password.encode()
+            sock.sendall(b"\x01" + bytes([len(user)]) + user + bytes([len(pwd)]) + pwd)
+            if _recv_exact(sock, 2)[1] != 0:
+                raise OSError("代理认证失败")
+        host = target_host.encode("idna")
+        sock.sendall(b"\x05\x01\x00\x03" + bytes([len(host)]) + host + target_port.to_bytes(2, "big"))
+        reply = _recv_exact(sock, 4)
+        if reply[1] != 0:
+            raise OSError(f"代理 CONNECT 失败（错误码 {reply[1]}）")
+
+def _host_side_proxy(proxy: str) -> str:
+    # 容器内通过 host.docker.internal 访问的代理，在宿主机上探测时对应 127.0.0.1
+    return proxy.replace("@host.docker.internal", "@127.0.0.1").replace("//host.docker.internal", "//127.0.0.1")
+
+def probe_socks5(proxy: str, url: str, timeout: float) -> dict:
+    """
+    通过代理做一次轻量探测，不创建浏览器会话。
+    安装了 PySocks（requests[socks]）时发起真实的 HTTP 请求；否则只做 SOCKS5 握手并 CONNECT 到目标站点。
+    任何 HTTP 响应（包括 Cloudflare 的 403）都说明代理可用。
+    """
+    host_proxy = _host_side_proxy(proxy)
+    target = urlsplit(url)
+    t0 = time.perf_counter()
+    try:
+        if importlib.util.find_spec("socks") is not None:
+            remote_dns = host_proxy.replace("socks5://", "socks5h://", 1)
+            with requests.get(url, proxies={"http": remote_dns, "https": remote_dns}, timeout=timeout, stream=True):
+                pass
+        else:
+            _socks5_handshake(host_proxy, target.hostname, target.port or (443 if target.scheme == "https" else 80), timeout)
+        return {"proxy": proxy, "ok": True, "latency_ms": round((time.perf_counter() - t0) * 1000), "error": None}
+    except Exception as e:
+        return {"proxy": proxy, "ok": False, "latency_ms": None, "error": str(e)[:200]}
+
+def probe_socks_candidates(candidates: list[str], url: str, timeout: float) -> list[dict]:
+    """并发探测所有候选代理，总耗时约等于最慢的一次探测而不是各次之和。"""
+    if not candidates:
+        return []
+    with ThreadPoolExecutor(max_workers=min(16, len(candidates))) as pool:
+        return list(pool.map(lambda p: probe_socks5(p, url, timeout), candidates))
+
+def update_socks_stats(stats: dict[str, dict], results: list[dict]) -> None:
+    for result in results:
+        entry = stats.setdefault(result["proxy"], {"proxy": result["proxy"], "probes": 0, "success_rate": None, "latency_ms": None, "consecutive_failures": 0})
+        ok = 1.0 if result["ok"] else 0.0
+        rate = entry.get("success_rate")
+        entry["success_rate"] = ok if rate is None else round(rate * (1 - SOCKS_SUCCESS_EWMA) + ok * SOCKS_SUCCESS_EWMA, 3)
+        entry["probes"] = entry.get("probes", 0) + 1
+        entry["ok"] = result["ok"]
+        entry["last_probe"] = int(time.time())
+        entry["last_error"] = result["error"]
+        if result["ok"]:
+            entry["latency_ms"] = result["latency_ms"]
+            entry["consecutive_failures"] = 0
+        else:
+            entry["consecutive_failures"] = entry.get("consecutive_failures", 0) + 1
+
+def rank_socks_candidates(stats: dict[str, dict], candidates: list[str] | None = None) -> list[str]:
+    """按最近一次是否可用、成功率（降序）、延迟（升序）排序。"""
+    pool = candidates if candidates is not None else list(stats)
+    def score(proxy: str):
+        entry = stats.get(proxy, {})
+        latency = entry.get("latency_ms")
+        return (
+            not entry.get("ok", False),
+            -(entry.get("success_rate") or 0),
+            latency if latency is not None else float("inf"),
+        )
+    return sorted(pool, key=score)
+
+def print_socks_ranking(stats: dict[str, dict], ranking: list[str]) -> None:
+    for i, proxy in enumerate(ranking, 1):
+        entry = stats.get(proxy, {})
+        if entry.get("ok"):
+            print(f"[SOCKS] #{i} {proxy}  延迟 {entry['latency_ms']}ms  成功率 {entry['success_rate']:.0%}")
+        else:
+            print(f"[SOCKS] #{i} {proxy}  不可用: {entry.get('last_error')}")
+
+def is_socks_degraded(stats: dict[str, dict], current: str, ranking: list[str]) -> bool:
+    entry = stats.get(current)
+    if not entry:
+        return False
+    if entry.get("consecutive_failures", 0) >= SOCKS_DEGRADED_FAILURES:
+        return True
+    alternatives = [stats[p]["latency_ms"] for p in ranking if p != current and stats[p].get("ok")]
+    latency = entry.get("latency_ms")
+    if not alternatives or not entry.get("ok", False) or latency is None:
+        return False
+    return latency > SOCKS_DEGRADED_MIN_LATENCY_MS and latency > SOCKS_DEGRADED_LATENCY_RATIO * min(alternatives)
+
+class SocksHealthMonitor(threading.Thread):
+    """
+    后台线程：定期并发探测全部候选代理，更新锁文件中的排名。
+    当前代理劣化时记录一个待切换的代理，由主线程在 TabSupervisor 中取走并重建浏览器会话
+    （WebDriver 会话不是线程安全的，切换必须在主线程进行）。
+    """
+
+    def __init__(self, candidates: list[str], current: str, stats: dict[str, dict], url: str, timeout: float, interval: float):
+        super().__init__(daemon=True)
+        self.candidates = candidates
+        self.current = current
+        self.stats = stats
+        self.url = url
+        self.timeout = timeout
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending_switch: str | None = None
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            results = probe_socks_candidates(self.candidates, self.url, self.timeout)
+            with self._lock:
+                update_socks_stats(self.stats, results)
+                ranking = rank_socks_candidates(self.stats, self.candidates)
+                write_locked_socks5(self.current, self.stats, announce=False)
+                if self._pending_switch is None and is_socks_degraded(self.stats, self.current, ranking):
+                    best = next((p for p in ranking if p != self.current and self.stats[p].get("ok")), None)
+                    if best:
+                        print(f"[SOCKS] 当前代理 {self.current} 已劣化，准备切换到 {best}")
+                        self._pending_switch = best
+
+    def take_switch(self) -> str | None:
+        with self._lock:
+            proxy, self._pending_switch = self._pending_switch, None
+            return proxy
+
+    def ranked_alternatives(self, exclude: str) -> list[str]:
+        with self._lock:
+            ranking = rank_socks_candidates(self.stats, self.candidates)
+            return [p for p in ranking if p != exclude and self.stats.get(p, {}).get("ok")]
+
+    def set_current(self, proxy: str) -> None:
+        with self._lock:
+            self.current = proxy
+            write_locked_socks5(proxy, self.stats)
+
+    def mark_failed(self, proxy: str, error: str) -> None:
+        with self._lock:
+            update_socks_stats(self.stats, [{"proxy": proxy, "ok": False, "latency_ms": None, "error": error}])
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+def new_profile_dir() -> str:
+    suffix = f"{int(time.time())}-{random.randint(1000,9999)}"
+    return f"/tmp/chrome-profile-{suffix}"
+
 def create_chrome_options(proxy: str | None = None, user_data_dir: str | None = None) -> ChromeOptions:
     options = ChromeOptions()
     options.page_load_strategy = "eager"
@@ -223,6 +426,10 @@ def create_chrome_options(proxy: str | None = None, user_data_dir: str | None =
     options.add_argument("--allow-insecure-localhost")
     options.add_argument("--disable-features=BlockInsecurePrivateNetworkRequests")
     options.set_capability("acceptInsecureCerts", True)
+    # 多标签页时只有一个处于前台，关闭后台节流，避免心跳与重连定时器被延迟
+    options.add_argument("--disable-background-timer-throttling")
+    options.add_argument("--disable-renderer-backgrounding")
+    options.add_argument("--disable-backgrounding-occluded-windows")
     if proxy:
         options.add_argument(f"--proxy-server={proxy}")
         print(f"[SOCKS] 使用代理: {proxy}")
@@ -263,9 +470,10 @@ def clear_browser_data(driver) -> None:
     except Exception:
         pass
 
-def add_userscript_on_new_document(driver, script_src: str) -> None:
-    # 在每个新文档 document_start 注入
-    driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": script_src})
+def add_userscript_on_new_document(driver, script_src: str) -> str | None:
+    # 在每个新文档 document_start 注入，返回注入脚本的标识，用于重新注入时移除旧脚本
+    result = driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": script_src})
+    return (result or {}).get("identifier")
 
 def navigate(driver, url: str) -> None:
     driver.get(url)
@@ -315,6 +523,74 @@ def wait_userscript_ws_ready(driver, timeout_sec: int = 60) -> bool:
     print("[WARN] 在指定时间内未检测到 '✅' 标记，可能是 API 服务未启动或被浏览器拦截了混合内容。")
     return False
 
+def bridge_tab_id(container: str, index: int) -> str:
+    return f"{container}-tab{index}"
+
+def script_for_tab(script_src: str, tab_id: str) -> str:
+    # 在用户脚本之前设置标签页 ID，重启后的标签页沿用同一 ID，服务器端的记录可以对上
+    return f"window.__LMARENA_BRIDGE_TAB_ID = {json.dumps(tab_id)};\n" + script_src
+
+# 每个标签页当前注入脚本的 CDP 标识，键为标签页 ID
+injected_script_ids: dict[str, str | None] = {}
+
+def open_bridge_tab(driver, script_src: str, url: str, tab_id: str, new_window: bool = True) -> str:
+    """
+    打开一个桥接标签页并返回其窗口句柄。
+    CDP 的新文档注入只作用于当前标签页，因此每个标签页都要单独注入。
+    """
+    if new_window:
+        driver.switch_to.new_window("tab")
+    injected_script_ids[tab_id] = add_userscript_on_new_document(driver, script_for_tab(script_src, tab_id))
+    navigate(driver, url)
+    print(f"[TABS] 标签页 {tab_id} 已打开。")
+    return driver.current_window_handle
+
+def is_tab_alive(driver, handle: str) -> bool:
+    # 标签页崩溃后对其执行脚本会抛出异常（如 "tab crashed"）
+    try:
+        driver.switch_to.window(handle)
+        driver.execute_script("return 1")
+        return True
+    except Exception:
+        return False
+
+def reinject_userscript(driver, script_src: str, tab_id: str) -> None:
+    """在当前标签页移除旧的注入脚本并重新注入（例如用户脚本文件已更新），随后重新加载页面时生效。"""
+    old_id = injected_script_ids.get(tab_id)
+    if old_id:
+        try:
+            driver.execute_cdp_cmd("Page.removeScriptToEvaluateOnNewDocument", {"identifier": old_id})
+        except Exception:
+            pass
+    injected_script_ids[tab_id] = add_userscript_on_new_document(driver, script_for_tab(script_src, tab_id))
+
+def restart_bridge_tab(driver, tabs: dict[str, str], tab_id: str, script_src: str, url: str) -> None:
+    handle = tabs.get(tab_id)
+    try:
+        if handle in driver.window_handles:
+            driver.switch_to.window(handle)
+            driver.close()
+    except Exception:
+        pass
+    # close() 之后当前窗口失效，先切换到任一存活的窗口再新开标签页
+    try:
+        remaining = driver.window_handles
+        if remaining:
+            driver.switch_to.window(remaining[0])
+    except Exception:
+        pass
+    tabs[tab_id] = open_bridge_tab(driver, script_src, url, tab_id)
+
+def open_bridge_tabs(driver, script_src: str, url: str, container: str, start: int, count: int, tabs: dict[str, str]) -> None:
+    """打开序号为 [start, count) 的桥接标签页；打开失败的标签页记为空句柄，由守护循环重试。"""
+    for index in range(start, count):
+        tab_id = bridge_tab_id(container, index)
+        try:
+            tabs[tab_id] = open_bridge_tab(driver, script_src, url, tab_id, new_window=index > 0)
+        except Exception as e:
+            print(f"[TABS] 打开标签页 {tab_id} 失败: {e}，稍后由守护循环重试。")
+            tabs[tab_id] = ""
+
 def api_server_healthcheck() -> bool:
     try:
         r = requests.get("http://127.0.0.1:5102/v1/models", timeout=3)
@@ -357,6 +633,443 @@ def run_connectivity_self_test(timeout_sec: int = 45) -> None:
         time.sleep(1.0)
     print("[TEST] ❌ 自检超时：浏览器可能未成功回传页面，或混合内容被阻止。请确认 '✅' 标记已出现、以及已允许不安全内容。")
 
+def rebuild_browser_session(driver, sequence: list[str | None], script_src: str, args, tab_count: int,
+                            socks_monitor: SocksHealthMonitor | None = None):
+    """
+    关闭旧会话（standalone 镜像默认只允许一个会话），按顺序用候选代理与全新的配置目录重建浏览器，
+    并重新打开全部标签页。Chrome 的代理只能在启动时指定，因此切换代理与更换配置目录都需要重建。
+    返回 (driver, tabs, proxy)，全部失败时抛出 RuntimeError。
+    """
+    try:
+        driver.quit()
+    except Exception:
+        pass
+    for proxy in sequence:
+        drv = create_driver_with(proxy, user_data_dir=new_profile_dir())
+        if drv and probe_site_reachable(drv, args.url, timeout_sec=args.socks_test_timeout):
+            tabs: dict[str, str] = {}
+            open_bridge_tabs(drv, script_src, args.url, args.name, 0, tab_count, tabs)
+            if detect_cloudflare(drv):
+                print(f"[CF] 重建浏览器会话后出现 Cloudflare 验证，请在 noVNC 中完成: {NOVNC_URL}")
+            return drv, tabs, proxy
+        if socks_monitor and proxy:
+            socks_monitor.mark_failed(proxy, "浏览器无法通过该代理打开站点")
+        if drv:
+            try:
+                drv.quit()
+            except Exception:
+                pass
+    raise RuntimeError("所有候选代理/配置都无法重建浏览器会话")
+
+# ===================== 自愈守护 =====================
+
+# 每类问题的恢复步骤：同一问题持续存在时按顺序升级，到达末尾后重复最后一步
+RECOVERY_POLICY = {
+    "dead": ["restart_tab"],
+    "disconnected": ["reload", "reinject", "restart_tab", "rotate", "alert"],
+    "errors": ["reload", "reinject", "restart_tab", "alert"],
+    "cloudflare": ["reload", "alert", "rotate", "alert"],
+}
+ISSUE_LABELS = {
+    "dead": "标签页崩溃或已关闭",
+    "disconnected": "WebSocket 未连接",
+    "errors": "近期请求错误过多",
+    "cloudflare": "Cloudflare 验证",
+}
+ACTION_LABELS = {
+    "reload": "刷新页面",
+    "reinject": "重新注入用户脚本",
+    "restart_tab": "重开标签页",
+    "rotate": "更换代理/配置目录",
+    "alert": "告警",
+}
+# 首次发现问题后先等待的秒数（用户脚本断线后约 5 秒自动重连），崩溃的标签页立即处理
+ISSUE_GRACE_SECONDS = 15
+# 两次恢复操作之间的退避：10s、20s、40s ... 最长 300s
+RECOVERY_BACKOFF_BASE = 10
+RECOVERY_BACKOFF_MAX = 300
+# 重建浏览器会话会断开全部标签页，两次重建之间至少间隔该秒数，期间以告警代替
+REBUILD_COOLDOWN_SECONDS = 600
+# 统计窗口内同一标签页的请求错误达到该数量时视为异常
+ERROR_WINDOW_SECONDS = 120
+ERROR_THRESHOLD = 3
+# 服务器报告标签页在线且健康时，切换到该标签页直接检查页面的最短间隔（切换窗口会打断页面，不必每轮都做）
+TAB_PROBE_INTERVAL_SECONDS = 60
+
+@dataclass
+class TabHealth:
+    tab_id: str
+    status: str = "starting"
+    issue: str | None = None
+    # 针对当前问题已执行的恢复次数，决定下一步在 RECOVERY_POLICY 中的位置
+    streak: int = 0
+    next_action_at: float = 0.0
+    recoveries: int = 0
+    last_action: str | None = None
+    last_ok_at: float | None = None
+    # 只统计该时间之后的错误，恢复操作之后旧错误不再计入
+    errors_since: float = field(default_factory=time.time)
+    recent_errors: int = 0
+    # 上次切换到该标签页检查页面的时间（time.monotonic）
+    last_probe_at: float = 0.0
+
+def fetch_bridge_tabs() -> dict[str, dict] | None:
+    """读取服务器端的标签页状态，服务器不可达时返回 None。"""
+    try:
+        r = requests.get(f"{API_SERVER_URL}/internal/tabs", timeout=3)
+        r.raise_for_status()
+        return {t["tab_id"]: t for t in r.json().get("tabs", [])}
+    except Exception:
+        return None
+
+def request_tab_drain(tab_id: str) -> dict | None:
+    """
+    请服务器排空标签页：不再分配新请求。返回 {"pending_requests": ...}；
+    服务器上没有该标签页时返回 {"pending_requests": 0}，服务器不可达时返回 None。
+    """
+    try:
+        r = requests.post(f"{API_SERVER_URL}/internal/tabs/{tab_id}/drain", timeout=3)
+        if r.status_code == 404:
+            return {"pending_requests": 0}
+        r.raise_for_status()
+        return r.json()
+    except Exception:
+        return None
+
+def fetch_scheduler_load() -> dict | None:
+    """读取服务器的排队深度与每个标签页的负载，服务器不可达时返回 None。"""
+    try:
+        r = requests.get(f"{API_SERVER_URL}/internal/scheduler", timeout=3)
+        r.raise_for_status()
+        return r.json()
+    except Exception:
+        return None
+
+# 连续多少轮检测到压力才扩容，避免瞬时突发触发
+SCALE_UP_STREAK = 2
+# 两次扩容之间的最短间隔（新标签页打开并连上 /ws 需要一些时间）
+SCALE_UP_COOLDOWN_SECONDS = 30
+# 缩容时等待排空的最长时间。服务器在 tab_drain_timeout_seconds（默认 120 秒）后会把剩余请求转移到其他标签页
+TAB_DRAIN_WAIT_SECONDS = 180
+
+def write_json_atomic(path: Path, data: dict) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+class TabSupervisor:
+    """
+    [READY] 之后的守护循环。每轮：
+    - 处理后台代理探测发出的切换请求；
+    - 结合服务器 /internal/tabs（是否在线、健康状态、近期错误）与页面本身（是否崩溃、✅ 标题、Cloudflare）诊断每个标签页；
+    - 按 RECOVERY_POLICY 逐级恢复并指数退避；
+    - 把自身健康状况写入状态文件，供外部监控读取。
+    """
+
+    def __init__(self, driver, tabs: dict[str, str], script_src: str, args, proxy: str | None,
+                 socks_monitor: SocksHealthMonitor | None = None):
+        self.driver = driver
+        self.tabs = tabs
+        self.script_src = script_src
+        self.args = args
+        self.proxy = proxy
+        self.socks_monitor = socks_monitor
+        self.status_path = Path(args.status_file)
+        self.health = self._fresh_health()
+        self.started_at = time.time()
+        self.server_reachable: bool | None = None
+        self.rebuilds = 0
+        self.last_rebuild_at: float | None = None
+        self.alerts: list[dict] = []
+        # 自动扩缩容状态
+        self.pressure_streak = 0
+        self.last_scale_at = time.monotonic()
+        self.scale_events = 0
+        self.load: dict | None = None
+        self.capacity_hint_shown = False
+        # 正在排空、等待关闭的标签页 -> 最晚关闭时间（time.monotonic）
+        self.draining: dict[str, float] = {}
+
+    def _fresh_health(self) -> dict[str, TabHealth]:
+        return {tab_id: TabHealth(tab_id) for tab_id in self.tabs}
+
+    def run(self, interval: float = 5) -> None:
+        while True:
+            time.sleep(interval)
+            next_proxy = self.socks_monitor.take_switch() if self.socks_monitor else None
+            if next_proxy:
+                alternatives = [p for p in self.socks_monitor.ranked_alternatives(self.proxy) if p != next_proxy]
+                self.rebuild([next_proxy] + alternatives + [self.proxy], f"代理 {self.proxy} 已劣化")
+            else:
+                self.check_tabs()
+                if self.args.max_tabs > self.args.min_tabs:
+                    self.autoscale()
+            self.publish_status()
+
+    def check_tabs(self) -> None:
+        server_tabs = fetch_bridge_tabs()
+        self.server_reachable = server_tabs is not None
+        try:
+            handles = set(self.driver.window_handles)
+        except Exception:
+            handles = None
+        for tab_id in list(self.tabs):
+            if tab_id in self.draining:
+                continue
+            health = self.health.setdefault(tab_id, TabHealth(tab_id))
+            issue = self.diagnose(tab_id, health, server_tabs, handles)
+            now = time.monotonic()
+            if issue is None:
+                if health.issue:
+                    print(f"[SUPERVISOR] 标签页 {tab_id} 已恢复正常。")
+                health.status, health.issue, health.streak = "ok", None, 0
+                health.last_ok_at = time.time()
+                continue
+            if issue != health.issue:
+                print(f"[SUPERVISOR] 标签页 {tab_id} 异常: {ISSUE_LABELS[issue]}")
+                health.issue, health.streak = issue, 0
+                health.next_action_at = now if issue == "dead" else now + ISSUE_GRACE_SECONDS
+            health.status = issue
+            if now < health.next_action_at:
+                continue
+            ladder = RECOVERY_POLICY[issue]
+            action = ladder[min(health.streak, len(ladder) - 1)]
+            health.streak += 1
+            health.next_action_at = now + min(RECOVERY_BACKOFF_BASE * 2 ** (health.streak - 1), RECOVERY_BACKOFF_MAX)
+            if self.recover(tab_id, health, action):
+                # 浏览器会话已重建，标签页与状态全部替换，本轮不再继续
+                return
+
+    def diagnose(self, tab_id: str, health: TabHealth, server_tabs: dict[str, dict] | None,
+                 handles: set[str] | None = None) -> str | None:
+        handle = self.tabs.get(tab_id)
+        if not handle or (handles is not None and handle not in handles):
+            return "dead"
+        server_tab = server_tabs.get(tab_id) if server_tabs is not None else None
+        errors = []
+        if server_tab:
+            window_start = max(health.errors_since, time.time() - ERROR_WINDOW_SECONDS)
+            errors = [e for e in server_tab.get("recent_errors", []) if e.get("ts", 0) >= window_start]
+        health.recent_errors = len(errors)
+        # 服务器确认标签页在线、健康且没有近期错误时，页面本身不会有问题，按较长间隔才切换过去检查
+        now = time.monotonic()
+        if (server_tab and server_tab.get("healthy", True) and not errors
+                and now - health.last_probe_at < TAB_PROBE_INTERVAL_SECONDS):
+            return None
+        health.last_probe_at = now
+        if not is_tab_alive(self.driver, handle):
+            return "dead"
+        try:
+            title = self.driver.title or ""
+        except Exception:
+            return "dead"
+        # 读取完整页面源码开销较大，只在已有异常迹象时检测 Cloudflare
+        if not title.strip().startswith("✅") or any("Cloudflare" in e.get("error", "") for e in errors):
+            if detect_cloudflare(self.driver) or "just a moment" in title.lower():
+                return "cloudflare"
+        if not title.strip().startswith("✅"):
+            return "disconnected"
+        if server_tabs is not None and (server_tab is None or not server_tab.get("healthy", True)):
+            return "disconnected"
+        if len(errors) >= ERROR_THRESHOLD:
+            return "errors"
+        return None
+
+    def recover(self, tab_id: str, health: TabHealth, action: str) -> bool:
+        """执行一步恢复操作，返回是否重建了整个浏览器会话。"""
+        print(f"[SUPERVISOR] 标签页 {tab_id}（{ISSUE_LABELS[health.issue]}）: {ACTION_LABELS[action]}，第 {health.streak} 次尝试")
+        health.last_action = action
+        health.recoveries += 1
+        health.errors_since = time.time()
+        try:
+            if action == "reload":
+                self.driver.switch_to.window(self.tabs[tab_id])
+                self.driver.refresh()
+            elif action == "reinject":
+                self.driver.switch_to.window(self.tabs[tab_id])
+                reinject_userscript(self.driver, self.script_src, tab_id)
+                navigate(self.driver, self.args.url)
+            elif action == "restart_tab":
+                restart_bridge_tab(self.driver, self.tabs, tab_id, self.script_src, self.args.url)
+            elif action == "rotate":
+                return self.rotate(tab_id, health)
+            elif action == "alert":
+                self.alert(tab_id, health)
+        except RuntimeError:
+            raise
+        except Exception as e:
+            print(f"[SUPERVISOR] 恢复操作失败: {e}")
+        return False
+
+    def rotate(self, tab_id: str, health: TabHealth) -> bool:
+        if self.last_rebuild_at and time.monotonic() - self.last_rebuild_at < REBUILD_COOLDOWN_SECONDS:
+            self.alert(tab_id, health)
+            return False
+        # 有可用的备选代理时换代理，否则以同一代理换一个全新的配置目录
+        alternatives = self.socks_monitor.ranked_alternatives(self.proxy) if self.socks_monitor else []
+        self.rebuild(alternatives + [self.proxy], f"标签页 {tab_id} {ISSUE_LABELS[health.issue]}")
+        return True
+
+    def rebuild(self, sequence: list[str | None], reason: str) -> None:
+        print(f"[SUPERVISOR] {reason}，正在重建浏览器会话...")
+        self.driver, self.tabs, self.proxy = rebuild_browser_session(
+            self.driver, sequence, self.script_src, self.args, len(self.tabs), self.socks_monitor)
+        if self.socks_monitor and self.proxy:
+            self.socks_monitor.set_current(self.proxy)
+        elif self.proxy:
+            write_locked_socks5(self.proxy)
+        self.health = self._fresh_health()
+        self.draining.clear()
+        self.rebuilds += 1
+        self.last_rebuild_at = time.monotonic()
+        print(f"[SUPERVISOR] 浏览器会话已重建（代理: {self.proxy or '无'}）。")
+
+    def alert(self, tab_id: str, health: TabHealth) -> None:
+        print("\n" + "!" * 60)
+        print(f"[ALERT] 标签页 {tab_id}: {ISSUE_LABELS[health.issue]}，自动恢复未能解决，需要人工处理。")
+        print(f"[ALERT] 请打开 noVNC 检查页面: {NOVNC_URL}")
+        print("!" * 60 + "\n")
+        self.alerts.append({"ts": int(time.time()), "tab_id": tab_id, "issue": health.issue})
+        del self.alerts[:-20]
+
+    def autoscale(self) -> None:
+        """
+        按标签页的饱和程度扩缩标签页：某个健康标签页的在途请求达到其并发上限，或平均在途请求数
+        达到 --scale-up-pending 时扩容；没有压力且某个本进程打开的标签页空闲超过 --scale-down-idle 秒时缩容（先经服务器排空再关闭）。
+        同时在途的请求数受服务器 max_concurrent_requests 限制，标签页数量不会超过按该上限摊到
+        每个标签页 --scale-up-pending 个请求所需的数量；调度器排队说明瓶颈在该上限，增加标签页无济于事。
+        新标签页与已有标签页共享同一个浏览器配置，沿用已通过的 Cloudflare 验证与登录状态。
+        """
+        load = fetch_scheduler_load()
+        self.load = load
+        if load is None:
+            return
+        self.close_drained_tabs(load)
+        now = time.monotonic()
+        ready = [t for t in load.get("tabs", []) if t.get("healthy") and not t.get("draining")]
+        pending = sum(t.get("pending_requests", 0) for t in ready)
+        per_tab = pending / len(ready) if ready else float("inf")
+        saturated = [t for t in ready if t.get("max_concurrent") and t.get("pending_requests", 0) >= t["max_concurrent"]]
+        pressure = bool(saturated) or per_tab >= self.args.scale_up_pending
+        self.pressure_streak = self.pressure_streak + 1 if pressure else 0
+        capacity = load.get("capacity") or 0
+        useful_tabs = math.ceil(capacity / self.args.scale_up_pending) if capacity else self.args.max_tabs
+
+        if pressure:
+            if len(ready) >= useful_tabs:
+                if load.get("queued", 0) > 0 and not self.capacity_hint_shown:
+                    print(f"[SCALE] 调度器排队 {load['queued']} 个请求，但同时在途的请求数已达到服务器的 "
+                          f"max_concurrent_requests ({capacity})，增加标签页不会提高吞吐；如需更高并发请调大该配置。")
+                    self.capacity_hint_shown = True
+            elif (self.pressure_streak >= SCALE_UP_STREAK and len(self.tabs) < self.args.max_tabs
+                    and now - self.last_scale_at >= SCALE_UP_COOLDOWN_SECONDS):
+                self.add_tab(f"{len(saturated)} 个标签页已满，平均每个标签页 {per_tab:.1f} 个在途请求")
+            return
+        self.capacity_hint_shown = False
+
+        if (self.draining or len(self.tabs) <= self.args.min_tabs
+                or now - self.last_scale_at < self.args.scale_down_idle):
+            return
+        own = {t["tab_id"]: t for t in load.get("tabs", []) if t["tab_id"] in self.tabs}
+        idle = [
+            tab_id for tab_id, t in own.items()
+            if t.get("pending_requests", 0) == 0 and t.get("idle_seconds", 0) >= self.args.scale_down_idle
+        ]
+        if idle:
+            # 优先关闭序号最大的标签页，保持标签页 ID 连续
+            self.remove_tab(max(idle, key=lambda tab_id: int(tab_id.rsplit("tab", 1)[-1])))
+
+    def add_tab(self, reason: str) -> None:
+        index = next(i for i in range(len(self.tabs) + 1) if bridge_tab_id(self.args.name, i) not in self.tabs)
+        tab_id = bridge_tab_id(self.args.name, index)
+        print(f"[SCALE] {reason}，扩容：打开标签页 {tab_id}（{len(self.tabs) + 1}/{self.args.max_tabs}）")
+        self.tabs[tab_id] = ""
+        self.health[tab_id] = TabHealth(tab_id)
+        try:
+            self.tabs[tab_id] = open_bridge_tab(self.driver, self.script_src, self.args.url, tab_id)
+        except Exception as e:
+            # 保留空句柄，由守护循环按崩溃的标签页处理并重试
+            print(f"[SCALE] 打开标签页 {tab_id} 失败: {e}")
+        self.last_scale_at = time.monotonic()
+        self.pressure_streak = 0
+        self.scale_events += 1
+
+    def remove_tab(self, tab_id: str) -> None:
+        """
+        先请服务器排空标签页（不再分配新请求），服务器报告它没有进行中的请求后再关闭页面，
+        避免关闭前刚分配给它的请求无人处理。
+        """
+        result = request_tab_drain(tab_id)
+        if result is None:
+            return
+        print(f"[SCALE] 标签页 {tab_id} 空闲超过 {self.args.scale_down_idle} 秒，缩容（{len(self.tabs) - 1}/{self.args.max_tabs}）")
+        self.last_scale_at = time.monotonic()
+        if result.get("pending_requests", 0) == 0:
+            self.close_tab(tab_id)
+            return
+        print(f"[SCALE] 标签页 {tab_id} 仍有 {result['pending_requests']} 个进行中的请求，排空后关闭。")
+        self.draining[tab_id] = time.monotonic() + TAB_DRAIN_WAIT_SECONDS
+
+    def close_drained_tabs(self, load: dict) -> None:
+        """关闭已排空（服务器上没有进行中的请求或已断开）或等待超时的标签页。"""
+        server_tabs = {t["tab_id"]: t for t in load.get("tabs", [])}
+        for tab_id, deadline in list(self.draining.items()):
+            server_tab = server_tabs.get(tab_id)
+            if server_tab is None or server_tab.get("pending_requests", 0) == 0 or time.monotonic() >= deadline:
+                del self.draining[tab_id]
+                self.close_tab(tab_id)
+
+    def close_tab(self, tab_id: str) -> None:
+        handle = self.tabs.pop(tab_id)
+        self.health.pop(tab_id, None)
+        injected_script_ids.pop(tab_id, None)
+        try:
+            if handle in self.driver.window_handles:
+                self.driver.switch_to.window(handle)
+                self.driver.close()
+            self.driver.switch_to.window(next(iter(self.tabs.values())))
+        except Exception as e:
+            print(f"[SCALE] 关闭标签页 {tab_id} 失败: {e}")
+        self.last_scale_at = time.monotonic()
+        self.scale_events += 1
+
+    def publish_status(self) -> None:
+        now = time.monotonic()
+        status = {
+            "updated_at": int(time.time()),
+            "uptime_seconds": int(time.time() - self.started_at),
+            "proxy": self.proxy,
+            "server_reachable": self.server_reachable,
+            "browser_rebuilds": self.rebuilds,
+            "healthy_tabs": sum(1 for h in self.health.values() if h.status == "ok"),
+            "tabs": {
+                tab_id: {
+                    "status": h.status,
+                    "streak": h.streak,
+                    "recoveries": h.recoveries,
+                    "last_action": h.last_action,
+                    "last_ok_at": int(h.last_ok_at) if h.last_ok_at else None,
+                    "recent_errors": h.recent_errors,
+                    "next_action_in": round(max(h.next_action_at - now, 0), 1) if h.issue else None,
+                }
+                for tab_id, h in self.health.items()
+            },
+            "alerts": self.alerts,
+            "autoscale": {
+                "min_tabs": self.args.min_tabs,
+                "max_tabs": self.args.max_tabs,
+                "tabs": len(self.tabs),
+                "scale_events": self.scale_events,
+                "draining": sorted(self.draining),
+                "queued": self.load.get("queued") if self.load else None,
+                "utilization": self.load.get("utilization") if self.load else None,
+            },
+        }
+        try:
+            write_json_atomic(self.status_path, status)
+        except Exception as e:
+            print(f"[SUPERVISOR] 写入状态文件失败: {e}")
+
 def main():
     parser = argparse.ArgumentParser(description="Docker+noVNC LMArena Bridge 浏览器引导器")
     parser.add_argument("--image", default=DEFAULT_IMAGE, help="Docker 镜像（默认 selenium/standalone-chrome:latest）")
@@ -377,7 +1090,46 @@ def main():
         default=15,
         help="SOCKS5 可用性探测超时秒数（默认 15s）"
     )
+    parser.add_argument(
+        "--socks-probe-interval",
+        type=int,
+        default=60,
+        help="运行期间后台探测全部 SOCKS5 候选的间隔秒数，当前代理劣化时自动切换到次优代理；0 表示不探测（默认 60s）"
+    )
+    parser.add_argument(
+        "--tabs",
+        type=int,
+        default=1,
+        help="在同一浏览器中打开并守护的 LMArena 标签页数量，每个标签页以独立的标签页 ID 连接 /ws（默认 1）"
+    )
+    parser.add_argument(
+        "--status-file",
+        default=str(STATUS_PATH),
+        help="守护循环写入健康状态的 JSON 文件（默认项目根目录下的 runner_status.json）"
+    )
+    parser.add_argument("--min-tabs", type=int, default=None, help="自动扩缩容时的最少标签页数（默认等于 --tabs）")
+    parser.add_argument("--max-tabs", type=int, default=None, help="自动扩缩容时的最多标签页数（默认等于 --tabs，即不扩缩容）")
+    parser.add_argument(
+        "--scale-up-pending",
+        type=float,
+        default=2,
+        help="平均每个健康标签页的在途请求数达到该值（或某个标签页达到其并发上限）时扩容（默认 2）"
+    )
+    parser.add_argument(
+        "--scale-down-idle",
+        type=int,
+        default=300,
+        help="扩缩容冷却秒数：标签页空闲超过该时长且距上次扩缩容也超过该时长时才会被关闭（默认 300s）"
+    )
     args = parser.parse_args()
+    if args.tabs < 1:
+        parser.error("--tabs 必须大于等于 1")
+    args.min_tabs = args.tabs if args.min_tabs is None else args.min_tabs
+    args.max_tabs = max(args.tabs, args.min_tabs) if args.max_tabs is None else args.max_tabs
+    if not 1 <= args.min_tabs <= args.max_tabs:
+        parser.error("需要满足 1 <= --min-tabs <= --max-tabs")
+    # 初始标签页数限制在 [min, max] 范围内
+    args.tabs = min(max(args.tabs, args.min_tabs), args.max_tabs)
 
     ensure_container(args.image, args.name)
     wait_webdriver_ready()
@@ -397,51 +1149,43 @@ def main():
 
     driver = None
     chosen_proxy: str | None = None
-    need_new_profile_for_next = False
+    socks_stats: dict[str, dict] = {}
 
     if try_seq:
-        for idx, proxy in enumerate(try_seq):
-            # 先试“锁定”的原配置；若失败，再为新候选使用全新用户数据目录
-            user_dir = None
-            if idx == 0 and locked:
-                drv = create_driver_with(proxy)
-                if drv and probe_site_reachable(drv, args.url, timeout_sec=args.socks_test_timeout):
-                    driver = drv
-                    chosen_proxy = proxy
-                    break
-                else:
-                    if drv:
-                        try:
-                            clear_browser_data(drv)
-                        except Exception:
-                            pass
-                        try:
-                            drv.quit()
-                        except Exception:
-                            pass
-                    need_new_profile_for_next = True
-                    continue
-            # 其他候选：使用新的用户数据目录，等同“清除浏览器数据”
-            suffix = f"{int(time.time())}-{random.randint(1000,9999)}"
-            user_dir = f"/tmp/chrome-profile-{suffix}"
+        # 先并发做轻量探测并排序，只对排名靠前的代理创建浏览器会话；
+        # 探测全部失败时仍按排名逐个尝试，避免宿主机与容器网络不一致导致误判
+        socks_stats = read_socks_ranking()
+        print(f"[SOCKS] 并发探测 {len(try_seq)} 个候选代理...")
+        update_socks_stats(socks_stats, probe_socks_candidates(try_seq, args.url, args.socks_test_timeout))
+        try_seq = rank_socks_candidates(socks_stats, try_seq)
+        print_socks_ranking(socks_stats, try_seq)
+
+        for proxy in try_seq:
+            # 锁定的代理沿用原配置；其他候选使用新的用户数据目录，等同“清除浏览器数据”
+            user_dir = None if proxy == locked else new_profile_dir()
             drv = create_driver_with(proxy, user_data_dir=user_dir)
             if drv and probe_site_reachable(drv, args.url, timeout_sec=args.socks_test_timeout):
                 driver = drv
                 chosen_proxy = proxy
                 break
-            else:
-                if drv:
+            update_socks_stats(socks_stats, [{"proxy": proxy, "ok": False, "latency_ms": None, "error": "浏览器无法通过该代理打开站点"}])
+            if drv:
+                if proxy == locked:
                     try:
-                        drv.quit()
+                        clear_browser_data(drv)
                     except Exception:
                         pass
+                try:
+                    drv.quit()
+                except Exception:
+                    pass
 
         if driver is None:
             print("[SOCKS] 未找到可用的 SOCKS5 代理，退出。")
             sys.exit(1)
 
         if chosen_proxy:
-            write_locked_socks5(chosen_proxy)
+            write_locked_socks5(chosen_proxy, socks_stats)
 
     else:
         # 未设置 SOCKS5：不使用代理
@@ -452,8 +1196,8 @@ def main():
 
     # 对每个新 document 注入 userscript，并重新加载目标页以生效
     script_src = load_userscript()
-    add_userscript_on_new_document(driver, script_src)
-    navigate(driver, args.url)
+    tabs: dict[str, str] = {}
+    open_bridge_tabs(driver, script_src, args.url, args.name, 0, 1, tabs)
 
     # 检测 CF
     if detect_cloudflare(driver):
@@ -476,8 +1220,18 @@ def main():
         else:
             print("[WARN] Cloudflare 仍存在，继续保持 noVNC 会话，稍后再试。")
 
+    # 其余标签页在 Cloudflare 验证通过后再打开，共享同一份 Cookie
+    open_bridge_tabs(driver, script_src, args.url, args.name, 1, args.tabs, tabs)
+
     # 等待用户脚本 WebSocket 连接标志（标题前缀 ✅）
-    ws_ok = wait_userscript_ws_ready(driver, timeout_sec=args.test_timeout)
+    ws_ok = True
+    for tab_id, handle in tabs.items():
+        if not handle:
+            ws_ok = False
+            continue
+        driver.switch_to.window(handle)
+        print(f"[TABS] 检查标签页 {tab_id} ...")
+        ws_ok = wait_userscript_ws_ready(driver, timeout_sec=args.test_timeout) and ws_ok
 
     # 可选：做一次端到端自检（需要 api_server.py 正在本机运行）
     if args.self_test:
@@ -488,15 +1242,27 @@ def main():
 
     print("\n[READY] 浏览器会话已准备就绪。保持此进程运行以维持与本机 api_server.py 的 WebSocket 连接。")
     print("        你可以随时打开 noVNC 观察/操作: " + NOVNC_URL)
+    if args.tabs > 1:
+        print(f"        共 {args.tabs} 个桥接标签页。")
+    print(f"        守护循环会自动处理断线、Cloudflare 与崩溃，健康状态写入 {args.status_file}")
     print("        结束会话请按 Ctrl+C")
+    socks_monitor = None
+    if chosen_proxy and args.socks_probe_interval > 0 and len(try_seq) > 1:
+        socks_monitor = SocksHealthMonitor(try_seq, chosen_proxy, socks_stats, args.url,
+                                           args.socks_test_timeout, args.socks_probe_interval)
+        socks_monitor.start()
+    supervisor = TabSupervisor(driver, tabs, script_src, args, chosen_proxy, socks_monitor)
     try:
-        while True:
-            time.sleep(5)
+        supervisor.run()
     except KeyboardInterrupt:
         print("\n[EXIT] 正在退出...")
+    except RuntimeError as e:
+        print(f"\n[ERROR] {e}")
     finally:
+        if socks_monitor:
+            socks_monitor.stop()
         try:
-            driver.quit()
+            supervisor.driver.quit()
         except Exception:
             pass
         if not args.keep_container:
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+聊天请求体内存占用基准：测量并发多图请求时 API 服务器进程的峰值 RSS。
+
+对每个并发数，分别以整体读入内存（request_body_spill_threshold_kb = 0）和流式解析写入临时文件
+（默认 256 KB 阈值）两种方式启动一个独立的服务器进程，用模拟的油猴脚本标签页应答请求
+（应答前等待 --hold 秒，保证所有请求同时在途），然后从 /proc 读取服务器进程的峰值 RSS (VmHWM)。
+
+每个请求包含 --images 张随机内容的 base64 图片（每张 --image-kb KB），请求之间内容不同，不会被合并或去重。
+只支持 Linux（依赖 /proc/<pid>/status）。
+
+用法：
+  python scripts/request_body_rss_bench.py
+  python scripts/request_body_rss_bench.py --concurrency 10 50 --images 4 --image-kb 1536
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def serve(port: int, threshold_kb: int, concurrency: int):
+    """子进程入口：以基准所需的配置启动服务器。"""
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    import logging
+    import uvicorn
+    import api_server
+
+    overrides = {
+        "enable_auto_update": False,
+        "request_body_spill_threshold_kb": threshold_kb,
+        "single_flight_enabled": False,
+        "max_concurrent_requests": concurrency,
+        "session_lane_concurrency": concurrency,
+    }
+    original_load_config = api_server.load_config
+
+    def load_config():
+        original_load_config()
+        api_server.CONFIG.update(overrides)
+        api_server.request_scheduler.set_capacity(concurrency)
+        api_server.session_lanes.set_concurrency(concurrency)
+
+    api_server.load_config = load_config
+    # 模拟的模型不在 models.json 中，每个请求都会产生警告，基准测试时只保留错误
+    logging.getLogger().setLevel(logging.ERROR)
+    uvicorn.run(api_server.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def read_status(pid: int) -> dict[str, int]:
+    """读取进程的内存统计（单位 KB）。"""
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                values[key] = int(value.split()[0])
+    return values
+
+
+async def fake_tab(session: aiohttp.ClientSession, base_url: str, hold: float, ready: asyncio.Event):
+    """模拟油猴脚本标签页：应答心跳，收到请求 hold 秒后返回一段固定文本。"""
+    async with session.ws_connect(f"{base_url}/ws?tab_id=bench", max_msg_size=0) as ws:
+        await ws.send_json({"type": "hello", "tab_id": "bench", "capabilities": ["heartbeat"]})
+        ready.set()
+
+        async def answer(request_id: str):
+            await asyncio.sleep(hold)
+            await ws.send_json({"request_id": request_id, "data": 'a0:"ok"\nad:{"finishReason":"stop"}\n'})
+            await ws.send_json({"request_id": request_id, "data": "[DONE]"})
+
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            message = json.loads(msg.data)
+            if message.get("command") == "ping":
+                await ws.send_json({"type": "pong", "ts": message["ts"]})
+            elif "payload" in message:
+                asyncio.create_task(answer(message["request_id"]))
+
+
+def vision_request(images: int, image_kb: int) -> bytes:
+    content = [{"type": "text", "text": "描述这些图片。"}]
+    for _ in range(images):
+        data = base64.b64encode(os.urandom(image_kb * 1024)).decode("ascii")
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{data}"}})
+    return json.dumps({"model": "bench", "stream": False, "messages": [{"role": "user", "content": content}]}).encode("utf-8")
+
+
+async def run_case(threshold_kb: int, concurrency: int, args) -> dict:
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, __file__, "--serve", str(port), str(threshold_kb), str(concurrency)],
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+            for _ in range(100):
+                try:
+                    async with session.get(f"{base_url}/v1/models"):
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+            ready = asyncio.Event()
+            tab = asyncio.create_task(fake_tab(session, base_url, args.hold, ready))
+            await ready.wait()
+            await asyncio.sleep(0.3)
+
+            bodies = [vision_request(args.images, args.image_kb) for _ in range(concurrency)]
+            baseline = read_status(server.pid)["VmRSS"]
+
+            async def post(body: bytes) -> int:
+                async with session.post(f"{base_url}/v1/chat/completions", data=body, headers={"Content-Type": "application/json"}) as r:
+                    await r.read()
+                    return r.status
+
+            started = time.perf_counter()
+            statuses = await asyncio.gather(*(post(body) for body in bodies))
+            elapsed = time.perf_counter() - started
+            peak = read_status(server.pid)["VmHWM"]
+            tab.cancel()
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "body_mb": len(bodies[0]) / 1024 / 1024,
+        "baseline_mb": baseline / 1024,
+        "peak_mb": peak / 1024,
+        "ok": sum(1 for status in statuses if status == 200),
+        "elapsed": elapsed,
+    }
+
+
+async def main(args):
+    print(f"每个请求 {args.images} 张图片，每张 {args.image_kb} KB（base64 前）")
+    print(f"{'并发':>4}  {'模式':<12}{'请求体/MB':>10}{'基线/MB':>10}{'峰值/MB':>10}{'增量/MB':>10}{'成功':>6}{'耗时/s':>8}")
+    for concurrency in args.concurrency:
+        for label, threshold_kb in (("整体读入", 0), ("流式写盘", args.threshold_kb)):
+            result = await run_case(threshold_kb, concurrency, args)
+            print(
+                f"{concurrency:>4}  {label:<8}{result['body_mb']:>10.1f}{result['baseline_mb']:>10.1f}"
+                f"{result['peak_mb']:>10.1f}{result['peak_mb'] - result['baseline_mb']:>10.1f}"
+                f"{result['ok']:>4}/{concurrency:<3}{result['elapsed']:>6.2f}"
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50], help="并发请求数")
+    parser.add_argument("--images", type=int, default=3, help="每个请求的图片数")
+    parser.add_argument("--image-kb", type=int, default=1024, help="每张图片的原始大小 (KB)")
+    parser.add_argument("--threshold-kb", type=int, default=256, help="流式模式的写盘阈值 (KB)")
+    parser.add_argument("--hold", type=float, default=1.0, help="模拟标签页应答前的等待时间（秒）")
+    asyncio.run(main(parser.parse_args()))
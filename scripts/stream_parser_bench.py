@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+LMArena 流解析器的回放校验与基准工具。
+
+读取 scripts/stream_corpus/ 下的 LMArena 流样本，把每份样本在所有可能的切分点
+重新切成两帧（过长的样本按采样切分）后送入 api_server._process_lmarena_stream，
+检查产生的事件序列与样本中记录的 expected 完全一致，并统计解析器每 MB 的 CPU 耗时。
+由浏览器解析的样本（stream_format 为 events，帧为 {"events": [...]}）则在每个事件边界
+重新分成两批回放。
+
+目前的样本都是按 LMArena 流格式编写的合成数据，并非从真实会话中抓取：
+source 为 "synthetic" 的样本手工编写，"synthetic-generated" 的样本由脚本批量生成（如 long_output）。
+从真实会话抓取的样本请标记为 "captured"。
+
+样本文件格式：
+{
+  "description": "...",
+  "source": "synthetic" | "synthetic-generated" | "captured",
+  "frames": ["油猴脚本转发的原始数据块", ..., {"error": "..."}]
+            或 [{"events": [{"type": "text", "side": "a", "text": "..."}, ...]}, ...],
+  "split_sides": true,  // 可选，对战模式（n=2）回放，事件数据为 [choice 序号, 值]
+  "expected": [["content", "..."], ["finish", "stop"], ...]
+}
+
+用法：
+  python scripts/stream_parser_bench.py
+  python scripts/stream_parser_bench.py --capture long_output --samples 1000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+CORPUS_DIR = Path(__file__).resolve().parent / "stream_corpus"
+sys.path.insert(0, str(ROOT))
+
+import api_server  # noqa: E402
+
+# 每次回放都会产生 INFO 日志，基准测试时只保留警告以上
+logging.getLogger(api_server.__name__).setLevel(logging.WARNING)
+
+
+def load_captures(corpus_dir: Path, only: list[str] | None = None) -> list[tuple[str, dict]]:
+    captures = []
+    for path in sorted(corpus_dir.glob("*.json")):
+        if only and path.stem not in only:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            captures.append((path.stem, json.load(f)))
+    return captures
+
+
+async def replay(frames: list, split_sides: bool = False) -> list[list]:
+    """把一组帧送入解析器，返回事件列表。对战模式的 (choice 序号, 值) 转为列表，便于与 JSON 中的期望值比较。"""
+    request_id = str(uuid.uuid4())
+    queue = asyncio.Queue()
+    for frame in frames:
+        queue.put_nowait(frame)
+    queue.put_nowait("[DONE]")
+    api_server.response_channels[request_id] = queue
+    events = api_server._process_lmarena_stream(request_id, split_sides=split_sides)
+    return [[event_type, list(data) if isinstance(data, tuple) else data] async for event_type, data in events]
+
+
+def split_positions(length: int, exhaustive_limit: int, samples: int, rnd: random.Random) -> list[int]:
+    """短流返回全部切分点；长流返回均匀采样加随机采样的切分点。"""
+    if length <= exhaustive_limit:
+        return list(range(1, length))
+    step = max(1, length // samples)
+    positions = set(range(1, length, step))
+    positions.update(rnd.randrange(1, length) for _ in range(samples))
+    return sorted(positions)
+
+
+def is_event_batch(frame) -> bool:
+    return isinstance(frame, dict) and "events" in frame
+
+
+def stream_length(frames: list) -> int:
+    """可切分的长度：文本帧为字符数，事件帧为事件数。"""
+    if any(is_event_batch(f) for f in frames):
+        return sum(len(f["events"]) for f in frames if is_event_batch(f))
+    return sum(len(f) for f in frames if isinstance(f, str))
+
+
+def frame_size(frame) -> int:
+    if isinstance(frame, str):
+        return len(frame.encode("utf-8"))
+    if is_event_batch(frame):
+        return len(json.dumps(frame, ensure_ascii=False).encode("utf-8"))
+    return 0
+
+
+def build_variants(frames: list, positions: list[int]) -> list[list]:
+    """
+    以原始帧为第一个变体，随后把文本部分拼接后在每个切分点重新切成两帧；
+    事件帧则把全部事件拼接后在每个事件边界重新分成两批。
+    其余帧（如油猴脚本上报的错误对象）保持在末尾原样回放。
+    """
+    variants = [frames]
+    if any(is_event_batch(f) for f in frames):
+        events = [event for f in frames if is_event_batch(f) for event in f["events"]]
+        tail = [f for f in frames if not is_event_batch(f)]
+        for pos in positions:
+            variants.append([{"events": events[:pos]}, {"events": events[pos:]}] + tail)
+        return variants
+    text_frames = [f for f in frames if isinstance(f, str)]
+    tail = [f for f in frames if not isinstance(f, str)]
+    stream = "".join(text_frames)
+    for pos in positions:
+        variants.append([stream[:pos], stream[pos:]] + tail)
+    return variants
+
+
+async def check_capture(name: str, capture: dict, args, rnd: random.Random) -> dict:
+    frames = capture["frames"]
+    expected = capture["expected"]
+    stream_len = stream_length(frames)
+    positions = split_positions(stream_len, args.exhaustive_limit, args.samples, rnd)
+    variants = build_variants(frames, positions)
+
+    failures = []
+    total_bytes = 0
+    cpu_start = time.process_time()
+    for index, variant in enumerate(variants):
+        events = await replay(variant, capture.get("split_sides", False))
+        total_bytes += sum(frame_size(f) for f in variant)
+        if events != expected:
+            split_at = None if index == 0 else positions[index - 1]
+            failures.append((split_at, events))
+            if len(failures) >= args.max_failures:
+                break
+    cpu = time.process_time() - cpu_start
+
+    return {
+        "name": name,
+        "replays": len(variants),
+        "exhaustive": stream_len <= args.exhaustive_limit,
+        "bytes": total_bytes,
+        "cpu": cpu,
+        "failures": failures,
+    }
+
+
+def format_event_diff(expected: list, actual: list) -> str:
+    for i, (e, a) in enumerate(zip(expected, actual)):
+        if e != a:
+            return f"第 {i} 个事件不一致: 期望 {e!r}，实际 {a!r}"
+    return f"事件数量不一致: 期望 {len(expected)} 个，实际 {len(actual)} 个"
+
+
+async def main_async(args) -> int:
+    captures = load_captures(Path(args.corpus), args.capture)
+    if not captures:
+        print(f"[ERROR] 在 {args.corpus} 中没有找到捕获文件。")
+        return 1
+
+    rnd = random.Random(args.seed)
+    all_ok = True
+    grand_bytes, grand_cpu = 0, 0.0
+    print(f"{'capture':<28}{'replays':>9}{'MB':>9}{'CPU s':>9}{'CPU s/MB':>10}  result")
+    for name, capture in captures:
+        result = await check_capture(name, capture, args, rnd)
+        mb = result["bytes"] / (1024 * 1024)
+        per_mb = result["cpu"] / mb if mb else 0.0
+        grand_bytes += result["bytes"]
+        grand_cpu += result["cpu"]
+        status = "OK" if not result["failures"] else f"FAIL ({len(result['failures'])})"
+        mode = "" if result["exhaustive"] else " [sampled]"
+        print(f"{name:<28}{result['replays']:>9}{mb:>9.2f}{result['cpu']:>9.2f}{per_mb:>10.3f}  {status}{mode}")
+        for split_at, events in result["failures"]:
+            where = "原始帧" if split_at is None else f"切分点 {split_at}"
+            print(f"    - {where}: {format_event_diff(capture['expected'], events)}")
+        all_ok = all_ok and not result["failures"]
+
+    grand_mb = grand_bytes / (1024 * 1024)
+    if grand_mb:
+        print(f"{'TOTAL':<28}{'':>9}{grand_mb:>9.2f}{grand_cpu:>9.2f}{grand_cpu / grand_mb:>10.3f}")
+    return 0 if all_ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LMArena 流解析器回放校验与基准")
+    parser.add_argument("--corpus", default=str(CORPUS_DIR), help="捕获文件目录")
+    parser.add_argument("--capture", action="append", help="只运行指定名称的捕获（可重复）")
+    parser.add_argument("--exhaustive-limit", type=int, default=8192, help="流长度不超过该值时遍历全部切分点（默认 8192 字符）")
+    parser.add_argument("--samples", type=int, default=256, help="长流的采样切分点数量（默认 256）")
+    parser.add_argument("--seed", type=int, default=0, help="随机采样种子")
+    parser.add_argument("--max-failures", type=int, default=5, help="每份捕获最多报告的失败数")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
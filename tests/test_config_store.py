@@ -0,0 +1,150 @@
+# test_config_store.py
+# config_store 的测试：JSONC 解析、保留注释与格式的修改，以及 ConfigStore 的换行符保持与重新加载
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.config_store import ConfigStore, parse_jsonc, set_jsonc_values
+
+CONFIG = """{
+  // 行注释，其中的 "引号" 与 {括号} 不会被解析
+  "url": "http://example.com/a//b", // 字符串中的 // 不是注释
+  /* 块注释
+     跨越多行 */
+  "enabled": true,
+
+  "limits": {
+    "interactive": 8,
+    // "bulk": 1,
+    "batch": 1,
+  },
+  "tags": ["a", "b",],
+  "timeout": 300,
+}
+"""
+
+
+class ParseJsoncTest(unittest.TestCase):
+    def test_comments_and_trailing_commas(self):
+        self.assertEqual(parse_jsonc(CONFIG), {
+            "url": "http://example.com/a//b",
+            "enabled": True,
+            "limits": {"interactive": 8, "batch": 1},
+            "tags": ["a", "b"],
+            "timeout": 300,
+        })
+
+    def test_commas_and_comment_markers_inside_strings(self):
+        text = '{"a": ",}", "b": "/* x */", "c": "\\\\", "d": "\\",]",}'
+        self.assertEqual(parse_jsonc(text), {"a": ",}", "b": "/* x */", "c": "\\", "d": '",]'})
+
+    def test_invalid_json_raises(self):
+        with self.assertRaises(ValueError):
+            parse_jsonc('{"a": 1,, }')
+
+
+class SetJsoncValuesTest(unittest.TestCase):
+    def test_preserves_comments_and_trailing_commas(self):
+        text = set_jsonc_values(CONFIG, {"timeout": 60, "enabled": False})
+        self.assertEqual(text, CONFIG.replace('"timeout": 300', '"timeout": 60').replace('"enabled": true', '"enabled": false'))
+        self.assertEqual(parse_jsonc(text)["timeout"], 60)
+
+    def test_unchanged_value_is_left_verbatim(self):
+        text = set_jsonc_values(CONFIG, {"limits": {"interactive": 8, "batch": 1}})
+        self.assertEqual(text, CONFIG)
+
+    def test_nested_value(self):
+        limits = {"interactive": 4, "bulk": {"weight": 1, "tags": ["x"]}}
+        text = set_jsonc_values(CONFIG, {"limits": limits})
+        self.assertEqual(parse_jsonc(text)["limits"], limits)
+        self.assertIn('  "limits": {\n    "interactive": 4,\n    "bulk": {\n      "weight": 1,', text)
+        self.assertIn('// 行注释', text)
+        self.assertIn('"timeout": 300,\n}', text)
+
+    def test_appends_missing_keys(self):
+        text = set_jsonc_values(CONFIG, {"new_key": {"a": 1}, "other": "x"})
+        config = parse_jsonc(text)
+        self.assertEqual(config["new_key"], {"a": 1})
+        self.assertEqual(config["other"], "x")
+        self.assertTrue(text.startswith(CONFIG[:CONFIG.index('"timeout": 300') + len('"timeout": 300')]))
+        self.assertTrue(text.endswith('"other": "x",\n}\n'))
+
+    def test_appends_to_empty_object(self):
+        text = set_jsonc_values("{\n  // 空配置\n}\n", {"a": 1})
+        self.assertEqual(parse_jsonc(text), {"a": 1})
+        self.assertIn("// 空配置", text)
+
+
+class ConfigStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "config.jsonc")
+        self.published = []
+        self.store = ConfigStore(self.path)
+        self.store.subscribe(lambda snapshot, version: self.published.append((snapshot, version)))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, content: str, newline: str = "\n"):
+        with open(self.path, 'w', encoding='utf-8', newline='') as f:
+            f.write(content.replace("\n", newline))
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_update_keeps_crlf(self):
+        self.write(CONFIG, "\r\n")
+        self.store.load()
+        snapshot = self.store.update({"timeout": 60, "added": [1, 2]})
+        data = self.read_bytes()
+        self.assertEqual(data.count(b"\n"), data.count(b"\r\n"))
+        self.assertTrue(data.startswith(CONFIG.split('"limits"')[0].replace("\n", "\r\n").encode('utf-8')))
+        self.assertEqual(snapshot["timeout"], 60)
+        self.assertEqual(snapshot["added"], [1, 2])
+        self.assertEqual(parse_jsonc(data.decode('utf-8')), snapshot)
+
+    def test_update_keeps_lf(self):
+        self.write(CONFIG)
+        self.store.load()
+        self.store.update({"timeout": 60})
+        self.assertEqual(self.read_bytes(), CONFIG.replace('"timeout": 300', '"timeout": 60').encode('utf-8'))
+
+    def test_update_publishes_new_version(self):
+        self.write(CONFIG)
+        self.store.load()
+        self.store.update({"enabled": False})
+        self.assertEqual([version for _, version in self.published], [1, 2])
+        self.assertFalse(self.store.snapshot["enabled"])
+        # 自己写入的修改不会被当作外部修改再加载一次
+        self.assertFalse(self.store.reload_if_changed())
+
+    def test_reload_if_changed(self):
+        self.write(CONFIG)
+        self.store.load()
+        self.assertFalse(self.store.reload_if_changed())
+        self.write(CONFIG.replace('"timeout": 300', '"timeout": 5'))
+        os.utime(self.path, ns=(0, os.stat(self.path).st_mtime_ns + 1_000_000_000))
+        self.assertTrue(self.store.reload_if_changed())
+        self.assertEqual(self.store.snapshot["timeout"], 5)
+        self.assertEqual(self.store.version, 2)
+
+    def test_invalid_file_keeps_previous_snapshot(self):
+        self.write(CONFIG)
+        self.store.load()
+        self.write('{"timeout": ')
+        os.utime(self.path, ns=(0, os.stat(self.path).st_mtime_ns + 1_000_000_000))
+        with self.assertLogs("modules.config_store", "ERROR"):
+            self.assertFalse(self.store.reload_if_changed())
+        self.assertEqual(self.store.snapshot["timeout"], 300)
+        # 文件再次变化之前不重复报错
+        self.assertFalse(self.store.reload_if_changed())
+
+
+if __name__ == "__main__":
+    unittest.main()
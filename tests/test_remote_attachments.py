@@ -0,0 +1,152 @@
+# test_remote_attachments.py
+# RemoteAttachmentFetcher 的测试：用本机 HTTP 服务器代替远程图片地址
+
+import asyncio
+import collections
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.remote_attachments import RemoteAttachmentFetcher, RemoteFetchError
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 1024
+MAX_BYTES = 64 * 1024
+
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+    hits = collections.Counter()
+    delay = 0.3
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.hits[self.path] += 1
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/image.png")
+            self.end_headers()
+            return
+        if self.path == "/slow.png":
+            time.sleep(self.delay)
+        body, content_type = {
+            "/image.png": (PNG, "image/png"),
+            "/slow.png": (PNG, "image/png"),
+            "/untyped.png": (PNG, "application/octet-stream"),
+            "/page": (b"<html></html>", "text/html"),
+            "/large.png": (b"\x00" * (MAX_BYTES + 1), "image/png"),
+        }.get(self.path, (None, None))
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LoopbackResolver:
+    """把任何主机名都解析到 127.0.0.1，模拟 DNS 记录指向内网。"""
+
+    async def resolve(self, host, port=0, family=0):
+        return [{"hostname": host, "host": "127.0.0.1", "port": port, "family": family, "proto": 0, "flags": 0}]
+
+    async def close(self):
+        pass
+
+
+class RemoteAttachmentFetcherTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    async def asyncSetUp(self):
+        ImageHandler.hits.clear()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.fetcher = RemoteAttachmentFetcher(self.cache_dir.name)
+
+    async def asyncTearDown(self):
+        await self.fetcher.close()
+        self.cache_dir.cleanup()
+
+    async def fetch(self, path: str, timeout: float = 5, allow_private: bool = True):
+        return await self.fetcher.fetch(self.base_url + path, MAX_BYTES, timeout, allow_private)
+
+    async def test_fetch_and_cache(self):
+        self.assertEqual(await self.fetch("/image.png"), (PNG, "image/png"))
+        self.assertEqual(await self.fetch("/image.png"), (PNG, "image/png"))
+        self.assertEqual(ImageHandler.hits["/image.png"], 1)
+        self.assertTrue(os.path.exists(self.fetcher.index_path))
+
+    async def test_cache_survives_restart(self):
+        await self.fetch("/image.png")
+        self.fetcher = RemoteAttachmentFetcher(self.cache_dir.name)
+        self.assertEqual(await self.fetch("/image.png"), (PNG, "image/png"))
+        self.assertEqual(ImageHandler.hits["/image.png"], 1)
+
+    async def test_follows_redirect(self):
+        self.assertEqual(await self.fetch("/redirect"), (PNG, "image/png"))
+
+    async def test_guesses_type_from_extension(self):
+        self.assertEqual(await self.fetch("/untyped.png"), (PNG, "image/png"))
+
+    async def test_rejects_private_address(self):
+        with self.assertRaises(RemoteFetchError) as cm:
+            await self.fetch("/image.png", allow_private=False)
+        self.assertEqual(cm.exception.status_code, 403)
+        self.assertEqual(ImageHandler.hits["/image.png"], 0)
+
+    async def test_rejects_hostname_resolving_to_private_address(self):
+        url = f"http://images.example.com:{self.server.server_port}/image.png"
+        with mock.patch("modules.remote_attachments.DefaultResolver", LoopbackResolver):
+            with self.assertRaises(RemoteFetchError) as cm:
+                await self.fetcher.fetch(url, MAX_BYTES, 5, allow_private=False)
+        self.assertEqual(cm.exception.status_code, 403)
+        self.assertEqual(ImageHandler.hits["/image.png"], 0)
+
+    async def test_error_status_codes(self):
+        for path, status_code in (("/page", 415), ("/missing.png", 400), ("/large.png", 413)):
+            with self.subTest(path=path):
+                with self.assertRaises(RemoteFetchError) as cm:
+                    await self.fetch(path)
+                self.assertEqual(cm.exception.status_code, status_code)
+
+    async def test_timeout(self):
+        with self.assertRaises(RemoteFetchError) as cm:
+            await self.fetch("/slow.png", timeout=0.1)
+        self.assertEqual(cm.exception.status_code, 504)
+
+    async def test_concurrent_fetches_share_one_download(self):
+        results = await asyncio.gather(*(self.fetch("/slow.png") for _ in range(5)))
+        self.assertEqual(results, [(PNG, "image/png")] * 5)
+        self.assertEqual(ImageHandler.hits["/slow.png"], 1)
+
+    async def test_cancelled_first_caller_does_not_fail_others(self):
+        first = asyncio.create_task(self.fetch("/slow.png"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(self.fetch("/slow.png"))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        self.assertEqual(await second, (PNG, "image/png"))
+        self.assertTrue(first.cancelled())
+        self.assertEqual(ImageHandler.hits["/slow.png"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+# test_request_body.py
+# 请求体流式解析的测试：任意分块边界、转义与代理对、无效请求体，以及临时文件的引用计数
+
+import asyncio
+import base64
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.request_body import (
+    BlobStore, RequestBodyParser, blob_digest, expand_blob_references, has_blob_references, parse_json_stream,
+)
+
+THRESHOLD = 32
+IMAGE = "data:image/png;base64," + base64.b64encode(bytes(range(256)) * 2).decode("ascii")
+# 原样写在请求体中的 JSON 文本：base64 中的 \/ 与 MIME 换行，非 base64 data: URL 中的各种转义、代理对与多字节字符
+BODY = (
+    '{"model": "m", "messages": [{"role": "user", "content": ['
+    '{"type": "text", "text": "短文本 \\"引号\\" \\\\ \\ud83d\\ude00 😀"},'
+    '{"type": "image_url", "image_url": {"url": "' + IMAGE.replace("/", "\\/", 3) + '\\n"}},'
+    '{"type": "file", "url": "data:text/plain,' + 'x' * 40 + ' \\"q\\" \\\\ \\t \\u00e9 \\ud83d\\ude00 中文 😀"},'
+    '{"type": "text", "text": "data:short,ok"}'
+    ']}], "n": 1, "stream": false}'
+).encode("utf-8")
+
+
+async def chunked(data: bytes, sizes):
+    """按 sizes 给出的长度依次切分 data，最后一段包含剩余的全部内容。"""
+    position = 0
+    for size in sizes:
+        yield data[position:position + size]
+        position += size
+    if position < len(data):
+        yield data[position:]
+
+
+class RequestBodyParserTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = BlobStore(prefix="test_request_body_")
+
+    async def asyncTearDown(self):
+        self.store.clear()
+
+    def files(self) -> list[str]:
+        return sorted(os.listdir(self.store.directory))
+
+    async def parse(self, body: bytes, sizes=(), threshold: int = THRESHOLD):
+        return await parse_json_stream(chunked(body, sizes), self.store, threshold)
+
+    def expand(self, obj) -> object:
+        return json.loads(self.store.expand(json.dumps(obj)))
+
+    async def test_every_chunk_boundary(self):
+        expected = json.loads(BODY)
+        # 缩小批量写入的大小，让字符串在写入文件的中途也会触发 flush
+        with mock.patch("modules.request_body.SPILL_CHUNK", 16):
+            for split in range(1, len(BODY)):
+                with self.subTest(split=split):
+                    obj, blobs = await self.parse(BODY, [split])
+                    self.assertEqual(len(blobs), 2)
+                    self.assertEqual(self.expand(obj), expected)
+                    blobs.release()
+            obj, blobs = await self.parse(BODY, [1] * len(BODY))
+            self.assertEqual(self.expand(obj), expected)
+            blobs.release()
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.files(), [])
+
+    async def test_spilled_strings_keep_escapes(self):
+        obj, blobs = await self.parse(BODY)
+        content = obj["messages"][0]["content"]
+        self.assertEqual(content[0]["text"], "短文本 \"引号\" \\ 😀 😀")
+        self.assertEqual(content[3]["text"], "data:short,ok")
+        url = content[2]["url"]
+        self.assertTrue(url.startswith("data:text/plain,"))
+        self.assertEqual(self.store.read_text(blob_digest(url)), "x" * 40 + ' "q" \\ \t é 😀 中文 😀')
+        image = content[1]["image_url"]["url"]
+        self.assertTrue(image.startswith("data:image/png;base64,"))
+        self.assertEqual(self.store.read_text(blob_digest(image)), IMAGE.split(",", 1)[1] + "\n")
+        blobs.release()
+
+    async def test_short_strings_are_not_spilled(self):
+        obj, blobs = await self.parse(BODY, threshold=len(BODY))
+        self.assertEqual(obj, json.loads(BODY))
+        self.assertEqual(len(blobs), 0)
+        self.assertFalse(has_blob_references(json.dumps(obj)))
+
+    async def test_malformed_bodies_release_files(self):
+        spilled = b'{"url": "data:text/plain,' + b"x" * 40
+        bodies = {
+            "truncated skeleton": BODY[:-1],
+            "truncated spilled string": spilled,
+            "truncated escape": spilled + b"\\",
+            "truncated unicode escape": spilled + b'\\u12"}',
+            "invalid escape": spilled + b'\\x"}',
+            "control character": spilled + b'\x01"}',
+            "invalid skeleton": spilled + b'", , }',
+            "trailing data": BODY + b"}",
+        }
+        for name, body in bodies.items():
+            for sizes in ([], [7] * (len(body) // 7)):
+                with self.subTest(name=name, sizes=sizes[:1]):
+                    with self.assertRaises(ValueError):
+                        await self.parse(body, sizes)
+                    self.assertEqual(len(self.store), 0)
+                    self.assertEqual(self.files(), [])
+
+    async def test_invalid_base64_is_rejected(self):
+        prefix = b'{"url": "data:image/png;base64,' + b"A" * 40
+        for invalid in (b"!", b" ", b"\\t", b"\\\\", b'\\"', "é".encode("utf-8")):
+            with self.subTest(invalid=invalid):
+                with self.assertRaises(ValueError):
+                    await self.parse(prefix + invalid + b'AAAA"}', [len(prefix)])
+                self.assertEqual(self.files(), [])
+        # 同样的内容在非 base64 的 data: URL 中是合法的
+        obj, blobs = await self.parse(b'{"url": "data:text/plain,' + b"A" * 40 + b'!\\t\\\\ "}')
+        self.assertEqual(self.expand(obj)["url"], "data:text/plain," + "A" * 40 + "!\t\\ ")
+        blobs.release()
+
+    async def test_refcount_release(self):
+        first, first_blobs = await self.parse(BODY)
+        second, second_blobs = await self.parse(BODY)
+        # 相同内容只保存一份，两个请求各持有一个引用
+        self.assertEqual(first_blobs.digests, second_blobs.digests)
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(len(self.files()), 2)
+        first_blobs.release()
+        first_blobs.release()
+        self.assertEqual(len(self.files()), 2)
+        self.assertEqual(self.expand(second), json.loads(BODY))
+        second_blobs.discard(second_blobs.digests[0])
+        self.assertEqual(len(self.files()), 1)
+        second_blobs.release()
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.files(), [])
+
+    async def test_interrupted_stream_releases_files(self):
+        async def broken():
+            yield BODY[:len(BODY) * 3 // 4]
+            raise ConnectionResetError("客户端断开")
+
+        with mock.patch("modules.request_body.SPILL_CHUNK", 16):
+            with self.assertRaises(ConnectionResetError):
+                await parse_json_stream(broken(), self.store, THRESHOLD)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.files(), [])
+
+    async def test_abort_during_flush_releases_files(self):
+        parser = RequestBodyParser(self.store, THRESHOLD)
+        parser.feed(BODY)
+        flush = asyncio.ensure_future(parser.flush())
+        await asyncio.sleep(0)
+        flush.cancel()
+        parser.abort()
+        with self.assertRaises(asyncio.CancelledError):
+            await flush
+        # 写入线程结束后由 abort() 登记的回调清理
+        for _ in range(100):
+            if not self.files():
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.files(), [])
+
+    async def test_expand_blob_references(self):
+        obj, blobs = await self.parse(BODY)
+        text = json.dumps({"payload": obj}, ensure_ascii=False)
+        self.assertTrue(has_blob_references(text))
+        expanded = await expand_blob_references(self.store, text)
+        self.assertFalse(has_blob_references(expanded))
+        self.assertEqual(json.loads(expanded)["payload"], json.loads(BODY))
+        plain = json.dumps({"text": "no references"})
+        self.assertIs(await expand_blob_references(self.store, plain), plain)
+        blobs.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
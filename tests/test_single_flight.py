@@ -0,0 +1,114 @@
+# test_single_flight.py
+# 合并请求的测试：发起方在上游请求发出之前失败时，合并进来的请求是接替发起还是一起收到错误
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+
+import api_server
+from modules.single_flight import Flight, SingleFlightGroup
+
+
+async def upstream(*texts):
+    for text in texts:
+        yield 'content', text
+    yield 'finish', 'stop'
+
+
+class FlightHandOffTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.group = SingleFlightGroup()
+        self.flight = self.group.create("key")
+        self.takeovers = []
+
+    def add_follower(self, subscriber: str, texts=("ok",)):
+        """登记一个合并进来的请求：接替时直接开始消费上游事件，返回收集它收到的事件的任务。"""
+        async def takeover():
+            self.takeovers.append(subscriber)
+            self.flight.start(upstream(*texts))
+
+        self.flight.add_successor(subscriber, takeover)
+        events = self.flight.subscribe(subscriber=subscriber)
+        return asyncio.create_task(self.collect(events))
+
+    @staticmethod
+    async def collect(events):
+        return [event async for event in events]
+
+    async def test_cancelled_leader_hands_off_to_follower(self):
+        first = self.add_follower("f1")
+        second = self.add_follower("f2")
+        await asyncio.sleep(0)
+        api_server.abandon_flight(self.flight, asyncio.CancelledError())
+        self.assertEqual(await first, [('content', 'ok'), ('finish', 'stop')])
+        self.assertEqual(await second, [('content', 'ok'), ('finish', 'stop')])
+        self.assertEqual(self.takeovers, ["f1"])
+        self.assertIsNone(self.group.get("key"))
+
+    async def test_queue_timeout_hands_off_to_follower(self):
+        follower = self.add_follower("f1")
+        await asyncio.sleep(0)
+        api_server.abandon_flight(self.flight, api_server.QueueTimeoutError(status_code=503, detail="排队超时"))
+        self.assertEqual(await follower, [('content', 'ok'), ('finish', 'stop')])
+        self.assertEqual(self.takeovers, ["f1"])
+
+    async def test_shared_failure_is_broadcast(self):
+        first = self.add_follower("f1")
+        second = self.add_follower("f2")
+        await asyncio.sleep(0)
+        api_server.abandon_flight(self.flight, HTTPException(status_code=400, detail="请求无效"))
+        self.assertEqual(await first, [('error', '请求无效')])
+        self.assertEqual(await second, [('error', '请求无效')])
+        self.assertEqual(self.takeovers, [])
+        self.assertIsNone(self.group.get("key"))
+
+    async def test_cancelled_leader_without_followers_fails(self):
+        api_server.abandon_flight(self.flight, asyncio.CancelledError())
+        self.assertTrue(self.flight.done)
+        self.assertIsNone(self.group.get("key"))
+
+    async def test_departed_follower_is_skipped(self):
+        gone = self.add_follower("f1")
+        waiting = self.add_follower("f2")
+        await asyncio.sleep(0)
+        gone.cancel()
+        await asyncio.sleep(0)
+        api_server.abandon_flight(self.flight, asyncio.CancelledError())
+        self.assertEqual(await waiting, [('content', 'ok'), ('finish', 'stop')])
+        self.assertEqual(self.takeovers, ["f2"])
+
+    async def test_follower_leaving_during_takeover_passes_it_on(self):
+        started = asyncio.Event()
+
+        async def slow_takeover():
+            self.takeovers.append("f1")
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError as e:
+                api_server.abandon_flight(self.flight, e)
+                raise
+
+        self.flight.add_successor("f1", slow_takeover)
+        first = asyncio.create_task(self.collect(self.flight.subscribe(subscriber="f1")))
+        second = self.add_follower("f2")
+        await asyncio.sleep(0)
+        api_server.abandon_flight(self.flight, asyncio.CancelledError())
+        await started.wait()
+        first.cancel()
+        self.assertEqual(await second, [('content', 'ok'), ('finish', 'stop')])
+        self.assertEqual(self.takeovers, ["f1", "f2"])
+
+    async def test_late_follower_is_not_a_successor(self):
+        self.flight.start(upstream("ok"))
+        self.flight.add_successor("late", lambda: None)
+        self.assertEqual(self.flight.successors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()